@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+class InputSplitter:
+
+    # Split an ordered list of input files into jobs with similar total size
+    #
+    # Files are kept in their original order and each job gets a contiguous
+    # slice of the list. Slice boundaries are placed as close as possible to
+    # equal fractions of the total size, so that the job walltimes (roughly
+    # proportional to the amount of data to process) are balanced: each job
+    # differs from the average by at most one file.
+    #
+    # The number of jobs is fixed by the target size per job, if given, or by
+    # the requested number of files per job (same number of jobs as a plain
+    # split in chunks of files_per_job files).
+
+    def __init__(self,files_per_job=100,bytes_per_job=0,max_files_per_job=1000):
+
+        # At least one file per job
+        self.files_per_job = max(1,files_per_job)
+        self.bytes_per_job = bytes_per_job
+        self.max_files_per_job = max(1,max_files_per_job)
+
+        # Total size of jobs after last split and flag telling if file sizes were available
+        self.job_sizes = []
+        self.sizes_known = False
+
+    def split(self,files):
+
+        # files is a list of (file_url,size) in processing order. Size can be None if unknown
+        # Return a list of lists of file urls, one per job
+        self.job_sizes = []
+        if not files: return []
+
+        # Files with unknown size are assumed to have the average size of the others
+        # If no size is known at all, all files count the same (i.e. split by number of files)
+        known = [ size for (url,size) in files if size ]
+        self.sizes_known = bool(known)
+        if known:
+            default = float(sum(known))/len(known)
+        else:
+            default = 1.
+        weights = [ float(size) if size else default for (url,size) in files ]
+        total = sum(weights)
+
+        # Compute number of jobs
+        if self.bytes_per_job and known:
+            n_jobs = int((total+self.bytes_per_job-1)//self.bytes_per_job)
+        else:
+            n_jobs = (len(files)+self.files_per_job-1)//self.files_per_job
+        n_jobs = max(n_jobs,(len(files)+self.max_files_per_job-1)//self.max_files_per_job,1)
+
+        # Close a job when adding the next file would move it further from its boundary than stopping
+        job_lists = []
+        job_list = []
+        job_size = 0.
+        acc = 0.
+        for i in range(len(files)):
+            w = weights[i]
+            boundary = total*(len(job_lists)+1)/n_jobs
+            if job_list and ((len(job_lists) < n_jobs-1 and acc+w/2. > boundary) or len(job_list) >= self.max_files_per_job):
+                job_lists.append(job_list)
+                self.job_sizes.append(job_size)
+                job_list = []
+                job_size = 0.
+            job_list.append(files[i][0])
+            job_size += w
+            acc += w
+        job_lists.append(job_list)
+        self.job_sizes.append(job_size)
+
+        return job_lists
+
+    def summary(self):
+
+        # Return a string describing the size distribution of the jobs
+        if not self.job_sizes: return "no jobs"
+        if not self.sizes_known: return "%d jobs - file sizes unknown: split by number of files"%len(self.job_sizes)
+        return "%d jobs - size per job min %.1f MB max %.1f MB avg %.1f MB"%(len(self.job_sizes),min(self.job_sizes)/1.E6,max(self.job_sizes)/1.E6,sum(self.job_sizes)/len(self.job_sizes)/1.E6)
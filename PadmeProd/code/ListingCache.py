@@ -0,0 +1,165 @@
+#!/usr/bin/python
+
+import os
+import time
+import json
+import hashlib
+import subprocess
+import shlex
+
+class ListingCache:
+
+    # Local cache of storage directory listings
+    #
+    # Each listing of <uri><path> obtained with "gfal-ls -l" is saved as a JSON
+    # file in the cache directory (by default cache/listing in the top
+    # production directory) with the list of entries (name,size,mtime,is_dir)
+    # and the time when the listing was taken.
+    #
+    # A cached listing is used as it is if it is younger than ttl seconds.
+    # An older listing is still considered valid if the (fresh) listing of its
+    # parent directory shows that the directory was not modified after the
+    # listing was taken. Listing a parent directory once (e.g. the rawdata
+    # directory of a year) thus validates the cached listings of all its
+    # subdirectories with a single storage access.
+
+    def __init__(self,cache_dir="",ttl=None,debug=0):
+
+        if not cache_dir: cache_dir = os.getenv('PADME_LISTING_CACHE',"cache/listing")
+        self.cache_dir = cache_dir
+
+        # Time (in seconds) after which a listing must be validated or refreshed
+        if ttl == None: ttl = int(os.getenv('PADME_LISTING_TTL',"3600"))
+        self.ttl = ttl
+
+        # Set to 1 or more to enable printout of executed commands
+        self.debug = debug
+
+        # Number of attempts for each gfal-ls command
+        self.max_tries = 3
+
+    def cache_file(self,uri,path):
+
+        key = hashlib.sha1("%s%s"%(uri,path.rstrip("/"))).hexdigest()
+        return "%s/%s.json"%(self.cache_dir,key)
+
+    def load(self,uri,path):
+
+        # Return cached listing as a dictionary or None if not available
+        cache_file = self.cache_file(uri,path)
+        if not os.path.exists(cache_file): return None
+        try:
+            with open(cache_file,"r") as cf: listing = json.load(cf)
+        except:
+            return None
+        return listing
+
+    def store(self,uri,path,entries):
+
+        # Write listing to a temporary file and rename it so that concurrent readers never see partial files
+        if not os.path.isdir(self.cache_dir): os.makedirs(self.cache_dir)
+        listing = { "uri": uri, "path": path.rstrip("/"), "time": time.time(), "entries": entries }
+        cache_file = self.cache_file(uri,path)
+        tmp_file = "%s.%d"%(cache_file,os.getpid())
+        with open(tmp_file,"w") as cf: json.dump(listing,cf)
+        os.rename(tmp_file,cache_file)
+        return listing
+
+    def invalidate(self,uri,path):
+
+        cache_file = self.cache_file(uri,path)
+        if os.path.exists(cache_file): os.remove(cache_file)
+
+    def parse_mtime(self,month,day,hour_or_year):
+
+        # gfal-ls -l shows "Mon DD HH:MM" for recent files and "Mon DD YYYY" for older ones
+        try:
+            if ":" in hour_or_year:
+                year = time.localtime().tm_year
+                mtime = time.mktime(time.strptime("%s %s %d %s"%(month,day,year,hour_or_year),"%b %d %Y %H:%M"))
+                # Dates in the future belong to the previous year
+                if mtime > time.time()+86400:
+                    mtime = time.mktime(time.strptime("%s %s %d %s"%(month,day,year-1,hour_or_year),"%b %d %Y %H:%M"))
+            else:
+                mtime = time.mktime(time.strptime("%s %s %s"%(month,day,hour_or_year),"%b %d %Y"))
+        except ValueError:
+            return None
+        return int(mtime)
+
+    def fetch(self,uri,path):
+
+        # List directory on storage and store result in cache. Return listing or None on error
+        cmd = "gfal-ls -l %s%s"%(uri,path)
+        tries = 0
+        while True:
+            if self.debug: print "> %s"%cmd
+            p = subprocess.Popen(shlex.split(cmd),stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+            (out,err) = p.communicate()
+            if p.returncode == 0: break
+            print "WARNING gfal-ls returned error status %d while listing %s%s"%(p.returncode,uri,path)
+            if self.debug:
+                print "- STDOUT -\n%s"%out
+                print "- STDERR -\n%s"%err
+            tries += 1
+            if tries >= self.max_tries:
+                print "*** ERROR *** Could not list %s%s. Tried %d times."%(uri,path,tries)
+                return None
+            time.sleep(5)
+
+        entries = []
+        for line in iter(out.splitlines()):
+            if self.debug >= 2: print line
+            # Long format: <mode> <nlink> <uid> <gid> <size> <month> <day> <time|year> <name>
+            fields = line.split()
+            if not fields: continue
+            if len(fields) >= 9 and fields[4].isdigit():
+                entries.append((fields[-1],int(fields[4]),self.parse_mtime(fields[5],fields[6],fields[7]),fields[0].startswith("d")))
+            else:
+                entries.append((fields[-1],None,None,False))
+        return self.store(uri,path,entries)
+
+    def is_valid(self,listing):
+
+        # Check if a cached listing can still be used
+        if time.time()-listing["time"] < self.ttl: return True
+
+        # Use fresh listing of parent directory (if cached) to check if directory was modified
+        (parent,name) = os.path.split(listing["path"])
+        parent_listing = self.load(listing["uri"],parent)
+        if parent_listing == None or time.time()-parent_listing["time"] >= self.ttl: return False
+        for (entry_name,size,mtime,is_dir) in parent_listing["entries"]:
+            if entry_name == name:
+                # gfal-ls -l shows times with a 1 minute resolution
+                return mtime != None and mtime+60 < listing["time"]
+        return False
+
+    def list(self,uri,path,refresh=False):
+
+        # Return list of (name,size,mtime,is_dir) for all entries in <uri><path> or None on error
+        listing = None
+        if not refresh:
+            listing = self.load(uri,path)
+            if listing != None and not self.is_valid(listing): listing = None
+        if listing == None:
+            listing = self.fetch(uri,path)
+            if listing == None: return None
+        elif self.debug:
+            print "Using cached listing of %s%s"%(uri,path)
+        return [ (str(name),size,mtime,is_dir) for (name,size,mtime,is_dir) in listing["entries"] ]
+
+    def refresh_tree(self,uri,path,subdirs=None):
+
+        # Refresh listing of a directory and then of its subdirectories (only those in subdirs, if given)
+        # Subdirectories which were not modified since their last listing are not listed again
+        # Return number of directories actually listed on storage or -1 on error
+        top = self.fetch(uri,path)
+        if top == None: return -1
+        n_listed = 1
+        for (name,size,mtime,is_dir) in top["entries"]:
+            if not is_dir: continue
+            if subdirs != None and not name in subdirs: continue
+            subpath = "%s/%s"%(path.rstrip("/"),name)
+            listing = self.load(uri,subpath)
+            if listing != None and self.is_valid(listing): continue
+            if self.fetch(uri,subpath) != None: n_listed += 1
+        return n_listed
@@ -1,7 +1,9 @@
 #!/usr/bin/python
 
 import MySQLdb
+import MySQLdb.cursors
 import os
+import hashlib
 import sys
 import time
 
@@ -21,6 +23,9 @@ class PadmeMCDB:
 
         self.conn = None
 
+        # Cache of configurations already stored in the job_config table: (prod_id,hash) -> True
+        self.config_cache = {}
+
     def __del__(self):
 
         self.close_db()
@@ -73,6 +78,29 @@ class PadmeMCDB:
         if n: return True
         return False
 
+    def get_reco_runs(self,reco_version,prod_names,runs):
+
+        # Return set of runs (from runs list) which already have a reco production, checking with a single query
+        # A run is considered done if it was reconstructed with the same version or if a production with
+        # the corresponding name (prod_names[i] for runs[i]) already exists
+        if not runs: return set()
+        self.check_db()
+        c = self.conn.cursor()
+        query = """SELECT r.run,p.name FROM production p LEFT JOIN reco_prod r ON r.production_id = p.id
+WHERE (r.reco_version = %%s AND r.run IN (%s)) OR p.name IN (%s)"""%(",".join(["%s"]*len(runs)),",".join(["%s"]*len(prod_names)))
+        done = set()
+        try:
+            c.execute(query,[reco_version]+list(runs)+list(prod_names))
+        except MySQLdb.Error as e:
+            print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
+        else:
+            prod_run = dict(zip(prod_names,runs))
+            for (run,name) in c.fetchall():
+                if run in runs: done.add(run)
+                if name in prod_run: done.add(prod_run[name])
+        self.conn.commit()
+        return done
+
     def create_recoprod(self,name,run,description,prod_ce,reco_version,prod_dir,storage_uri,storage_dir,proxy_file,n_jobs):
 
         prod_id = self.create_prod(name,prod_ce,prod_dir,storage_uri,storage_dir,proxy_file,n_jobs)
@@ -87,14 +115,34 @@ class PadmeMCDB:
 
         return prod_id
 
-    def create_mcprod(self,name,description,user_req,n_events_req,prod_ce,mc_version,prod_dir,storage_uri,storage_dir,proxy_file,n_jobs):
+    def create_mcprod(self,name,description,user_req,n_events_req,prod_ce,mc_version,prod_dir,storage_uri,storage_dir,proxy_file,n_jobs,seeds=[]):
+
+        # Production, MC info and seed pairs are created in a single transaction: if any seed pair
+        # is already in use (or any other error occurs) nothing is written to the DB and 0 is returned
+        prod_id = 0
+        self.check_db()
+        c = self.conn.cursor()
+        try:
+            c.execute("""INSERT INTO production (name,prod_ce,prod_dir,storage_uri,storage_dir,proxy_file,time_create,n_jobs,n_jobs_ok,n_jobs_fail) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,0,0)""",(name,prod_ce,prod_dir,storage_uri,storage_dir,proxy_file,self.__now__(),n_jobs))
+            prod_id = c.lastrowid
+            c.execute("""INSERT INTO mc_prod (production_id,description,user_req,n_events_req,mc_version) VALUES (%s,%s,%s,%s,%s)""",(prod_id,description,user_req,n_events_req,mc_version))
+            if seeds: c.executemany("""INSERT INTO seed (seed1,seed2,production_id) VALUES (%s,%s,%s)""",[ (seed1,seed2,prod_id) for (seed1,seed2) in seeds ])
+        except MySQLdb.Error as e:
+            print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
+            self.conn.rollback()
+            return 0
+        self.conn.commit()
+
+        return prod_id
+
+    def create_mergeprod(self,name,source_prod_id,description,file_type,target_size,prod_ce,prod_dir,storage_uri,storage_dir,proxy_file,n_jobs):
 
         prod_id = self.create_prod(name,prod_ce,prod_dir,storage_uri,storage_dir,proxy_file,n_jobs)
 
         self.check_db()
         c = self.conn.cursor()
         try:
-            c.execute("""INSERT INTO mc_prod (production_id,description,user_req,n_events_req,mc_version) VALUES (%s,%s,%s,%s,%s)""",(prod_id,description,user_req,n_events_req,mc_version))
+            c.execute("""INSERT INTO merge_prod (production_id,description,source_production_id,file_type,target_size) VALUES (%s,%s,%s,%s,%s)""",(prod_id,description,source_prod_id,file_type,target_size))
         except MySQLdb.Error as e:
             print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
         self.conn.commit()
@@ -140,6 +188,11 @@ class PadmeMCDB:
             self.conn.commit()
             return "MC"
 
+        c.execute("""SELECT id FROM merge_prod WHERE production_id = %s""",(prod_id,))
+        if c.rowcount != 0:
+            self.conn.commit()
+            return "MERGE"
+
         self.conn.commit()
         return "UNKNOWN"
 
@@ -192,6 +245,41 @@ class PadmeMCDB:
         (id,) = res
         return id
 
+    def get_prod_version(self,prod_id):
+
+        # Return (program,version) used by a MC or reconstruction production or None for other productions
+        self.check_db()
+        c = self.conn.cursor()
+        c.execute("""SELECT mc_version FROM mc_prod WHERE production_id = %s""",(prod_id,))
+        res = c.fetchone()
+        if res:
+            self.conn.commit()
+            return ("PadmeMC",res[0])
+        c.execute("""SELECT reco_version FROM reco_prod WHERE production_id = %s""",(prod_id,))
+        res = c.fetchone()
+        self.conn.commit()
+        if res: return ("PadmeReco",res[0])
+        return None
+
+    def get_recoprod_info(self,prod_id):
+
+        # Return (run,reco_version) of a reconstruction production or None for other productions
+        self.check_db()
+        c = self.conn.cursor()
+        c.execute("""SELECT run,reco_version FROM reco_prod WHERE production_id = %s""",(prod_id,))
+        res = c.fetchone()
+        self.conn.commit()
+        return res
+
+    def is_prod_complete(self,prod_id):
+
+        self.check_db()
+        c = self.conn.cursor()
+        c.execute("""SELECT time_complete FROM production WHERE id = %s""",(prod_id,))
+        res = c.fetchone()
+        self.conn.commit()
+        return res != None and res[0] != None
+
     def get_prod_info(self,pid):
 
         self.check_db()
@@ -213,18 +301,138 @@ class PadmeMCDB:
         for j in res: job_list.append(j[0])
         return job_list    
 
+    def get_job_list_info(self,prod_id):
+
+        # Return (id,name,job_dir,status) for all jobs of a production with a single query
+        self.check_db()
+        c = self.conn.cursor()
+        c.execute("""SELECT id,name,job_dir,status FROM job WHERE production_id=%s ORDER BY id""",(prod_id,))
+        res = c.fetchall()
+        self.conn.commit()
+        return list(res)
+
+    def get_prod_input_files(self,prod_id):
+
+        # Return list of input files of all jobs of a production
+        input_files = []
+        self.check_db()
+        c = self.conn.cursor()
+        try:
+            c.execute("""SELECT input_prefix,input_list FROM job WHERE production_id=%s ORDER BY id""",(prod_id,))
+        except MySQLdb.Error as e:
+            print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
+        else:
+            for (input_prefix,input_list) in c.fetchall():
+                input_files.extend(self.expand_input_list(input_prefix,input_list).split())
+        self.conn.commit()
+        return input_files
+
+    def get_prod_storage(self,prod_id):
+
+        # Return (storage_uri,storage_dir) of a production
+        self.check_db()
+        c = self.conn.cursor()
+        c.execute("""SELECT storage_uri,storage_dir FROM production WHERE id=%s""",(prod_id,))
+        res = c.fetchone()
+        self.conn.commit()
+        return res
+
+    def add_prod_jobs(self,prod_id,n_jobs):
+
+        # Add n_jobs to the number of jobs of a production and mark it as running again
+        self.check_db()
+        c = self.conn.cursor()
+        try:
+            c.execute("""UPDATE production SET n_jobs = n_jobs + %s, time_complete = NULL WHERE id = %s""",(n_jobs,prod_id))
+        except MySQLdb.Error as e:
+            print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
+        self.conn.commit()
+
     def create_job(self,prod_id,name,job_dir,configuration,input_list,random):
 
+        # Create job and return its id (None on error)
         # Jobs are created in idle status
         status = 0
 
+        # Configuration is stored once per production and referenced by its hash
+        config_hash = None
+        if configuration: config_hash = self.store_job_config(prod_id,configuration)
+
+        # Input list is stored as a common prefix plus the list of suffixes
+        (input_prefix,input_suffixes) = self.compress_input_list(input_list)
+
+        job_id = None
         self.check_db()
         c = self.conn.cursor()
         try:
-            c.execute("""INSERT INTO job (production_id,name,job_dir,configuration,input_list,random,status,time_create) VALUES (%s,%s,%s,%s,%s,%s,%s,%s)""",(prod_id,name,job_dir,configuration,input_list,random,status,self.__now__()))
+            c.execute("""INSERT INTO job (production_id,name,job_dir,config_hash,input_prefix,input_list,random,status,time_create) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s)""",(prod_id,name,job_dir,config_hash,input_prefix,input_suffixes,random,status,self.__now__()))
         except MySQLdb.Error as e:
             print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
+        else:
+            job_id = c.lastrowid
+        self.conn.commit()
+        return job_id
+
+    def store_job_config(self,prod_id,configuration):
+
+        # Store configuration in the job_config table (if not already there) and return its hash
+        config_hash = hashlib.sha1(configuration).hexdigest()
+        if (prod_id,config_hash) in self.config_cache: return config_hash
+
+        self.check_db()
+        c = self.conn.cursor()
+        try:
+            c.execute("""INSERT IGNORE INTO job_config (production_id,hash,configuration) VALUES (%s,%s,%s)""",(prod_id,config_hash,configuration))
+        except MySQLdb.Error as e:
+            print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
+        else:
+            self.config_cache[(prod_id,config_hash)] = True
+        self.conn.commit()
+        return config_hash
+
+    def compress_input_list(self,input_list):
+
+        # Split an input list (one file URL per line) into the common prefix (up to the last "/")
+        # and the list of suffixes. Return ("",input_list) if there is no common prefix
+        files = [ l for l in input_list.splitlines() if l ]
+        if not files: return ("",input_list)
+        prefix = os.path.commonprefix(files)
+        prefix = prefix[:prefix.rfind("/")+1]
+        if not prefix: return ("",input_list)
+        return (prefix,"".join([ "%s\n"%f[len(prefix):] for f in files ]))
+
+    def expand_input_list(self,input_prefix,input_list):
+
+        # Inverse of compress_input_list: rebuild full input list
+        if not input_list: return ""
+        if not input_prefix: return input_list
+        return "".join([ "%s%s\n"%(input_prefix,l) for l in input_list.splitlines() if l ])
+
+    def get_job_configuration(self,job_id):
+
+        # Return job configuration (old jobs have a full copy in the job table)
+        self.check_db()
+        c = self.conn.cursor()
+        c.execute("""SELECT j.configuration,c.configuration FROM job j LEFT JOIN job_config c ON c.production_id=j.production_id AND c.hash=j.config_hash WHERE j.id=%s""",(job_id,))
+        res = c.fetchone()
         self.conn.commit()
+        if (res == None): return ""
+        (job_configuration,prod_configuration) = res
+        if prod_configuration: return prod_configuration
+        if job_configuration: return job_configuration
+        return ""
+
+    def get_job_input_list(self,job_id):
+
+        # Return full list of input files of a job
+        self.check_db()
+        c = self.conn.cursor()
+        c.execute("""SELECT input_prefix,input_list FROM job WHERE id=%s""",(job_id,))
+        res = c.fetchone()
+        self.conn.commit()
+        if (res == None): return ""
+        (input_prefix,input_list) = res
+        return self.expand_input_list(input_prefix,input_list)
 
     def close_job(self,job_id,status):
 
@@ -336,6 +544,16 @@ class PadmeMCDB:
         self.conn.commit()
         return res
 
+    def get_last_job_submit(self,job_id):
+
+        # Return (id,submit_index,status,ce_job_id) of the last submission of a job or None if it was never submitted
+        self.check_db()
+        c = self.conn.cursor()
+        c.execute("""SELECT id,submit_index,status,ce_job_id FROM job_submit WHERE job_id=%s ORDER BY submit_index DESC LIMIT 1""",(job_id,))
+        res = c.fetchone()
+        self.conn.commit()
+        return res
+
     def get_job_submit_index(self,job_sub_id):
     
         self.check_db()
@@ -346,12 +564,39 @@ class PadmeMCDB:
         (index,) = res
         return index
 
-    def create_job_file(self,job_id,file_name,file_type,seq_n,n_events,size,adler32):
+    def create_job_file(self,job_id,file_name,file_type,seq_n,n_events,size,adler32,storage_uri=None):
 
+        # storage_uri is the storage endpoint where the file was copied, if known
+        # Return id of the new file or 0 on error
+        file_id = 0
         self.check_db()
         c = self.conn.cursor()
         try:
-            c.execute("""INSERT INTO file (job_id,name,type,seq_index,n_events,size,adler32) VALUES (%s,%s,%s,%s,%s,%s,%s)""",(job_id,file_name,file_type,seq_n,n_events,size,adler32))
+            c.execute("""INSERT INTO file (job_id,name,type,seq_index,n_events,size,adler32,storage_uri) VALUES (%s,%s,%s,%s,%s,%s,%s,%s)""",(job_id,file_name,file_type,seq_n,n_events,size,adler32,storage_uri))
+        except MySQLdb.Error as e:
+            print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
+        else:
+            file_id = c.lastrowid
+        self.conn.commit()
+        return file_id
+
+    def job_has_lineage(self,job_id):
+
+        # Return True if input files were registered in file_lineage for this job (reconstruction and merge jobs)
+        self.check_db()
+        c = self.conn.cursor()
+        c.execute("""SELECT 1 FROM file_lineage WHERE job_id = %s LIMIT 1""",(job_id,))
+        res = c.fetchone()
+        self.conn.commit()
+        return res != None
+
+    def set_lineage_output(self,job_id,seq_n,file_id):
+
+        # Link input files of the job to its output file with the same sequential number
+        self.check_db()
+        c = self.conn.cursor()
+        try:
+            c.execute("""UPDATE file_lineage SET output_file_id = %s WHERE job_id = %s AND output_seq_index = %s AND output_file_id IS NULL""",(file_id,job_id,seq_n))
         except MySQLdb.Error as e:
             print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
         self.conn.commit()
@@ -432,6 +677,24 @@ class PadmeMCDB:
             print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
         self.conn.commit()
 
+    def set_job_resources(self,job_sub_id,cpu_min,cpu_avg,cpu_max,rss_peak,read_bytes,write_bytes):
+        self.check_db()
+        c = self.conn.cursor()
+        try:
+            c.execute("""UPDATE job_submit SET cpu_min = %s, cpu_avg = %s, cpu_max = %s, rss_peak = %s, read_bytes = %s, write_bytes = %s WHERE id = %s""",(cpu_min,cpu_avg,cpu_max,rss_peak,read_bytes,write_bytes,job_sub_id))
+        except MySQLdb.Error as e:
+            print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
+        self.conn.commit()
+
+    def set_job_phase_times(self,job_sub_id,setup_time,run_time,checksum_time,upload_time):
+        self.check_db()
+        c = self.conn.cursor()
+        try:
+            c.execute("""UPDATE job_submit SET setup_time = %s, run_time = %s, checksum_time = %s, upload_time = %s WHERE id = %s""",(setup_time,run_time,checksum_time,upload_time,job_sub_id))
+        except MySQLdb.Error as e:
+            print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
+        self.conn.commit()
+
     def set_job_worker_node(self,job_sub_id,worker_node):
         self.check_db()
         c = self.conn.cursor()
@@ -491,53 +754,170 @@ class PadmeMCDB:
         self.conn.commit()
         return prod_dir
 
-    def get_prod_file_list(self,prod_name):
+    def iter_prod_files(self,prod_name,file_type=None):
 
-        file_list = []
-        self.check_db()
-        c = self.conn.cursor()
-        try:
-            c.execute("""
-SELECT f.name 
+        # Generator returning (name,size,adler32,storage_uri) for all files of a production, ordered by name
+        # storage_uri is the storage endpoint where the file was copied or, if not known, the one of the production
+        # If file_type is given (e.g. MCDATA), only files of that type are returned
+        # Files retired after being merged are not returned as they are no longer on storage
+        # Rows are streamed from the server with a server-side cursor: the DB connection
+        # cannot be used for other queries until all rows were read
+        query = """
+SELECT f.name,f.size,f.adler32,COALESCE(f.storage_uri,p.storage_uri)
 FROM file f
     INNER JOIN job j ON j.id = f.job_id
     INNER JOIN production p ON p.id = j.production_id
-WHERE p.name=%s
-            """,(prod_name,))
+WHERE p.name=%s AND f.retired IS NULL"""
+        args = [prod_name]
+        if file_type:
+            query += " AND f.type=%s"
+            args.append(file_type)
+        query += " ORDER BY f.name"
+
+        self.check_db()
+        c = self.conn.cursor(MySQLdb.cursors.SSCursor)
+        try:
+            c.execute(query,args)
         except MySQLdb.Error as e:
             print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
-        else:
-            res = c.fetchall()
-            for (prod_file,) in res:
-                file_list.append("%s"%prod_file)
-            file_list.sort()
-        self.conn.commit()
-        return file_list
+            c.close()
+            self.conn.commit()
+            return
+        try:
+            while True:
+                rows = c.fetchmany(1000)
+                if not rows: break
+                for (file_name,file_size,file_checksum,file_uri) in rows:
+                    if file_size != None: file_size = int(file_size)
+                    yield ("%s"%file_name,file_size,file_checksum,file_uri)
+        finally:
+            c.close()
+            self.conn.commit()
+
+    def get_prod_file_list(self,prod_name):
+
+        # Return sorted list of names of all files in a production
+        return [ file_name for (file_name,file_size,file_checksum,file_uri) in self.iter_prod_files(prod_name) ]
 
     def get_prod_files_attr(self,prod_name):
 
         # Return file attributes (size and adler32 checksum) of all files in a production as dictionaries
         size = {}
         checksum = {}
+        for (file_name,file_size,file_checksum,file_uri) in self.iter_prod_files(prod_name):
+            size[file_name] = file_size
+            checksum[file_name] = file_checksum
+        return (size,checksum)
+
+    def get_used_seeds(self,seeds):
+
+        # Return the set of seed pairs in list which were already used by some production or None on DB error
+        # Pairs are checked in blocks with a single indexed query per block
+        used = set()
+        self.check_db()
+        c = self.conn.cursor()
+        for first in range(0,len(seeds),1000):
+            block = seeds[first:first+1000]
+            query = "SELECT seed1,seed2 FROM seed WHERE (seed1,seed2) IN (%s)"%",".join(["(%s,%s)"]*len(block))
+            values = [ s for pair in block for s in pair ]
+            try:
+                c.execute(query,values)
+            except MySQLdb.Error as e:
+                print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
+                self.conn.commit()
+                return None
+            for (seed1,seed2) in c.fetchall(): used.add((int(seed1),int(seed2)))
+        self.conn.commit()
+        return used
+
+    def register_lineage(self,job_id,reco_version,input_names,n_outputs=1,kind="RECO"):
+
+        # Register input files (file names only, not full paths) processed by a reconstruction job
+        # Merge jobs use kind "MERGE" and no reco version
+        # Jobs with n_outputs output files split the input list in contiguous slices (as the PadmeReco instances
+        # of multicore jobs do): each input file is linked to the sequential number of the output built from it
+        n = max(1,min(n_outputs,len(input_names)))
+        rows = []
+        for k in range(n):
+            for name in input_names[k*len(input_names)//n:(k+1)*len(input_names)//n]: rows.append((name,kind,reco_version,job_id,k))
         self.check_db()
         c = self.conn.cursor()
         try:
-            c.execute("""
-SELECT f.name,f.size,f.adler32 
-FROM file f
-    INNER JOIN job j ON j.id = f.job_id
+            c.executemany("""INSERT INTO file_lineage (input_name,kind,reco_version,job_id,output_seq_index) VALUES (%s,%s,%s,%s,%s)""",rows)
+        except MySQLdb.Error as e:
+            print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
+        self.conn.commit()
+
+    def get_reconstructed_inputs(self,reco_version,input_names):
+
+        # Return the set of input files in list already reconstructed by a successful job with this reco version
+        return self.get_processed_inputs("RECO",reco_version,input_names)
+
+    def get_merged_inputs(self,input_names):
+
+        # Return the set of input files in list already merged by a successful job
+        return self.get_processed_inputs("MERGE",None,input_names)
+
+    def get_processed_inputs(self,kind,reco_version,input_names):
+
+        # Return the set of input files in list already processed by a successful job with this lineage kind
+        # (and reco version, if given). Files are checked in blocks with a single indexed query per block
+        version_sel = ""
+        version_args = []
+        if reco_version != None:
+            version_sel = " AND l.reco_version = %s"
+            version_args = [reco_version]
+        done = set()
+        self.check_db()
+        c = self.conn.cursor()
+        for first in range(0,len(input_names),1000):
+            block = input_names[first:first+1000]
+            query = """SELECT DISTINCT l.input_name FROM file_lineage l JOIN job j ON j.id = l.job_id
+WHERE l.kind = %%s%s AND j.status = 2 AND l.input_name IN (%s)"""%(version_sel,",".join(["%s"]*len(block)))
+            try:
+                c.execute(query,[kind]+version_args+list(block))
+            except MySQLdb.Error as e:
+                print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
+            else:
+                for (name,) in c.fetchall(): done.add(name)
+        self.conn.commit()
+        return done
+
+    def get_retirable_files(self,merge_prod_name):
+
+        # Return list of (file id,file name,storage uri,storage dir) of all files merged by successful jobs of a
+        # merge production into a registered merged file and not yet retired
+        query = """
+SELECT f.id,f.name,COALESCE(f.storage_uri,sp.storage_uri),sp.storage_dir
+FROM file_lineage l
+    INNER JOIN job j ON j.id = l.job_id
     INNER JOIN production p ON p.id = j.production_id
-WHERE p.name=%s
-            """,(prod_name,))
+    INNER JOIN merge_prod m ON m.production_id = p.id
+    INNER JOIN production sp ON sp.id = m.source_production_id
+    INNER JOIN job sj ON sj.production_id = sp.id
+    INNER JOIN file f ON f.job_id = sj.id AND f.name = l.input_name
+WHERE p.name = %s AND j.status = 2 AND l.kind = 'MERGE' AND l.output_file_id IS NOT NULL AND f.retired IS NULL
+ORDER BY f.name"""
+        files = []
+        self.check_db()
+        c = self.conn.cursor()
+        try:
+            c.execute(query,(merge_prod_name,))
         except MySQLdb.Error as e:
             print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
         else:
-            res = c.fetchall()
-            for (file_name,file_size,file_checksum) in res:
-                size[file_name] = int(file_size)
-                checksum[file_name] = file_checksum
+            files = [ (file_id,"%s"%file_name,storage_uri,storage_dir) for (file_id,file_name,storage_uri,storage_dir) in c.fetchall() ]
+        self.conn.commit()
+        return files
+
+    def set_file_retired(self,file_id):
+        self.check_db()
+        c = self.conn.cursor()
+        try:
+            c.execute("""UPDATE file SET retired = %s WHERE id = %s""",(self.__now__(),file_id))
+        except MySQLdb.Error as e:
+            print "MySQL Error:%d:%s"%(e.args[0],e.args[1])
         self.conn.commit()
-        return (size,checksum)
 
     def __now__(self):
         return time.strftime("%Y-%m-%d %H:%M:%S",time.gmtime())
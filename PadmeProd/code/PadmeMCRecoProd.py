@@ -7,13 +7,15 @@ import time
 import subprocess
 import shutil
 import shlex
-import re
 import daemon
 import daemon.pidfile
 
 from PadmeProdServer import PadmeProdServer
 from PadmeMCDB import PadmeMCDB
 from ProxyHandler import ProxyHandler
+from ProdLayout import ProdLayout
+from ProdPlan import ProdPlan
+from InputSplitter import InputSplitter
 
 # Get location of padme-prod software from PADME_PROD env variable
 # Default to ./padme-prod if not set
@@ -34,8 +36,11 @@ PADME_SRM_URI = {
     "CNAF2": "srm://storm-fe-archive.cr.cnaf.infn.it:8444/srm/managerv2?SFN=/padme"
 }
 
+# xrootd URIs used by jobs to read MC files from each storage site
 PADME_ROOT_URI = {
-    "LNF": "root://atlasse.lnf.infn.it:1094//dpm/lnf.infn.it/home/vo.padme.org"
+    "LNF":   "root://atlasse.lnf.infn.it:1094//dpm/lnf.infn.it/home/vo.padme.org",
+    "CNAF":  "root://xrootd-padme.cr.cnaf.infn.it:1094//padmeTape",
+    "CNAF2": "root://xrootd-padme.cr.cnaf.infn.it:1094//padme"
 }
 
 # List of available submission sites and corresponding default CE nodes
@@ -49,6 +54,7 @@ PROD_MCPROD_NAME = ""
 PROD_NAME = ""
 PROD_FILES_PER_JOB = 100
 PROD_FILES_PER_JOB_MAX = 1000
+PROD_MB_PER_JOB = 0
 PROD_STORAGE_DIR = ""
 PROD_DIR = ""
 PROD_SCRIPT = "%s/PadmeProd/script/padmereco_prod.py"%PADME_PROD
@@ -62,14 +68,20 @@ PROD_PROXY_FILE = ""
 PROD_YEAR = ""
 PROD_DEBUG = 0
 PROD_DESCRIPTION = "TEST"
+PROD_FAKE = False
+PROD_REPROCESS = False
+PROD_NCORES = 1
+PROD_NCORES_MAX = 64
+PROD_STAGE_CHUNK = 0
 
 def print_help():
 
-    print "PadmeMCRecoProd -m <mcprod_name> -v <version> [-j <files_per_job>] [-n <prod_name>] [-s <submission_site>] [-C <CE_node> [-P <CE_port>] -Q <CE_queue>] [-d <storage_site>] [-p <proxy>] [-D <description>] [-V] [-h]"
+    print "PadmeMCRecoProd -m <mcprod_name> -v <version> [-j <files_per_job>] [-b <MB_per_job>] [-n <prod_name>] [-s <submission_site>] [-C <CE_node> [-P <CE_port>] -Q <CE_queue>] [-d <storage_site>] [-p <proxy>] [-D <description>] [-R] [-c <cores>] [-k <files>] [-f] [-V] [-h]"
     print "  -m <mcprod_name>\tname of the MC production to process"
     print "  -v <version>\t\tversion of PadmeReco to use for production. Must be installed on CVMFS."
     print "  -n <prod_name>\tname for the production. Default: <mcprod_name>_<version>"
-    print "  -j <files_per_job>\tnumber of rawdata files to be reconstructed by each job. Default: %d"%PROD_FILES_PER_JOB
+    print "  -j <files_per_job>\tnumber of rawdata files to be reconstructed by each job (on average: jobs are balanced by size). Default: %d"%PROD_FILES_PER_JOB
+    print "  -b <MB_per_job>\tamount of data (MB) to be reconstructed by each job. If given, -j is ignored. Default: split by number of files"
     print "  -s <submission_site>\tsite to be used for job submission. Allowed: %s. Default: %s"%(",".join(PADME_CE_NODE.keys()),PROD_RUN_SITE)
     print "  -C <CE_node>\t\tCE node to be used for job submission. If defined, <submission_site> will not be used"
     print "  -P <CE_port>\t\tCE port. Default: %s"%PROD_CE_PORT
@@ -77,6 +89,10 @@ def print_help():
     print "  -d <storage_site>\tsite where the jobs output will be stored. Allowed: %s. Default: %s"%(",".join(PADME_SRM_URI.keys()),PROD_STORAGE_SITE)
     print "  -p <proxy>\t\tLong lived proxy file to use for this production. If not defined it will be created."
     print "  -D <description>\tProduction description (to be stored in the DB). '%s' if not given."%PROD_DESCRIPTION
+    print "  -R\t\t\treconstruct also files already reconstructed by a successful job with the same version"
+    print "  -c <cores>\t\tnumber of cores requested by each job, which splits its input files among <cores> PadmeReco instances. Must be >0 and <=%d. Default: %d"%(PROD_NCORES_MAX,PROD_NCORES)
+    print "  -k <files>\t\tstage input files to local disk in chunks of <files> files while PadmeReco processes the previous chunk. Default: read input files remotely"
+    print "  -f\t\t\tFAKE mode: show what would be created without touching grid, storage and DB"
     print "  -V\t\t\tenable debug mode. Can be repeated to increase verbosity"
 
 def execute_command(command):
@@ -85,12 +101,23 @@ def execute_command(command):
     (out,err) = p.communicate()
     return (p.returncode,out,err)
 
+def get_root_uri(uri):
+
+    # Return xrootd URI of a storage endpoint or "" if it is not known
+    # Endpoints of productions submitted via HTCondor are already xrootd URIs
+    if not uri: return ""
+    if uri.startswith("root://"): return uri
+    for site in PADME_SRM_URI.keys():
+        if PADME_SRM_URI[site] == uri and site in PADME_ROOT_URI: return PADME_ROOT_URI[site]
+    return ""
+
 def main(argv):
 
     # Declare that here we can possibly modify these global variables
     global PROD_MCPROD_NAME
     global PROD_NAME
     global PROD_FILES_PER_JOB
+    global PROD_MB_PER_JOB
     global PROD_STORAGE_DIR
     global PROD_DIR
     global PROD_SCRIPT
@@ -104,9 +131,13 @@ def main(argv):
     global PROD_YEAR
     global PROD_DEBUG
     global PROD_DESCRIPTION
+    global PROD_FAKE
+    global PROD_NCORES
+    global PROD_STAGE_CHUNK
+    global PROD_REPROCESS
 
     try:
-        opts,args = getopt.getopt(argv,"hVm:v:n:j:s:d:C:P:Q:p:D:",[])
+        opts,args = getopt.getopt(argv,"hVm:v:n:j:b:s:d:C:P:Q:p:D:Rc:k:f",[])
     except getopt.GetoptError as e:
         print "Option error: %s"%str(e)
         print_help()
@@ -118,6 +149,10 @@ def main(argv):
             sys.exit(0)
         elif opt == '-V':
             PROD_DEBUG += 1
+        elif opt == '-f':
+            PROD_FAKE = True
+        elif opt == '-R':
+            PROD_REPROCESS = True
         elif opt == '-m':
             PROD_MCPROD_NAME = arg
         elif opt == '-v':
@@ -148,6 +183,17 @@ def main(argv):
                 print "*** ERROR *** Invalid storage site %s. Valid: %s"%(arg,",".join(PADME_SRM_URI.keys()))
                 print_help()
                 sys.exit(2)
+        elif opt == '-b':
+            try:
+                PROD_MB_PER_JOB = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid amount of data per job: '%s'"%arg
+                print_help()
+                sys.exit(2)
+            if PROD_MB_PER_JOB < 0:
+                print "*** ERROR *** Invalid amount of data per job: %d"%PROD_MB_PER_JOB
+                print_help()
+                sys.exit(2)
         elif opt == '-j':
             try:
                 PROD_FILES_PER_JOB = int(arg)
@@ -155,12 +201,30 @@ def main(argv):
                 print "*** ERROR *** Invalid number of files per job: '%s'"%arg
                 print_help()
                 sys.exit(2)
+        elif opt == '-c':
+            try:
+                PROD_NCORES = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid number of cores: '%s'"%arg
+                print_help()
+                sys.exit(2)
+        elif opt == '-k':
+            try:
+                PROD_STAGE_CHUNK = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid number of files per staging chunk: '%s'"%arg
+                print_help()
+                sys.exit(2)
 
     if not PROD_MCPROD_NAME:
         print "*** ERROR *** No MC production name specified."
         print_help()
         sys.exit(2)
 
+    # All actions creating the production go through the planner (only recorded in FAKE mode)
+    PLAN = ProdPlan(PROD_FAKE,PROD_DEBUG)
+    PLAN.phase("Checks")
+
     if not PROD_RECO_VERSION:
         print "*** ERROR *** No reconstruction software version specified."
         print_help()
@@ -182,11 +246,21 @@ def main(argv):
     PROD_SRM = PADME_SRM_URI[PROD_STORAGE_SITE]
 
     # Check if number of files per job is valid
-    if PROD_FILES_PER_JOB < 0 or PROD_FILES_PER_JOB > PROD_FILES_PER_JOB_MAX:
+    if PROD_FILES_PER_JOB < 1 or PROD_FILES_PER_JOB > PROD_FILES_PER_JOB_MAX:
         print "*** ERROR *** Invalid number of files per job requested: %d - Max allowed: %d."%(PROD_FILES_PER_JOB,PROD_FILES_PER_JOB_MAX)
         print_help()
         sys.exit(2)
 
+    if PROD_NCORES < 1 or PROD_NCORES > PROD_NCORES_MAX:
+        print "*** ERROR *** Invalid number of cores per job requested: %d - Max allowed: %d."%(PROD_NCORES,PROD_NCORES_MAX)
+        print_help()
+        sys.exit(2)
+
+    if PROD_STAGE_CHUNK < 0:
+        print "*** ERROR *** Invalid number of files per staging chunk requested: %d"%PROD_STAGE_CHUNK
+        print_help()
+        sys.exit(2)
+
     # If production name was not specified, use the standard name (<mcprod_name>_<reco_version>)
     if PROD_NAME == "":
         PROD_NAME = "%s_%s"%(PROD_MCPROD_NAME,PROD_RECO_VERSION)
@@ -200,7 +274,7 @@ def main(argv):
     if PROD_DIR == "":
         version_dir = "prod/%s"%PROD_RECO_VERSION
         if not os.path.exists(version_dir):
-            os.mkdir(version_dir)
+            PLAN.mkdir(version_dir)
         elif not os.path.isdir(version_dir):
             print "*** ERROR *** '%s' exists but is not a directory"%version_dir
             sys.exit(2)
@@ -210,12 +284,21 @@ def main(argv):
     print "- Starting production %s"%PROD_NAME
     print "- Processing MC production %s"%PROD_MCPROD_NAME
     print "- PadmeReco version %s"%PROD_RECO_VERSION
-    print "- Each job will process %d rawdata files"%PROD_FILES_PER_JOB
+    if PROD_MB_PER_JOB:
+        print "- Each job will process about %d MB of data"%PROD_MB_PER_JOB
+    else:
+        print "- Each job will process about %d files"%PROD_FILES_PER_JOB
+    if PROD_NCORES > 1:
+        print "- Cores per job: %d (input files split among PadmeReco instances)"%PROD_NCORES
+    if PROD_STAGE_CHUNK:
+        print "- Input files staged to local disk in chunks of %d files"%PROD_STAGE_CHUNK
     print "- Submitting jobs to CE %s"%PROD_CE
     print "- Main production directory: %s"%PROD_DIR
     print "- Production script: %s"%PROD_SCRIPT
     print "- Storage SRM: %s"%PROD_SRM
     print "- Storage directory: %s"%PROD_STORAGE_DIR
+    if PROD_FAKE:
+        print "- FAKE mode: nothing will be created"
     if PROD_DEBUG:
         print "- Debug level: %d"%PROD_DEBUG
         PH.debug = PROD_DEBUG
@@ -231,25 +314,20 @@ def main(argv):
         sys.exit(2)
 
     # Create production directory to host support dirs for all jobs
+    PLAN.phase("Setup")
     print "- Creating production dir %s"%PROD_DIR
-    os.mkdir(PROD_DIR)
+    PLAN.mkdir(PROD_DIR)
 
     # Check if long-lived (30 days) proxy was defined. Create it if not
     JOB_PROXY_FILE = "%s/%s.proxy"%(PROD_DIR,PROD_NAME)
     if PROD_PROXY_FILE:
         if os.path.isfile(PROD_PROXY_FILE):
             try:
-                shutil.copyfile(PROD_PROXY_FILE,JOB_PROXY_FILE)
+                PLAN.copy_file(PROD_PROXY_FILE,JOB_PROXY_FILE,0o600)
             except:
                 print "*** ERROR *** Unable to copy long-lived proxy file %s to %s"%(PROD_PROXY_FILE,JOB_PROXY_FILE)
                 shutil.rmtree(PROD_DIR)
                 sys.exit(2)
-            try:
-                os.chmod(JOB_PROXY_FILE,0o600)
-            except:
-                print "*** ERROR *** Unable to set access permissions of long-lived proxy file %s"%JOB_PROXY_FILE
-                shutil.rmtree(PROD_DIR)
-                sys.exit(2)
         else:
             print "*** ERROR *** Long-lived proxy file %s was not found"%PROD_PROXY_FILE
             shutil.rmtree(PROD_DIR)
@@ -257,52 +335,77 @@ def main(argv):
     else:
         print "- Creating long-lived proxy file %s"%JOB_PROXY_FILE
         proxy_cmd = "voms-proxy-init --valid 720:0 --out %s"%JOB_PROXY_FILE
-        if PROD_DEBUG: print "> %s"%proxy_cmd
-        if subprocess.call(shlex.split(proxy_cmd)):
+        if PLAN.run(proxy_cmd):
             print "*** ERROR *** while generating long-lived proxy file %s"%JOB_PROXY_FILE
             shutil.rmtree(PROD_DIR)
             sys.exit(2)
 
     # Check if VOMS proxy exists and is valid. Renew it if not.
     # This is needed to create the storage dir on the SRM server
-    PH.renew_voms_proxy(JOB_PROXY_FILE)
+    # In FAKE mode the current VOMS proxy of the user is used
+    if not PROD_FAKE: PH.renew_voms_proxy(JOB_PROXY_FILE)
 
     # Get list of files for run to reconstruct
-    # All files are assumed to be on the LNF SE and available via the ROOTX protocol
-    job_file_lists = []
-    job_file_list = []
+    # Each file is read via xrootd from the storage endpoint where its job copied it
+    PLAN.phase("Input split")
+    # Files are split among jobs according to their size as stored in the DB
+    # Only data files are processed (histogram files are filtered out by the DB) and they are streamed in name order
+    file_list = []
     prod_dir = DB.get_prod_dir(PROD_MCPROD_NAME)
-    for f in DB.get_prod_file_list(PROD_MCPROD_NAME):
-        # Make sure we process only "_data" files (drop "_hsto" files)
-        if re.match("^.*_data.root$",f):
-            if len(job_file_list) == PROD_FILES_PER_JOB:
-                job_file_lists.append(job_file_list)
-                job_file_list = []
-            file_url = "%s%s/%s"%(PADME_ROOT_URI["LNF"],prod_dir,f)
-            job_file_list.append(file_url)
-    if job_file_list: job_file_lists.append(job_file_list)
+    for (f,size,checksum,uri) in DB.iter_prod_files(PROD_MCPROD_NAME,"MCDATA"):
+        root_uri = get_root_uri(uri)
+        if not root_uri:
+            print "*** ERROR *** MC file %s is stored on %s, which cannot be accessed via xrootd"%(f,uri)
+            DB.close_db()
+            if not PROD_FAKE: shutil.rmtree(PROD_DIR)
+            sys.exit(2)
+        file_url = "%s%s/%s"%(root_uri,prod_dir,f)
+        file_list.append((file_url,size))
+
+    # Files already reconstructed by a successful job with the same version are not processed again
+    if not PROD_REPROCESS:
+        done = DB.get_reconstructed_inputs(PROD_RECO_VERSION,[ os.path.basename(url) for (url,size) in file_list ])
+        if done:
+            print "- Skipping %d files already reconstructed with version %s"%(len(done),PROD_RECO_VERSION)
+            file_list = [ (url,size) for (url,size) in file_list if not os.path.basename(url) in done ]
+    if not file_list:
+        print "- No files to reconstruct"
+        DB.close_db()
+        if not PROD_FAKE: shutil.rmtree(PROD_DIR)
+        sys.exit(0)
+
+    splitter = InputSplitter(PROD_FILES_PER_JOB,PROD_MB_PER_JOB*1000000,PROD_FILES_PER_JOB_MAX)
+    job_file_lists = splitter.split(file_list)
+    print "- Input split: %s"%splitter.summary()
 
     # Create new production in DB
+    PLAN.phase("DB")
     print "- Creating new production in DB"
-    prodId = DB.create_recoprod(PROD_NAME,PROD_MCPROD_NAME,PROD_DESCRIPTION,PROD_CE,PROD_RECO_VERSION,PROD_DIR,PROD_SRM,PROD_STORAGE_DIR,JOB_PROXY_FILE,len(job_file_lists))
+    PLAN.add_db_rows("production")
+    PLAN.add_db_rows("reco_prod",1,len(PROD_DESCRIPTION))
+    if PROD_FAKE:
+        prodId = 0
+    else:
+        prodId = DB.create_recoprod(PROD_NAME,PROD_MCPROD_NAME,PROD_DESCRIPTION,PROD_CE,PROD_RECO_VERSION,PROD_DIR,PROD_SRM,PROD_STORAGE_DIR,JOB_PROXY_FILE,len(job_file_lists))
 
     # Create production directory in the storage SRM
     print "- Creating dir %s in %s"%(PROD_STORAGE_DIR,PROD_SRM)
     gfal_mkdir_cmd = "gfal-mkdir -p %s%s"%(PROD_SRM,PROD_STORAGE_DIR)
-    if PROD_DEBUG: print ">",gfal_mkdir_cmd
-    rc = subprocess.call(shlex.split(gfal_mkdir_cmd))
+    rc = PLAN.run(gfal_mkdir_cmd)
 
     # Create job structures
+    PLAN.phase("Jobs")
     print "- Creating directory structure for production jobs"
+    layout = ProdLayout(PROD_DIR)
     for j in range(0,len(job_file_lists)):
 
-        jobName = "job%05d"%j
+        jobName = layout.job_name(j)
 
         # Create dir to hold individual job info
-        jobLocalDir = jobName
-        jobDir = "%s/%s"%(PROD_DIR,jobLocalDir)
+        jobLocalDir = layout.job_local_dir(j)
+        jobDir = layout.job_dir(j)
         try:
-            os.mkdir(jobDir)
+            PLAN.create_job_dir(layout,j)
         except:
             print "*** ERROR *** Unable to create job directory %s"%jobDir
             sys.exit(2)
@@ -310,53 +413,63 @@ def main(argv):
         # Copy production script to job dir
         jobScript = "%s/job.py"%jobDir
         try:
-            shutil.copyfile(PROD_SCRIPT,jobScript)
+            PLAN.copy_file(PROD_SCRIPT,jobScript)
         except:
             print "*** ERROR *** Unable to copy job script file %s to %s"%(PROD_SCRIPT,jobScript)
             sys.exit(2)
 
         # Create list with files to process
         jobListFile = "%s/job.list"%jobDir
-        with open(jobListFile,"w") as jlf:
-            for f in job_file_lists[j]: jlf.write("%s\n"%f)
+        jobList = "".join([ "%s\n"%f for f in job_file_lists[j] ])
+        PLAN.write_file(jobListFile,jobList)
 
         # Copy long-lived proxy file to job dir
         jobProxy = "%s/job.proxy"%jobDir
         try:
-            shutil.copyfile(JOB_PROXY_FILE,jobProxy)
+            PLAN.copy_file(JOB_PROXY_FILE,jobProxy,0o600)
         except:
             print "*** ERROR *** Unable to copy job proxy file %s to %s"%(JOB_PROXY_FILE,jobProxy)
             sys.exit(2)
-        try:
-            os.chmod(jobProxy,0o600)
-        except:
-            print "*** ERROR *** Unable to set access permissions of job proxy file %s"%jobProxy
-            sys.exit(2)
 
         # Create JDL file in job dir
         jobJDL = "%s/job.jdl"%jobDir
-        with open(jobJDL,"w") as jf:
-            jf.write("[\n")
-            jf.write("Type = \"Job\";\n")
-            jf.write("JobType = \"Normal\";\n")
-            jf.write("Executable = \"/usr/bin/python\";\n")
-            jf.write("Arguments = \"-u job.py job.list job.proxy %s %s %s %s %s\";\n"%(PROD_NAME,jobName,PROD_RECO_VERSION,PROD_STORAGE_DIR,PROD_SRM))
-            jf.write("StdOutput = \"job.out\";\n")
-            jf.write("StdError = \"job.err\";\n")
-            jf.write("InputSandbox = {\"job.py\",\"job.list\",\"job.proxy\"};\n")
-            jf.write("OutputSandbox = {\"job.out\", \"job.err\", \"job.sh\"};\n")
-            jf.write("OutputSandboxBaseDestURI=\"gsiftp://localhost\";\n")
-            jf.write("]\n")
+        jdl = "[\n"
+        jdl += "Type = \"Job\";\n"
+        jdl += "JobType = \"Normal\";\n"
+        jdl += "Executable = \"/usr/bin/python\";\n"
+        if PROD_NCORES > 1 or PROD_STAGE_CHUNK:
+            jdl += "Arguments = \"-u job.py job.list job.proxy %s %s %s %s %s %d %d\";\n"%(PROD_NAME,jobName,PROD_RECO_VERSION,PROD_STORAGE_DIR,PROD_SRM,PROD_NCORES,PROD_STAGE_CHUNK)
+        else:
+            jdl += "Arguments = \"-u job.py job.list job.proxy %s %s %s %s %s\";\n"%(PROD_NAME,jobName,PROD_RECO_VERSION,PROD_STORAGE_DIR,PROD_SRM)
+        if PROD_NCORES > 1:
+            jdl += "CPUNumber = %d;\n"%PROD_NCORES
+            jdl += "SMPGranularity = %d;\n"%PROD_NCORES
+        jdl += "StdOutput = \"job.out\";\n"
+        jdl += "StdError = \"job.err\";\n"
+        jdl += "InputSandbox = {\"job.py\",\"job.list\",\"job.proxy\"};\n"
+        jdl += "OutputSandbox = {\"job.out\", \"job.err\", \"job.sh\", \"program.out.gz\", \"program.err.gz\", \"job.json\"};\n"
+        jdl += "OutputSandboxBaseDestURI=\"gsiftp://localhost\";\n"
+        jdl += "]\n"
+        PLAN.write_file(jobJDL,jdl)
 
         # Create job entry in DB and register job (jobCfg and jobSeeds are only used in MC jobs)
         jobCfg = ""
-        with open(jobListFile,"r") as jlf: jobList = jlf.read()
         jobSeeds = ""
-        DB.create_job(prodId,jobName,jobLocalDir,jobCfg,jobList,jobSeeds)
+        (input_prefix,input_suffixes) = DB.compress_input_list(jobList)
+        PLAN.add_db_rows("job",1,len(jobName)+len(jobLocalDir)+len(input_prefix)+len(input_suffixes))
+        input_names = [ os.path.basename(f) for f in job_file_lists[j] ]
+        PLAN.add_db_rows("file_lineage",len(input_names),sum([ len(n)+len(PROD_RECO_VERSION) for n in input_names ]))
+        if not PROD_FAKE:
+            jobId = DB.create_job(prodId,jobName,jobLocalDir,jobCfg,jobList,jobSeeds)
+            if jobId: DB.register_lineage(jobId,PROD_RECO_VERSION,input_names,PROD_NCORES)
 
     # From now on we do not need the DB anymore: close connection
     DB.close_db()
 
+    # Show what was (or would have been) created. In FAKE mode we stop here
+    PLAN.report()
+    if PROD_FAKE: sys.exit(0)
+
     # Prepare daemon context
 
     # Assume that the current directory is the top level Production directory
@@ -0,0 +1,465 @@
+#!/usr/bin/python
+
+import os
+import sys
+import getopt
+import shutil
+import daemon
+import daemon.pidfile
+
+from PadmeProdServer import PadmeProdServer
+from PadmeMCDB import PadmeMCDB
+from ProxyHandler import ProxyHandler
+from ProdLayout import ProdLayout
+from ProdPlan import ProdPlan
+from InputSplitter import InputSplitter
+
+# Get location of padme-prod software from PADME_PROD env variable
+# Default to ./padme-prod if not set
+PADME_PROD = os.getenv('PADME_PROD',"./padme-prod")
+
+# Create global handler to PadmeMCDB
+DB = PadmeMCDB()
+
+# Create proxy handler
+PH = ProxyHandler()
+
+# ### Define PADME grid resources ###
+
+# SRMs to access PADME area on the LNF and CNAF storage systems
+PADME_SRM_URI = {
+    "LNF":   "srm://atlasse.lnf.infn.it:8446/srm/managerv2?SFN=/dpm/lnf.infn.it/home/vo.padme.org",
+    "CNAF":  "srm://storm-fe-archive.cr.cnaf.infn.it:8444/srm/managerv2?SFN=/padmeTape",
+    "CNAF2": "srm://storm-fe-archive.cr.cnaf.infn.it:8444/srm/managerv2?SFN=/padme"
+}
+
+# List of available submission sites and corresponding default CE nodes
+PADME_CE_NODE = {
+    "LNF":   "atlasce1.lnf.infn.it:8443/cream-pbs-padme_c7",
+    "SOFIA": "cream.grid.uni-sofia.bg:8443/cream-pbs-cms"
+}
+
+# Type of files merged by default for each type of source production
+MERGE_FILE_TYPE = {
+    "MC":   "MCHSTO",
+    "RECO": "RECODATA"
+}
+
+# Suffix of merged file names for each file type
+MERGE_FILE_SUFFIX = {
+    "MCHSTO":   "hsto",
+    "MCDATA":   "data",
+    "RECODATA": "reco"
+}
+
+# Initialize global parameters and set some default values
+PROD_SOURCE_NAME = ""
+PROD_NAME = ""
+PROD_FILE_TYPE = ""
+PROD_MB_PER_FILE = 2000
+PROD_FILES_PER_FILE_MAX = 1000
+PROD_STORAGE_DIR = ""
+PROD_DIR = ""
+PROD_SCRIPT = "%s/PadmeProd/script/padmemerge_prod.py"%PADME_PROD
+PROD_CE_NODE = ""
+PROD_CE_PORT = "8443"
+PROD_CE_QUEUE = ""
+PROD_RUN_SITE = "LNF"
+PROD_STORAGE_SITE = ""
+PROD_VERSION = ""
+PROD_PROXY_FILE = ""
+PROD_DEBUG = 0
+PROD_DESCRIPTION = "TEST"
+PROD_FAKE = False
+PROD_INCOMPLETE = False
+
+def print_help():
+
+    print "PadmeMergeProd -i <source_prod_name> [-t <file_type>] [-b <MB_per_file>] [-j <files_per_file>] [-v <version>] [-n <prod_name>] [-s <submission_site>] [-C <CE_node> [-P <CE_port>] -Q <CE_queue>] [-d <storage_site>] [-p <proxy>] [-D <description>] [-I] [-f] [-V] [-h]"
+    print "  -i <source_prod_name>\tname of the production whose output files will be merged"
+    print "  -t <file_type>\ttype of files to merge. Default: %s"%",".join([ "%s for %s productions"%(MERGE_FILE_TYPE[t],t) for t in sorted(MERGE_FILE_TYPE.keys()) ])
+    print "  -b <MB_per_file>\ttarget size (MB) of merged files. Files larger than half this size are not merged. Default: %d"%PROD_MB_PER_FILE
+    print "  -j <files_per_file>\tmax number of files merged into a single file. Default: %d"%PROD_FILES_PER_FILE_MAX
+    print "  -v <version>\t\tversion of the software (PadmeMC or PadmeReco) providing hadd. Default: version of source production"
+    print "  -n <prod_name>\tname for the production. Default: <source_prod_name>_merge"
+    print "  -s <submission_site>\tsite to be used for job submission. Allowed: %s. Default: %s"%(",".join(PADME_CE_NODE.keys()),PROD_RUN_SITE)
+    print "  -C <CE_node>\t\tCE node to be used for job submission. If defined, <submission_site> will not be used"
+    print "  -P <CE_port>\t\tCE port. Default: %s"%PROD_CE_PORT
+    print "  -Q <CE_queue>\t\tCE queue to use for submission. This parameter is mandatory if -C is specified"
+    print "  -d <storage_site>\tsite where the merged files will be stored. Allowed: %s. Default: same storage as source production"%",".join(PADME_SRM_URI.keys())
+    print "  -p <proxy>\t\tLong lived proxy file to use for this production. If not defined it will be created."
+    print "  -D <description>\tProduction description (to be stored in the DB). '%s' if not given."%PROD_DESCRIPTION
+    print "  -I\t\t\tmerge files of a source production which is not complete yet"
+    print "  -f\t\t\tFAKE mode: show what would be created without touching grid, storage and DB"
+    print "  -V\t\t\tenable debug mode. Can be repeated to increase verbosity"
+    print "N.B. original files are not removed: use tools/retire_merged.py once the merge production is complete"
+
+def main(argv):
+
+    # Declare that here we can possibly modify these global variables
+    global PROD_SOURCE_NAME
+    global PROD_NAME
+    global PROD_FILE_TYPE
+    global PROD_MB_PER_FILE
+    global PROD_FILES_PER_FILE_MAX
+    global PROD_STORAGE_DIR
+    global PROD_DIR
+    global PROD_SCRIPT
+    global PROD_CE_NODE
+    global PROD_CE_PORT
+    global PROD_CE_QUEUE
+    global PROD_RUN_SITE
+    global PROD_STORAGE_SITE
+    global PROD_VERSION
+    global PROD_PROXY_FILE
+    global PROD_DEBUG
+    global PROD_DESCRIPTION
+    global PROD_FAKE
+    global PROD_INCOMPLETE
+
+    try:
+        opts,args = getopt.getopt(argv,"hVi:t:b:j:v:n:s:d:C:P:Q:p:D:If",[])
+    except getopt.GetoptError as e:
+        print "Option error: %s"%str(e)
+        print_help()
+        sys.exit(2)
+
+    for opt,arg in opts:
+        if opt == '-h':
+            print_help()
+            sys.exit(0)
+        elif opt == '-V':
+            PROD_DEBUG += 1
+        elif opt == '-f':
+            PROD_FAKE = True
+        elif opt == '-I':
+            PROD_INCOMPLETE = True
+        elif opt == '-i':
+            PROD_SOURCE_NAME = arg
+        elif opt == '-t':
+            PROD_FILE_TYPE = arg
+        elif opt == '-v':
+            PROD_VERSION = arg
+        elif opt == '-n':
+            PROD_NAME = arg
+        elif opt == '-C':
+            PROD_CE_NODE = arg
+        elif opt == '-P':
+            PROD_CE_PORT = arg
+        elif opt == '-Q':
+            PROD_CE_QUEUE = arg
+        elif opt == '-p':
+            PROD_PROXY_FILE = arg
+        elif opt == '-D':
+            PROD_DESCRIPTION = arg
+        elif opt == '-s':
+            if arg in PADME_CE_NODE.keys():
+                PROD_RUN_SITE = arg
+            else:
+                print "*** ERROR *** Invalid submission site %s. Valid: %s"%(arg,",".join(PADME_CE_NODE.keys()))
+                print_help()
+                sys.exit(2)
+        elif opt == '-d':
+            if arg in PADME_SRM_URI.keys():
+                PROD_STORAGE_SITE = arg
+            else:
+                print "*** ERROR *** Invalid storage site %s. Valid: %s"%(arg,",".join(PADME_SRM_URI.keys()))
+                print_help()
+                sys.exit(2)
+        elif opt == '-b':
+            try:
+                PROD_MB_PER_FILE = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid size of merged files: '%s'"%arg
+                print_help()
+                sys.exit(2)
+            if PROD_MB_PER_FILE <= 0:
+                print "*** ERROR *** Invalid size of merged files: %d"%PROD_MB_PER_FILE
+                print_help()
+                sys.exit(2)
+        elif opt == '-j':
+            try:
+                PROD_FILES_PER_FILE_MAX = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid number of files per merged file: '%s'"%arg
+                print_help()
+                sys.exit(2)
+            if PROD_FILES_PER_FILE_MAX < 2:
+                print "*** ERROR *** Invalid number of files per merged file: %d"%PROD_FILES_PER_FILE_MAX
+                print_help()
+                sys.exit(2)
+
+    if not PROD_SOURCE_NAME:
+        print "*** ERROR *** No source production name specified."
+        print_help()
+        sys.exit(2)
+
+    # All actions creating the production go through the planner (only recorded in FAKE mode)
+    PLAN = ProdPlan(PROD_FAKE,PROD_DEBUG)
+    PLAN.phase("Checks")
+
+    # Check if source production exists and get its type, software version and storage
+    if not DB.is_prod_in_db(PROD_SOURCE_NAME):
+        print "*** ERROR *** Source production '%s' not found in DB"%PROD_SOURCE_NAME
+        sys.exit(2)
+    source_id = DB.get_prod_id(PROD_SOURCE_NAME)
+    source_type = DB.get_prod_type(source_id)
+    source_version = DB.get_prod_version(source_id)
+    if not source_type in MERGE_FILE_TYPE or source_version == None:
+        print "*** ERROR *** Source production '%s' is not a MC or reconstruction production"%PROD_SOURCE_NAME
+        sys.exit(2)
+    (source_uri,source_dir) = DB.get_prod_storage(source_id)
+
+    # Files are merged only when the source production is complete, unless explicitly requested
+    if not PROD_INCOMPLETE and not DB.is_prod_complete(source_id):
+        print "*** ERROR *** Source production '%s' is not complete yet. Use -I to merge its files anyway"%PROD_SOURCE_NAME
+        sys.exit(2)
+
+    if not PROD_FILE_TYPE: PROD_FILE_TYPE = MERGE_FILE_TYPE[source_type]
+    if not PROD_FILE_TYPE in MERGE_FILE_SUFFIX:
+        print "*** ERROR *** Invalid file type %s. Valid: %s"%(PROD_FILE_TYPE,",".join(sorted(MERGE_FILE_SUFFIX.keys())))
+        print_help()
+        sys.exit(2)
+
+    # hadd is taken from the software used by the source production, unless a different version is given
+    (program,version) = source_version
+    if not PROD_VERSION: PROD_VERSION = version
+
+    # Choose submission CE
+    if PROD_CE_NODE:
+        # If CE was explicitly defined, use it
+        if not PROD_CE_QUEUE:
+            print "*** ERROR *** No queue specified for CE %s"%PROD_CE_NODE
+            print_help()
+            sys.exit(2)
+        PROD_CE = "%s:%s/%s"%(PROD_CE_NODE,PROD_CE_PORT,PROD_CE_QUEUE)
+    else:
+        # If CE was not defined, get it from submission site
+        PROD_CE = PADME_CE_NODE[PROD_RUN_SITE]
+
+    # Merged files are stored with the source files unless a different storage site is given
+    if PROD_STORAGE_SITE:
+        PROD_SRM = PADME_SRM_URI[PROD_STORAGE_SITE]
+    else:
+        PROD_SRM = source_uri
+
+    # If production name was not specified, use the standard name (<source_prod_name>_merge)
+    if PROD_NAME == "":
+        PROD_NAME = "%s_merge"%PROD_SOURCE_NAME
+        if PROD_DEBUG: print "No Production Name specified: using %s"%PROD_NAME
+
+    # If storage directory was not specified, use default
+    if PROD_STORAGE_DIR == "":
+        PROD_STORAGE_DIR = "%s/merged"%source_dir
+
+    # If production directory was not specified, use default
+    if PROD_DIR == "":
+        version_dir = "prod/%s"%PROD_VERSION
+        if not os.path.exists(version_dir):
+            PLAN.mkdir(version_dir)
+        elif not os.path.isdir(version_dir):
+            print "*** ERROR *** '%s' exists but is not a directory"%version_dir
+            sys.exit(2)
+        PROD_DIR = "%s/%s"%(version_dir,PROD_NAME)
+
+    # Show info about required production
+    print "- Starting production %s"%PROD_NAME
+    print "- Merging %s files of %s production %s"%(PROD_FILE_TYPE,source_type,PROD_SOURCE_NAME)
+    print "- Target size of merged files: %d MB (max %d files each)"%(PROD_MB_PER_FILE,PROD_FILES_PER_FILE_MAX)
+    print "- hadd from %s version %s"%(program,PROD_VERSION)
+    print "- Submitting jobs to CE %s"%PROD_CE
+    print "- Main production directory: %s"%PROD_DIR
+    print "- Production script: %s"%PROD_SCRIPT
+    print "- Storage SRM: %s"%PROD_SRM
+    print "- Storage directory: %s"%PROD_STORAGE_DIR
+    if PROD_FAKE:
+        print "- FAKE mode: nothing will be created"
+    if PROD_DEBUG:
+        print "- Debug level: %d"%PROD_DEBUG
+        PH.debug = PROD_DEBUG
+
+    # Check if production dir already exists
+    if os.path.exists(PROD_DIR):
+        print "*** ERROR *** Path %s already exists"%PROD_DIR
+        sys.exit(2)
+
+    # Check if production already exists in DB
+    if (DB.is_prod_in_db(PROD_NAME)):
+        print "*** ERROR *** A production named '%s' already exists in DB"%PROD_NAME
+        sys.exit(2)
+
+    # Get list of files to merge
+    PLAN.phase("Input split")
+    # Files which are already large enough or which were already merged by a successful job are left as they are
+    target_size = PROD_MB_PER_FILE*1000000
+    file_list = []
+    n_large = 0
+    for (f,size,checksum,uri) in DB.iter_prod_files(PROD_SOURCE_NAME,PROD_FILE_TYPE):
+        if size and size > target_size/2:
+            n_large += 1
+            continue
+        file_list.append(("%s%s/%s"%(uri,source_dir,f),size))
+    if n_large: print "- Skipping %d files larger than %d MB"%(n_large,PROD_MB_PER_FILE/2)
+    done = DB.get_merged_inputs([ os.path.basename(url) for (url,size) in file_list ])
+    if done:
+        print "- Skipping %d files already merged"%len(done)
+        file_list = [ (url,size) for (url,size) in file_list if not os.path.basename(url) in done ]
+
+    # Files are grouped in name order into merged files of similar size. Groups with a single file are not merged
+    splitter = InputSplitter(PROD_FILES_PER_FILE_MAX,target_size,PROD_FILES_PER_FILE_MAX)
+    job_file_lists = [ job_files for job_files in splitter.split(file_list) if len(job_files) > 1 ]
+    if not job_file_lists:
+        print "- No files to merge"
+        DB.close_db()
+        sys.exit(0)
+    print "- Input split: %s"%splitter.summary()
+    print "- Merging %d files into %d files"%(sum([ len(job_files) for job_files in job_file_lists ]),len(job_file_lists))
+
+    # Create production directory to host support dirs for all jobs
+    PLAN.phase("Setup")
+    print "- Creating production dir %s"%PROD_DIR
+    PLAN.mkdir(PROD_DIR)
+
+    # Check if long-lived (30 days) proxy was defined. Create it if not
+    JOB_PROXY_FILE = "%s/%s.proxy"%(PROD_DIR,PROD_NAME)
+    if PROD_PROXY_FILE:
+        if os.path.isfile(PROD_PROXY_FILE):
+            try:
+                PLAN.copy_file(PROD_PROXY_FILE,JOB_PROXY_FILE,0o600)
+            except:
+                print "*** ERROR *** Unable to copy long-lived proxy file %s to %s"%(PROD_PROXY_FILE,JOB_PROXY_FILE)
+                shutil.rmtree(PROD_DIR)
+                sys.exit(2)
+        else:
+            print "*** ERROR *** Long-lived proxy file %s was not found"%PROD_PROXY_FILE
+            shutil.rmtree(PROD_DIR)
+            sys.exit(2)
+    else:
+        print "- Creating long-lived proxy file %s"%JOB_PROXY_FILE
+        proxy_cmd = "voms-proxy-init --valid 720:0 --out %s"%JOB_PROXY_FILE
+        if PLAN.run(proxy_cmd):
+            print "*** ERROR *** while generating long-lived proxy file %s"%JOB_PROXY_FILE
+            shutil.rmtree(PROD_DIR)
+            sys.exit(2)
+
+    # Check if VOMS proxy exists and is valid. Renew it if not.
+    # This is needed to create the storage dir on the SRM server
+    # In FAKE mode the current VOMS proxy of the user is used
+    if not PROD_FAKE: PH.renew_voms_proxy(JOB_PROXY_FILE)
+
+    # Create new production in DB
+    PLAN.phase("DB")
+    print "- Creating new production in DB"
+    PLAN.add_db_rows("production")
+    PLAN.add_db_rows("merge_prod",1,len(PROD_DESCRIPTION))
+    if PROD_FAKE:
+        prodId = 0
+    else:
+        prodId = DB.create_mergeprod(PROD_NAME,source_id,PROD_DESCRIPTION,PROD_FILE_TYPE,target_size,PROD_CE,PROD_DIR,PROD_SRM,PROD_STORAGE_DIR,JOB_PROXY_FILE,len(job_file_lists))
+
+    # Create production directory in the storage SRM
+    print "- Creating dir %s in %s"%(PROD_STORAGE_DIR,PROD_SRM)
+    gfal_mkdir_cmd = "gfal-mkdir -p %s%s"%(PROD_SRM,PROD_STORAGE_DIR)
+    rc = PLAN.run(gfal_mkdir_cmd)
+
+    # Create job structures
+    PLAN.phase("Jobs")
+    print "- Creating directory structure for production jobs"
+    layout = ProdLayout(PROD_DIR)
+    for j in range(0,len(job_file_lists)):
+
+        jobName = layout.job_name(j)
+
+        # Create dir to hold individual job info
+        jobLocalDir = layout.job_local_dir(j)
+        jobDir = layout.job_dir(j)
+        try:
+            PLAN.create_job_dir(layout,j)
+        except:
+            print "*** ERROR *** Unable to create job directory %s"%jobDir
+            sys.exit(2)
+
+        # Copy production script to job dir
+        jobScript = "%s/job.py"%jobDir
+        try:
+            PLAN.copy_file(PROD_SCRIPT,jobScript)
+        except:
+            print "*** ERROR *** Unable to copy job script file %s to %s"%(PROD_SCRIPT,jobScript)
+            sys.exit(2)
+
+        # Create list with files to merge
+        jobListFile = "%s/job.list"%jobDir
+        jobList = "".join([ "%s\n"%f for f in job_file_lists[j] ])
+        PLAN.write_file(jobListFile,jobList)
+
+        # Copy long-lived proxy file to job dir
+        jobProxy = "%s/job.proxy"%jobDir
+        try:
+            PLAN.copy_file(JOB_PROXY_FILE,jobProxy,0o600)
+        except:
+            print "*** ERROR *** Unable to copy job proxy file %s to %s"%(JOB_PROXY_FILE,jobProxy)
+            sys.exit(2)
+
+        # Each job produces one merged file
+        mergedFile = "%s_%s_%s.root"%(PROD_NAME,jobName,MERGE_FILE_SUFFIX[PROD_FILE_TYPE])
+
+        # Create JDL file in job dir
+        jobJDL = "%s/job.jdl"%jobDir
+        jdl = "[\n"
+        jdl += "Type = \"Job\";\n"
+        jdl += "JobType = \"Normal\";\n"
+        jdl += "Executable = \"/usr/bin/python\";\n"
+        jdl += "Arguments = \"-u job.py job.list job.proxy %s %s %s %s %s %s %s %s\";\n"%(PROD_NAME,jobName,program,PROD_VERSION,PROD_STORAGE_DIR,PROD_SRM,PROD_FILE_TYPE,mergedFile)
+        jdl += "StdOutput = \"job.out\";\n"
+        jdl += "StdError = \"job.err\";\n"
+        jdl += "InputSandbox = {\"job.py\",\"job.list\",\"job.proxy\"};\n"
+        jdl += "OutputSandbox = {\"job.out\", \"job.err\", \"job.sh\", \"program.out.gz\", \"program.err.gz\", \"job.json\"};\n"
+        jdl += "OutputSandboxBaseDestURI=\"gsiftp://localhost\";\n"
+        jdl += "]\n"
+        PLAN.write_file(jobJDL,jdl)
+
+        # Create job entry in DB and register job with the lineage of the merged file (jobCfg and jobSeeds are only used in MC jobs)
+        jobCfg = ""
+        jobSeeds = ""
+        (input_prefix,input_suffixes) = DB.compress_input_list(jobList)
+        PLAN.add_db_rows("job",1,len(jobName)+len(jobLocalDir)+len(input_prefix)+len(input_suffixes))
+        input_names = [ os.path.basename(f) for f in job_file_lists[j] ]
+        PLAN.add_db_rows("file_lineage",len(input_names),sum([ len(n)+len("MERGE") for n in input_names ]))
+        if not PROD_FAKE:
+            jobId = DB.create_job(prodId,jobName,jobLocalDir,jobCfg,jobList,jobSeeds)
+            if jobId: DB.register_lineage(jobId,None,input_names,kind="MERGE")
+
+    # From now on we do not need the DB anymore: close connection
+    DB.close_db()
+
+    # Show what was (or would have been) created. In FAKE mode we stop here
+    PLAN.report()
+    if PROD_FAKE: sys.exit(0)
+
+    # Prepare daemon context
+
+    # Assume that the current directory is the top level Production directory
+    top_prod_dir = os.getcwd()
+    print "Production top working dir: %s"%top_prod_dir
+
+    # Lock file with daemon pid is located inside the production directory
+    prod_lock = "%s/%s/%s.pid"%(top_prod_dir,PROD_DIR,PROD_NAME)
+    print "Production lock file: %s"%prod_lock
+
+    # Redirect stdout and stderr to log/err files inside the production directory
+    prod_log_file = "%s/%s/%s.log"%(top_prod_dir,PROD_DIR,PROD_NAME)
+    prod_err_file = "%s/%s/%s.err"%(top_prod_dir,PROD_DIR,PROD_NAME)
+    print "Production log file: %s"%prod_log_file
+    print "Production err file: %s"%prod_err_file
+
+    # Start Padme Production Server as a daemon
+    context = daemon.DaemonContext()
+    context.working_directory = top_prod_dir
+    context.umask = 0o002
+    context.pidfile = daemon.pidfile.PIDLockFile(prod_lock)
+    context.open()
+    PadmeProdServer(PROD_NAME,PROD_DEBUG)
+    context.close()
+
+# Execution starts here
+if __name__ == "__main__": main(sys.argv[1:])
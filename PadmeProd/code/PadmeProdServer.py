@@ -7,11 +7,13 @@ import subprocess
 import re
 import shlex
 import random
+import resource
 
 from PadmeMCDB import PadmeMCDB
 from Logger import Logger
 from ProxyHandler import ProxyHandler
 from ProdJob import ProdJob
+from ProdLayout import ProdLayout
 
 class PadmeProdServer:
 
@@ -83,18 +85,37 @@ class PadmeProdServer:
         # Define name of control file: if found, this production will cleanly quit
         quit_file = "%s/quit"%prod_dir
 
-        # Get list of job ids for this production
-        job_id_list = self.db.get_job_list(self.prod_id)
-        if len(job_id_list) != prod_njobs:
-            print "*** ERROR *** Number of jobs in DB and in production are different: %s != %s"%(len(job_id_list),prod_njobs)
+        # Define name of control file: if found, jobs appended to this production in the DB will be added to it
+        append_file = "%s/append"%prod_dir
+
+        # Get id, name and directory of all jobs of this production with a single DB query
+        job_info_list = self.db.get_job_list_info(self.prod_id)
+        if len(job_info_list) != prod_njobs:
+            print "*** ERROR *** Number of jobs in DB and in production are different: %s != %s"%(len(job_info_list),prod_njobs)
             sys.exit(1)
 
+        # Verify that all job directories exist
+        layout = ProdLayout(prod_dir)
+        job_dir_set = set()
+        for (job_name,job_local_dir) in layout.list_job_dirs(): job_dir_set.add(job_local_dir)
+        for (job_id,job_name,job_local_dir,job_status) in job_info_list:
+            if not job_local_dir in job_dir_set:
+                print "*** ERROR *** Directory '%s' of job %s not found in production directory '%s'"%(job_local_dir,job_name,prod_dir)
+                sys.exit(1)
+        job_dir_set = None
+
+        # For very large productions do not report jobs in a final state at each iteration
+        self.report_final = True
+        if prod_njobs > ProdLayout.JOBS_PER_SHARD: self.report_final = False
+
         # All checks are good: ready to start real production activities
         print "=== Starting Production %s ==="%self.prod_name
 
         # Create and configure job handlers
-        for job_id in job_id_list:
-            self.job_list.append(ProdJob(job_id,prod_ce,self.db,self.delegation_id,self.debug))
+        for job_info in job_info_list: self.add_job(job_info,prod_ce,prod_dir)
+
+        # All jobs in the DB were just added: a pending append request is already satisfied
+        if os.path.exists(append_file): os.remove(append_file)
     
         # Define absolute path of VOMS proxy file which will be used for this production and pass it to the proxy handler
         voms_proxy = "%s/%s/%s.voms"%(os.getcwd(),prod_dir,self.prod_name)
@@ -126,7 +147,14 @@ class PadmeProdServer:
                 print "*** Quit file %s found: quitting production ***"%quit_file
                 self.quit_production()
 
+            # Check append control file and add to the production all jobs appended to it in the DB
+            if os.path.exists(append_file):
+                print "*** Append file %s found: adding new jobs to production ***"%append_file
+                os.remove(append_file)
+                self.append_jobs(prod_ce,prod_dir)
+
             # Call method to check jobs status and handle each job accordingly
+            cycle_start = time.time()
             (jobs_created,jobs_active,jobs_success,jobs_fail,jobs_undef) = self.handle_jobs()
 
             # Update database if any new job reached final state
@@ -139,8 +167,12 @@ class PadmeProdServer:
             # Show current production state
             print "Jobs: unsubmitted %d active %d success %d fail %d undef %d"%(jobs_created,jobs_active,jobs_success,jobs_fail,jobs_undef)
 
+            # Show duration of this iteration and memory used by the daemon (ru_maxrss is in kB)
+            print "Iteration time %.1f s - Max memory %.1f MB"%(time.time()-cycle_start,resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.)
+
             # If all jobs are in a final state (either success or fail), production is over
-            if jobs_created+jobs_active+jobs_undef == 0:
+            # unless new jobs were appended to it in the meantime
+            if jobs_created+jobs_active+jobs_undef == 0 and not os.path.exists(append_file):
                 print "--- No unfinished jobs left: production is done ---"
                 break
 
@@ -163,7 +195,7 @@ class PadmeProdServer:
     
         # Production is over: get total events, tag production as done and say bye bye
         n_events = self.db.get_prod_total_events(self.prod_id)
-        print "- Jobs submitted: %d - Jobs successful: %d - Jobs failed: %d - Total events: %d"%(prod_njobs,jobs_success,jobs_fail,n_events)
+        print "- Jobs submitted: %d - Jobs successful: %d - Jobs failed: %d - Total events: %d"%(len(self.job_list),jobs_success,jobs_fail,n_events)
         self.db.close_prod(self.prod_id,jobs_success,jobs_fail,n_events)
     
         # Release DB connection before exiting
@@ -172,6 +204,49 @@ class PadmeProdServer:
         print "=== Ending Production %s ==="%self.prod_name
         sys.exit(0)
     
+    def add_job(self,job_info,prod_ce,prod_dir):
+
+        (job_id,job_name,job_local_dir,job_status) = job_info
+        job = ProdJob(job_id,prod_ce,self.db,self.delegation_id,self.debug,job_name,"%s/%s"%(prod_dir,job_local_dir))
+        job.report_final = self.report_final
+
+        # Jobs which reached a final state in a previous run of the production daemon are not resubmitted
+        if job_status == 2 or job_status == 3:
+            job.job_status = job_status
+            if job_status == 2:
+                job.final_report = "- %-8s %-60s %s"%(job_name,"PREVIOUS-RUN","DONE_OK")
+            else:
+                job.final_report = "- %-8s %-60s %s"%(job_name,"PREVIOUS-RUN","FAILED")
+
+        # Jobs which were active in a previous run of the production daemon can still be running on the CE:
+        # reattach them to their last submission instead of submitting them again, unless it was already closed
+        if job_status == 1:
+            last_submit = self.db.get_last_job_submit(job_id)
+            if last_submit:
+                (job_sub_id,submit_index,job_sub_status,ce_job_id) = last_submit
+                if ce_job_id and (1 <= job_sub_status <= 6 or job_sub_status in (11,12)):
+                    job.job_status = 1
+                    job.job_sub_id = job_sub_id
+                    job.ce_job_id = ce_job_id
+                    job.resubmissions = submit_index+1
+                    if self.debug: print "Job %s reattached to CE job %s"%(job_name,ce_job_id)
+
+        self.job_list.append(job)
+
+    def append_jobs(self,prod_ce,prod_dir):
+
+        # Add to the production all jobs found in the DB which are not handled yet
+        known_jobs = set([ job.job_id for job in self.job_list ])
+        n_appended = 0
+        for job_info in self.db.get_job_list_info(self.prod_id):
+            if job_info[0] in known_jobs: continue
+            if not os.path.isdir("%s/%s"%(prod_dir,job_info[2])):
+                print "*** ERROR *** Directory '%s' of appended job %s not found: job ignored"%(job_info[2],job_info[1])
+                continue
+            self.add_job(job_info,prod_ce,prod_dir)
+            n_appended += 1
+        print "--- %d jobs appended to production. Total jobs: %d ---"%(n_appended,len(self.job_list))
+
     def handle_jobs(self):
     
         jobs_created = 0
@@ -8,12 +8,18 @@ import subprocess
 import shutil
 import shlex
 import re
+import errno
 import daemon
 import daemon.pidfile
 
 from PadmeProdServer import PadmeProdServer
 from PadmeMCDB import PadmeMCDB
 from ProxyHandler import ProxyHandler
+from ProdLayout import ProdLayout
+from ProdPlan import ProdPlan
+from InputSplitter import InputSplitter
+from ListingCache import ListingCache
+from RunSites import RunSites
 
 # Get location of padme-prod software from PADME_PROD env variable
 # Default to ./padme-prod if not set
@@ -25,6 +31,9 @@ DB = PadmeMCDB()
 # Create proxy handler
 PH = ProxyHandler()
 
+# Create handler to local cache of storage listings
+LC = ListingCache()
+
 # ### Define PADME grid resources ###
 
 # SRMs to access PADME area on the LNF and CNAF storage systems
@@ -33,21 +42,30 @@ PADME_SRM_URI = {
     "CNAF": "srm://storm-fe-archive.cr.cnaf.infn.it:8444/srm/managerv2?SFN=/padmeTape"
 }
 
+# xrootd URIs used by jobs to read rawdata files from the LNF and CNAF storage systems
 PADME_ROOT_URI = {
-    "LNF": "root://atlasse.lnf.infn.it:1094//dpm/lnf.infn.it/home/vo.padme.org"
+    "LNF":  "root://atlasse.lnf.infn.it:1094//dpm/lnf.infn.it/home/vo.padme.org",
+    "CNAF": "root://xrootd-padme.cr.cnaf.infn.it:1094//padmeTape"
 }
 
+# Storage sites which can hold replicas of rawdata files, in order of preference for remote reads
+PADME_REPLICA_SITES = [ "LNF","CNAF" ]
+
 # List of available submission sites and corresponding default CE nodes
 PADME_CE_NODE = {
     "LNF":   "atlasce1.lnf.infn.it:8443/cream-pbs-padme_c7",
     "SOFIA": "cream.grid.uni-sofia.bg:8443/cream-pbs-cms"
 }
 
+# Submission site to use if no site holds a replica of the run on its local storage
+PROD_RUN_SITE_DEFAULT = "LNF"
+
 # Initialize global parameters and set some default values
 PROD_RUN_NAME = ""
 PROD_NAME = ""
 PROD_FILES_PER_JOB = 100
 PROD_FILES_PER_JOB_MAX = 1000
+PROD_MB_PER_JOB = 0
 PROD_STORAGE_DIR = ""
 PROD_DIR = ""
 PROD_SCRIPT = "%s/PadmeProd/script/padmereco_prod.py"%PADME_PROD
@@ -55,23 +73,30 @@ PROD_SOURCE_URI = PADME_SRM_URI["LNF"]
 PROD_CE_NODE = ""
 PROD_CE_PORT = "8443"
 PROD_CE_QUEUE = ""
-PROD_RUN_SITE = "LNF"
+PROD_RUN_SITE = ""
 PROD_STORAGE_SITE = "LNF"
 PROD_RECO_VERSION = ""
 PROD_PROXY_FILE = ""
 PROD_YEAR = ""
 PROD_DEBUG = 0
 PROD_DESCRIPTION = "TEST"
+PROD_FAKE = False
+PROD_APPEND = False
+PROD_REPROCESS = False
+PROD_NCORES = 1
+PROD_NCORES_MAX = 64
+PROD_STAGE_CHUNK = 0
 
 def print_help():
 
-    print "PadmeRecoProd -r <run_name> -v <version> [-y <year>] [-j <files_per_job>] [-n <prod_name>] [-s <submission_site>] [-C <CE_node> [-P <CE_port>] -Q <CE_queue>] [-d <storage_site>] [-p <proxy>] [-D <description>] [-V] [-h]"
+    print "PadmeRecoProd -r <run_name> -v <version> [-y <year>] [-j <files_per_job>] [-b <MB_per_job>] [-n <prod_name>] [-s <submission_site>] [-C <CE_node> [-P <CE_port>] -Q <CE_queue>] [-d <storage_site>] [-p <proxy>] [-D <description>] [-a] [-R] [-c <cores>] [-k <files>] [-f] [-V] [-h]"
     print "  -r <run_name>\t\tname of the run to process"
     print "  -v <version>\t\tversion of PadmeReco to use for production. Must be installed on CVMFS."
     print "  -y <year>\t\tyear of run. N.B. used only if run name is not self-documenting"
     print "  -n <prod_name>\tname for the production. Default: <run_name>_<version>"
-    print "  -j <files_per_job>\tnumber of rawdata files to be reconstructed by each job. Default: %d"%PROD_FILES_PER_JOB
-    print "  -s <submission_site>\tsite to be used for job submission. Allowed: %s. Default: %s"%(",".join(PADME_CE_NODE.keys()),PROD_RUN_SITE)
+    print "  -j <files_per_job>\tnumber of rawdata files to be reconstructed by each job (on average: jobs are balanced by size). Default: %d"%PROD_FILES_PER_JOB
+    print "  -b <MB_per_job>\tamount of data (MB) to be reconstructed by each job. If given, -j is ignored. Default: split by number of files"
+    print "  -s <submission_site>\tsite to be used for job submission. Allowed: %s. Default: site holding most of the run data on its local storage (%s if none)"%(",".join(PADME_CE_NODE.keys()),PROD_RUN_SITE_DEFAULT)
     print "  -S <source_uri>\tURI to use to get list of files to process"
     print "  -C <CE_node>\t\tCE node to be used for job submission. If defined, <submission_site> will not be used"
     print "  -P <CE_port>\t\tCE port. Default: %s"%PROD_CE_PORT
@@ -79,6 +104,11 @@ def print_help():
     print "  -d <storage_site>\tsite where the jobs output will be stored. Allowed: %s. Default: %s"%(",".join(PADME_SRM_URI.keys()),PROD_STORAGE_SITE)
     print "  -p <proxy>\t\tLong lived proxy file to use for this production. If not defined it will be created."
     print "  -D <description>\tProduction description (to be stored in the DB). '%s' if not given."%PROD_DESCRIPTION
+    print "  -a\t\t\tAPPEND mode: add jobs for the files of the run not yet assigned to existing production <prod_name>. Run, version, CE and storage site must match those of the production"
+    print "  -R\t\t\treconstruct also files already reconstructed by a successful job with the same version"
+    print "  -c <cores>\t\tnumber of cores requested by each job, which splits its input files among <cores> PadmeReco instances. Must be >0 and <=%d. Default: %d"%(PROD_NCORES_MAX,PROD_NCORES)
+    print "  -k <files>\t\tstage input files to local disk in chunks of <files> files while PadmeReco processes the previous chunk. Default: read input files remotely"
+    print "  -f\t\t\tFAKE mode: show what would be created without touching grid, storage and DB"
     print "  -V\t\t\tenable debug mode. Can be repeated to increase verbosity"
 
 def execute_command(command):
@@ -95,40 +125,38 @@ def rawfile_sort_key(f):
         return index
     return 0
 
-def get_run_file_list(run):
+def get_run_file_list(run,refresh=False):
 
-    run_file_list = []
-    run_dir = "%s/daq/%s/rawdata/%s"%(PROD_SOURCE_URI,PROD_YEAR,run)
+    # Return list of (file_name,size) for all files in run. Size is None if it could not be parsed
+    # Listing is taken from the local listing cache when still valid, unless a refresh is requested
+    run_dir = "/daq/%s/rawdata/%s"%(PROD_YEAR,run)
+    listing = LC.list(PROD_SOURCE_URI,run_dir,refresh)
+    if listing == None: return []
 
-    tries = 0
-    cmd = "gfal-ls %s"%run_dir
-    while True:
-        (rc,out,err) = execute_command(cmd)
-        if rc == 0:
-            for line in iter(out.splitlines()):
-                if PROD_DEBUG >= 2: print line
-                run_file_list.append(line)
-            break
-        else:
-            print "WARNING gfal-ls returned error status %d while retrieving file list from run dir %s"%(rc,run_dir)
-            if PROD_DEBUG:
-                print "- STDOUT -\n%s"%out
-                print "- STDERR -\n%s"%err
-            tries += 1
-            if tries >= 3:
-                print "*** ERROR *** Could not retrieve list of files in %s. Tried %d times."%(run_dir,tries)
-                break
-            time.sleep(5)
-
-    run_file_list.sort(key=rawfile_sort_key)
+    run_file_list = [ (name,size) for (name,size,mtime,is_dir) in listing if not is_dir ]
+    run_file_list.sort(key=lambda f: rawfile_sort_key(f[0]))
     return run_file_list
 
+def prod_daemon_running(prod_lock):
+
+    # Check if the production daemon holding the lock file is alive
+    if not os.path.exists(prod_lock): return False
+    try:
+        with open(prod_lock,"r") as lf: pid = int(lf.read().strip())
+        os.kill(pid,0)
+    except (IOError,ValueError):
+        return False
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
 def main(argv):
 
     # Declare that here we can possibly modify these global variables
     global PROD_RUN_NAME
     global PROD_NAME
     global PROD_FILES_PER_JOB
+    global PROD_MB_PER_JOB
     global PROD_STORAGE_DIR
     global PROD_DIR
     global PROD_SCRIPT
@@ -143,9 +171,14 @@ def main(argv):
     global PROD_YEAR
     global PROD_DEBUG
     global PROD_DESCRIPTION
+    global PROD_FAKE
+    global PROD_NCORES
+    global PROD_STAGE_CHUNK
+    global PROD_APPEND
+    global PROD_REPROCESS
 
     try:
-        opts,args = getopt.getopt(argv,"hVr:y:n:j:s:d:S:C:P:Q:v:p:D:",[])
+        opts,args = getopt.getopt(argv,"hVr:y:n:j:b:s:d:S:C:P:Q:v:p:D:aRc:k:f",[])
     except getopt.GetoptError as e:
         print "Option error: %s"%str(e)
         print_help()
@@ -157,6 +190,12 @@ def main(argv):
             sys.exit(0)
         elif opt == '-V':
             PROD_DEBUG += 1
+        elif opt == '-f':
+            PROD_FAKE = True
+        elif opt == '-a':
+            PROD_APPEND = True
+        elif opt == '-R':
+            PROD_REPROCESS = True
         elif opt == '-r':
             PROD_RUN_NAME = arg
         elif opt == '-y':
@@ -191,6 +230,17 @@ def main(argv):
                 print "*** ERROR *** Invalid storage site %s. Valid: %s"%(arg,",".join(PADME_SRM_URI.keys()))
                 print_help()
                 sys.exit(2)
+        elif opt == '-b':
+            try:
+                PROD_MB_PER_JOB = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid amount of data per job: '%s'"%arg
+                print_help()
+                sys.exit(2)
+            if PROD_MB_PER_JOB < 0:
+                print "*** ERROR *** Invalid amount of data per job: %d"%PROD_MB_PER_JOB
+                print_help()
+                sys.exit(2)
         elif opt == '-j':
             try:
                 PROD_FILES_PER_JOB = int(arg)
@@ -198,12 +248,30 @@ def main(argv):
                 print "*** ERROR *** Invalid number of files per job: '%s'"%arg
                 print_help()
                 sys.exit(2)
+        elif opt == '-c':
+            try:
+                PROD_NCORES = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid number of cores: '%s'"%arg
+                print_help()
+                sys.exit(2)
+        elif opt == '-k':
+            try:
+                PROD_STAGE_CHUNK = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid number of files per staging chunk: '%s'"%arg
+                print_help()
+                sys.exit(2)
 
     if not PROD_RUN_NAME:
         print "*** ERROR *** No run name specified."
         print_help()
         sys.exit(2)
 
+    # All actions creating the production go through the planner (only recorded in FAKE mode)
+    PLAN = ProdPlan(PROD_FAKE,PROD_DEBUG)
+    PLAN.phase("Checks")
+
     if not PROD_RECO_VERSION:
         print "*** ERROR *** No software version specified."
         print_help()
@@ -217,9 +285,12 @@ def main(argv):
             print_help()
             sys.exit(2)
         PROD_CE = "%s:%s/%s"%(PROD_CE_NODE,PROD_CE_PORT,PROD_CE_QUEUE)
-    else:
+    elif PROD_RUN_SITE:
         # If CE was not defined, get it from submission site
         PROD_CE = PADME_CE_NODE[PROD_RUN_SITE]
+    else:
+        # If neither was defined, CE will be chosen according to location of input files
+        PROD_CE = ""
 
     # Define storage SRM URI according to chosen storage site (will add more options)
     PROD_SRM = PADME_SRM_URI[PROD_STORAGE_SITE]
@@ -236,11 +307,21 @@ def main(argv):
             print_help()
             sys.exit(2)
 
-    if PROD_FILES_PER_JOB < 0 or PROD_FILES_PER_JOB > PROD_FILES_PER_JOB_MAX:
+    if PROD_FILES_PER_JOB < 1 or PROD_FILES_PER_JOB > PROD_FILES_PER_JOB_MAX:
         print "*** ERROR *** Invalid number of files per job requested: %d - Max allowed: %d."%(PROD_FILES_PER_JOB,PROD_FILES_PER_JOB_MAX)
         print_help()
         sys.exit(2)
 
+    if PROD_NCORES < 1 or PROD_NCORES > PROD_NCORES_MAX:
+        print "*** ERROR *** Invalid number of cores per job requested: %d - Max allowed: %d."%(PROD_NCORES,PROD_NCORES_MAX)
+        print_help()
+        sys.exit(2)
+
+    if PROD_STAGE_CHUNK < 0:
+        print "*** ERROR *** Invalid number of files per staging chunk requested: %d"%PROD_STAGE_CHUNK
+        print_help()
+        sys.exit(2)
+
     if PROD_NAME == "":
         PROD_NAME = "%s_%s"%(PROD_RUN_NAME,PROD_RECO_VERSION)
         if PROD_DEBUG: print "No Production Name specified: using %s"%PROD_NAME
@@ -253,107 +334,210 @@ def main(argv):
     if PROD_DIR == "":
         version_dir = "prod/%s"%PROD_RECO_VERSION
         if not os.path.exists(version_dir):
-            os.mkdir(version_dir)
+            # Productions created in parallel (e.g. by PadmeRecoSubmit) can create this directory at the same time
+            try:
+                PLAN.mkdir(version_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST: raise
         elif not os.path.isdir(version_dir):
             print "*** ERROR *** '%s' exists but is not a directory"%version_dir
             sys.exit(2)
         PROD_DIR = "%s/%s"%(version_dir,PROD_NAME)
 
+    # In APPEND mode production must exist: get its parameters from DB
+    # New jobs must be equivalent to the existing ones: refuse to append if the requested parameters differ
+    first_job = 0
+    if PROD_APPEND:
+        if not DB.is_prod_in_db(PROD_NAME):
+            print "*** ERROR *** Production '%s' not found in DB: cannot append jobs to it"%PROD_NAME
+            sys.exit(2)
+        prodId = DB.get_prod_id(PROD_NAME)
+        reco_info = DB.get_recoprod_info(prodId)
+        if reco_info == None:
+            print "*** ERROR *** Production '%s' is not a reconstruction production: cannot append jobs to it"%PROD_NAME
+            sys.exit(2)
+        (prod_run,prod_version) = reco_info
+        (dummy,prod_ce,PROD_DIR,JOB_PROXY_FILE,first_job) = DB.get_prod_info(prodId)
+        (prod_srm,PROD_STORAGE_DIR) = DB.get_prod_storage(prodId)
+        mismatch = []
+        if prod_run != PROD_RUN_NAME: mismatch.append(("run",prod_run,PROD_RUN_NAME))
+        if prod_version != PROD_RECO_VERSION: mismatch.append(("PadmeReco version",prod_version,PROD_RECO_VERSION))
+        if PROD_CE and PROD_CE != prod_ce: mismatch.append(("CE",prod_ce,PROD_CE))
+        if "-d" in [ opt for (opt,arg) in opts ] and PROD_SRM != prod_srm: mismatch.append(("storage SRM",prod_srm,PROD_SRM))
+        if mismatch:
+            for (param,stored,requested) in mismatch:
+                print "*** ERROR *** Production '%s' uses %s %s but %s was requested"%(PROD_NAME,param,stored,requested)
+            print "*** ERROR *** Cannot append jobs with different parameters to production '%s'"%PROD_NAME
+            sys.exit(2)
+        PROD_CE = prod_ce
+        PROD_SRM = prod_srm
+        if not os.path.isdir(PROD_DIR):
+            print "*** ERROR *** Production directory '%s' not found"%PROD_DIR
+            sys.exit(2)
+
     # Show info about required production
-    print "- Starting production %s"%PROD_NAME
+    if PROD_APPEND:
+        print "- Appending jobs to production %s (%d jobs)"%(PROD_NAME,first_job)
+    else:
+        print "- Starting production %s"%PROD_NAME
     print "- Processing run %s"%PROD_RUN_NAME
     print "- PadmeReco version %s"%PROD_RECO_VERSION
-    print "- Each job will process %d rawdata files"%PROD_FILES_PER_JOB
-    print "- Submitting jobs to CE %s"%PROD_CE
+    if PROD_MB_PER_JOB:
+        print "- Each job will process about %d MB of data"%PROD_MB_PER_JOB
+    else:
+        print "- Each job will process about %d files"%PROD_FILES_PER_JOB
+    if PROD_NCORES > 1:
+        print "- Cores per job: %d (input files split among PadmeReco instances)"%PROD_NCORES
+    if PROD_STAGE_CHUNK:
+        print "- Input files staged to local disk in chunks of %d files"%PROD_STAGE_CHUNK
     print "- Main production directory: %s"%PROD_DIR
     print "- Production script: %s"%PROD_SCRIPT
     print "- Storage SRM: %s"%PROD_SRM
     print "- Storage directory: %s"%PROD_STORAGE_DIR
+    if PROD_FAKE:
+        print "- FAKE mode: nothing will be created"
     if PROD_DEBUG:
         print "- Debug level: %d"%PROD_DEBUG
         PH.debug = PROD_DEBUG
+        LC.debug = PROD_DEBUG
 
-    # Check if production dir already exists
-    if os.path.exists(PROD_DIR):
-        print "*** ERROR *** Path %s already exists"%PROD_DIR
-        sys.exit(2)
+    if not PROD_APPEND:
 
-    # Check if production already exists in DB
-    if (DB.is_prod_in_db(PROD_NAME)):
-        print "*** ERROR *** A production named '%s' already exists in DB"%PROD_NAME
-        sys.exit(2)
+        # Check if production dir already exists
+        if os.path.exists(PROD_DIR):
+            print "*** ERROR *** Path %s already exists"%PROD_DIR
+            sys.exit(2)
 
-    # Create production directory to host support dirs for all jobs
-    print "- Creating production dir %s"%PROD_DIR
-    os.mkdir(PROD_DIR)
+        # Check if production already exists in DB
+        if (DB.is_prod_in_db(PROD_NAME)):
+            print "*** ERROR *** A production named '%s' already exists in DB"%PROD_NAME
+            sys.exit(2)
 
-    # Check if long-lived (30 days) proxy was defined. Create it if not
-    JOB_PROXY_FILE = "%s/%s.proxy"%(PROD_DIR,PROD_NAME)
-    if PROD_PROXY_FILE:
-        if os.path.isfile(PROD_PROXY_FILE):
-            try:
-                shutil.copyfile(PROD_PROXY_FILE,JOB_PROXY_FILE)
-            except:
-                print "*** ERROR *** Unable to copy long-lived proxy file %s to %s"%(PROD_PROXY_FILE,JOB_PROXY_FILE)
+        # Create production directory to host support dirs for all jobs
+        PLAN.phase("Setup")
+        print "- Creating production dir %s"%PROD_DIR
+        PLAN.mkdir(PROD_DIR)
+
+        # Check if long-lived (30 days) proxy was defined. Create it if not
+        JOB_PROXY_FILE = "%s/%s.proxy"%(PROD_DIR,PROD_NAME)
+        if PROD_PROXY_FILE:
+            if os.path.isfile(PROD_PROXY_FILE):
+                try:
+                    PLAN.copy_file(PROD_PROXY_FILE,JOB_PROXY_FILE,0o600)
+                except:
+                    print "*** ERROR *** Unable to copy long-lived proxy file %s to %s"%(PROD_PROXY_FILE,JOB_PROXY_FILE)
+                    shutil.rmtree(PROD_DIR)
+                    sys.exit(2)
+            else:
+                print "*** ERROR *** Long-lived proxy file %s was not found"%PROD_PROXY_FILE
                 shutil.rmtree(PROD_DIR)
                 sys.exit(2)
-            try:
-                os.chmod(JOB_PROXY_FILE,0o600)
-            except:
-                print "*** ERROR *** Unable to set access permissions of long-lived proxy file %s"%JOB_PROXY_FILE
+        else:
+            print "- Creating long-lived proxy file %s"%JOB_PROXY_FILE
+            proxy_cmd = "voms-proxy-init --valid 720:0 --out %s"%JOB_PROXY_FILE
+            if PLAN.run(proxy_cmd):
+                print "*** ERROR *** while generating long-lived proxy file %s"%JOB_PROXY_FILE
                 shutil.rmtree(PROD_DIR)
                 sys.exit(2)
-        else:
-            print "*** ERROR *** Long-lived proxy file %s was not found"%PROD_PROXY_FILE
-            shutil.rmtree(PROD_DIR)
-            sys.exit(2)
-    else:
-        print "- Creating long-lived proxy file %s"%JOB_PROXY_FILE
-        proxy_cmd = "voms-proxy-init --valid 720:0 --out %s"%JOB_PROXY_FILE
-        if PROD_DEBUG: print "> %s"%proxy_cmd
-        if subprocess.call(shlex.split(proxy_cmd)):
-            print "*** ERROR *** while generating long-lived proxy file %s"%JOB_PROXY_FILE
-            shutil.rmtree(PROD_DIR)
-            sys.exit(2)
 
     # Check if VOMS proxy exists and is valid. Renew it if not.
     # This is needed to get list of files in this run and to create the storage dir on the SRM server
-    PH.renew_voms_proxy(JOB_PROXY_FILE)
-
-    # Get list of files for run to reconstruct
-    # All files are assumed to be on the LNF SE and available via the ROOTX protocol
-    file_list = get_run_file_list(PROD_RUN_NAME)
-    job_file_lists = []
-    job_file_list = []
-    for f in file_list:
-        if len(job_file_list) == PROD_FILES_PER_JOB:
-            job_file_lists.append(job_file_list)
-            job_file_list = []
-        file_url = "%s/daq/%s/rawdata/%s/%s"%(PADME_ROOT_URI["LNF"],PROD_YEAR,PROD_RUN_NAME,f)
-        job_file_list.append(file_url)
-    if job_file_list: job_file_lists.append(job_file_list)
+    # In FAKE mode the current VOMS proxy of the user is used
+    if not PROD_FAKE: PH.renew_voms_proxy(JOB_PROXY_FILE)
+
+    # Get list of files for run to reconstruct and find which storage sites hold a replica of each of them
+    PLAN.phase("Input split")
+    run_file_list = get_run_file_list(PROD_RUN_NAME,PROD_APPEND)
+
+    # In APPEND mode only files not yet assigned to any job of the production are processed
+    if PROD_APPEND:
+        assigned = set([ os.path.basename(f) for f in DB.get_prod_input_files(prodId) ])
+        run_file_list = [ (f,size) for (f,size) in run_file_list if not f in assigned ]
+        print "- %d files already assigned to production jobs, %d new files found"%(len(assigned),len(run_file_list))
+
+    # Files already reconstructed by a successful job with the same version are not processed again
+    if not PROD_REPROCESS:
+        done = DB.get_reconstructed_inputs(PROD_RECO_VERSION,[ f for (f,size) in run_file_list ])
+        if done:
+            print "- Skipping %d files already reconstructed with version %s"%(len(done),PROD_RECO_VERSION)
+            run_file_list = [ (f,size) for (f,size) in run_file_list if not f in done ]
+
+    if not run_file_list:
+        print "- No files to reconstruct"
+        DB.close_db()
+        if PROD_APPEND:
+            if not prod_daemon_running("%s/%s.pid"%(PROD_DIR,PROD_NAME)):
+                print "WARNING production daemon for %s is not running"%PROD_NAME
+        elif not PROD_FAKE:
+            shutil.rmtree(PROD_DIR)
+        sys.exit(0)
+
+    RS = RunSites(LC,PADME_SRM_URI,PADME_REPLICA_SITES)
+    replicas = RS.run_replicas(PROD_YEAR,PROD_RUN_NAME,run_file_list)
+
+    # If no CE was specified, submit to the site whose local storage holds most of the run data
+    if not PROD_CE:
+        PROD_RUN_SITE = RS.choose_site(PADME_CE_NODE,run_file_list,replicas,PROD_RUN_SITE_DEFAULT)
+        PROD_CE = PADME_CE_NODE[PROD_RUN_SITE]
+    print "- Submitting jobs to CE %s"%PROD_CE
+
+    # Each file is read via xrootd from the storage local to the CE, if it holds a replica of it, or
+    # else from the first site holding a replica. Files with no known replica are read from LNF
+    # Files are split among jobs according to their size
+    local = RS.local_storage(PROD_CE)
+    site_files = {}
+    file_list = []
+    for (f,size) in run_file_list:
+        if local and local in replicas[f]:
+            site = local
+        elif replicas[f]:
+            site = replicas[f][0]
+        else:
+            site = "LNF"
+        site_files.setdefault(site,[]).append(size)
+        file_url = "%s/daq/%s/rawdata/%s/%s"%(PADME_ROOT_URI[site],PROD_YEAR,PROD_RUN_NAME,f)
+        file_list.append((file_url,size))
+    for site in sorted(site_files.keys()):
+        if site == local:
+            where = "local"
+        else:
+            where = "remote"
+        print "- Input from %s (%s): %d files, %.1f MB"%(site,where,len(site_files[site]),sum([ size for size in site_files[site] if size ])/1.E6)
+    splitter = InputSplitter(PROD_FILES_PER_JOB,PROD_MB_PER_JOB*1000000,PROD_FILES_PER_JOB_MAX)
+    job_file_lists = splitter.split(file_list)
+    print "- Input split: %s"%splitter.summary()
 
     # Create new production in DB
-    print "- Creating new production in DB"
-    prodId = DB.create_recoprod(PROD_NAME,PROD_RUN_NAME,PROD_DESCRIPTION,PROD_CE,PROD_RECO_VERSION,PROD_DIR,PROD_SRM,PROD_STORAGE_DIR,JOB_PROXY_FILE,len(job_file_lists))
+    # In APPEND mode production and storage directory already exist
+    if not PROD_APPEND:
+
+        PLAN.phase("DB")
+        print "- Creating new production in DB"
+        PLAN.add_db_rows("production")
+        PLAN.add_db_rows("reco_prod",1,len(PROD_DESCRIPTION))
+        if PROD_FAKE:
+            prodId = 0
+        else:
+            prodId = DB.create_recoprod(PROD_NAME,PROD_RUN_NAME,PROD_DESCRIPTION,PROD_CE,PROD_RECO_VERSION,PROD_DIR,PROD_SRM,PROD_STORAGE_DIR,JOB_PROXY_FILE,len(job_file_lists))
 
-    # Create production directory in the storage SRM
-    print "- Creating dir %s in %s"%(PROD_STORAGE_DIR,PROD_SRM)
-    gfal_mkdir_cmd = "gfal-mkdir -p %s%s"%(PROD_SRM,PROD_STORAGE_DIR)
-    if PROD_DEBUG: print ">",gfal_mkdir_cmd
-    rc = subprocess.call(shlex.split(gfal_mkdir_cmd))
+        # Create production directory in the storage SRM
+        print "- Creating dir %s in %s"%(PROD_STORAGE_DIR,PROD_SRM)
+        gfal_mkdir_cmd = "gfal-mkdir -p %s%s"%(PROD_SRM,PROD_STORAGE_DIR)
+        rc = PLAN.run(gfal_mkdir_cmd)
 
     # Create job structures
+    PLAN.phase("Jobs")
     print "- Creating directory structure for production jobs"
-    for j in range(0,len(job_file_lists)):
+    layout = ProdLayout(PROD_DIR)
+    for j in range(first_job,first_job+len(job_file_lists)):
 
-        jobName = "job%05d"%j
+        jobName = layout.job_name(j)
 
         # Create dir to hold individual job info
-        jobLocalDir = jobName
-        jobDir = "%s/%s"%(PROD_DIR,jobLocalDir)
+        jobLocalDir = layout.job_local_dir(j)
+        jobDir = layout.job_dir(j)
         try:
-            os.mkdir(jobDir)
+            PLAN.create_job_dir(layout,j)
         except:
             print "*** ERROR *** Unable to create job directory %s"%jobDir
             sys.exit(2)
@@ -361,53 +545,80 @@ def main(argv):
         # Copy production script to job dir
         jobScript = "%s/job.py"%jobDir
         try:
-            shutil.copyfile(PROD_SCRIPT,jobScript)
+            PLAN.copy_file(PROD_SCRIPT,jobScript)
         except:
             print "*** ERROR *** Unable to copy job script file %s to %s"%(PROD_SCRIPT,jobScript)
             sys.exit(2)
 
         # Create list with files to process
         jobListFile = "%s/job.list"%jobDir
-        with open(jobListFile,"w") as jlf:
-            for f in job_file_lists[j]: jlf.write("%s\n"%f)
+        jobList = "".join([ "%s\n"%f for f in job_file_lists[j-first_job] ])
+        PLAN.write_file(jobListFile,jobList)
 
         # Copy long-lived proxy file to job dir
         jobProxy = "%s/job.proxy"%jobDir
         try:
-            shutil.copyfile(JOB_PROXY_FILE,jobProxy)
+            PLAN.copy_file(JOB_PROXY_FILE,jobProxy,0o600)
         except:
             print "*** ERROR *** Unable to copy job proxy file %s to %s"%(JOB_PROXY_FILE,jobProxy)
             sys.exit(2)
-        try:
-            os.chmod(jobProxy,0o600)
-        except:
-            print "*** ERROR *** Unable to set access permissions of job proxy file %s"%jobProxy
-            sys.exit(2)
 
         # Create JDL file in job dir
         jobJDL = "%s/job.jdl"%jobDir
-        with open(jobJDL,"w") as jf:
-            jf.write("[\n")
-            jf.write("Type = \"Job\";\n")
-            jf.write("JobType = \"Normal\";\n")
-            jf.write("Executable = \"/usr/bin/python\";\n")
-            jf.write("Arguments = \"-u job.py job.list job.proxy %s %s %s %s %s\";\n"%(PROD_NAME,jobName,PROD_RECO_VERSION,PROD_STORAGE_DIR,PROD_SRM))
-            jf.write("StdOutput = \"job.out\";\n")
-            jf.write("StdError = \"job.err\";\n")
-            jf.write("InputSandbox = {\"job.py\",\"job.list\",\"job.proxy\"};\n")
-            jf.write("OutputSandbox = {\"job.out\", \"job.err\", \"job.sh\"};\n")
-            jf.write("OutputSandboxBaseDestURI=\"gsiftp://localhost\";\n")
-            jf.write("]\n")
+        jdl = "[\n"
+        jdl += "Type = \"Job\";\n"
+        jdl += "JobType = \"Normal\";\n"
+        jdl += "Executable = \"/usr/bin/python\";\n"
+        if PROD_NCORES > 1 or PROD_STAGE_CHUNK:
+            jdl += "Arguments = \"-u job.py job.list job.proxy %s %s %s %s %s %d %d\";\n"%(PROD_NAME,jobName,PROD_RECO_VERSION,PROD_STORAGE_DIR,PROD_SRM,PROD_NCORES,PROD_STAGE_CHUNK)
+        else:
+            jdl += "Arguments = \"-u job.py job.list job.proxy %s %s %s %s %s\";\n"%(PROD_NAME,jobName,PROD_RECO_VERSION,PROD_STORAGE_DIR,PROD_SRM)
+        if PROD_NCORES > 1:
+            jdl += "CPUNumber = %d;\n"%PROD_NCORES
+            jdl += "SMPGranularity = %d;\n"%PROD_NCORES
+        jdl += "StdOutput = \"job.out\";\n"
+        jdl += "StdError = \"job.err\";\n"
+        jdl += "InputSandbox = {\"job.py\",\"job.list\",\"job.proxy\"};\n"
+        jdl += "OutputSandbox = {\"job.out\", \"job.err\", \"job.sh\", \"program.out.gz\", \"program.err.gz\", \"job.json\"};\n"
+        jdl += "OutputSandboxBaseDestURI=\"gsiftp://localhost\";\n"
+        jdl += "]\n"
+        PLAN.write_file(jobJDL,jdl)
 
         # Create job entry in DB and register job (jobCfg and jobSeeds are only used in MC jobs)
         jobCfg = ""
-        with open(jobListFile,"r") as jlf: jobList = jlf.read()
         jobSeeds = ""
-        DB.create_job(prodId,jobName,jobLocalDir,jobCfg,jobList,jobSeeds)
+        (input_prefix,input_suffixes) = DB.compress_input_list(jobList)
+        PLAN.add_db_rows("job",1,len(jobName)+len(jobLocalDir)+len(input_prefix)+len(input_suffixes))
+        input_names = [ os.path.basename(f) for f in job_file_lists[j-first_job] ]
+        PLAN.add_db_rows("file_lineage",len(input_names),sum([ len(n)+len(PROD_RECO_VERSION) for n in input_names ]))
+        if not PROD_FAKE:
+            jobId = DB.create_job(prodId,jobName,jobLocalDir,jobCfg,jobList,jobSeeds)
+            if jobId: DB.register_lineage(jobId,PROD_RECO_VERSION,input_names,PROD_NCORES)
+
+    # Jobs were appended: update number of jobs of the production
+    if PROD_APPEND and not PROD_FAKE: DB.add_prod_jobs(prodId,len(job_file_lists))
 
     # From now on we do not need the DB anymore: close connection
     DB.close_db()
 
+    # Show what was (or would have been) created. In FAKE mode we stop here
+    PLAN.report()
+    if PROD_FAKE: sys.exit(0)
+
+    # In APPEND mode tell the running production daemon to pick up the new jobs. If it is not running, start it
+    if PROD_APPEND:
+        append_file = "%s/append"%PROD_DIR
+        if prod_daemon_running("%s/%s.pid"%(PROD_DIR,PROD_NAME)):
+            print "- Telling production daemon to add %d new jobs"%len(job_file_lists)
+            open(append_file,"w").close()
+            # The daemon may have decided to exit just before the control file was written:
+            # wait until it picks up the new jobs (i.e. removes the control file) or it is found dead
+            print "- Waiting for production daemon to pick up the new jobs"
+            while os.path.exists(append_file) and prod_daemon_running("%s/%s.pid"%(PROD_DIR,PROD_NAME)): time.sleep(10)
+            if not os.path.exists(append_file): sys.exit(0)
+        print "- Production daemon is not running: restarting it"
+        if os.path.exists("%s/%s.pid"%(PROD_DIR,PROD_NAME)): os.remove("%s/%s.pid"%(PROD_DIR,PROD_NAME))
+
     # Prepare daemon context
 
     # Assume that the current directory is the top level Production directory
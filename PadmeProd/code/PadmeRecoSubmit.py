@@ -7,8 +7,13 @@ import re
 import time
 import shlex
 import subprocess
+import threading
+import Queue
 
+from PadmeMCDB import PadmeMCDB
 from ProxyHandler import ProxyHandler
+from ListingCache import ListingCache
+from RunSites import RunSites
 
 # Get some info about running script
 thisscript = sys.argv[0]
@@ -23,6 +28,9 @@ if not ( os.path.exists(PADMERECOPROD) and os.path.isfile(PADMERECOPROD) and os.
     print "*** ERROR *** Script %s not found or not executable"%PADMERECOPROD
     sys.exit(2)
 
+# Create global handler to PadmeMCDB
+DB = PadmeMCDB()
+
 # Create proxy handler
 PH = ProxyHandler()
 
@@ -40,7 +48,20 @@ PADME_CE_QUEUE = {
     "SOFIA": "cream-pbs-cms"
 }
 
-PADME_STORAGE_SITES = [ "LNF","CNAF" ]
+# SRMs to access PADME area on the LNF and CNAF storage systems
+PADME_SRM_URI = {
+    "LNF":  "srm://atlasse.lnf.infn.it:8446/srm/managerv2?SFN=/dpm/lnf.infn.it/home/vo.padme.org",
+    "CNAF": "srm://storm-fe-archive.cr.cnaf.infn.it:8444/srm/managerv2?SFN=/padmeTape"
+}
+
+# Storage sites which can hold replicas of rawdata files, in order of preference
+PADME_REPLICA_SITES = [ "LNF","CNAF" ]
+
+# Submission site to use if no site holds a replica of the run on its local storage
+PROD_RUN_SITE_DEFAULT = "LNF"
+
+# Default URI used by PadmeRecoProd to get list of files for each run
+PADME_SOURCE_URI_DEFAULT = "srm://atlasse.lnf.infn.it:8446/srm/managerv2?SFN=/dpm/lnf.infn.it/home/vo.padme.org"
 
 # Default CE port to use. Can be changed using the "-P <port>" argument.
 # If the CE definition in PADME_CE_NODE_LIST includes ":<port>" then it will be used instead.
@@ -49,31 +70,46 @@ PROD_CE_PORT_DEFAULT = "8443"
 # Define global defaults
 PROD_DEBUG = 0
 PROD_FILES_PER_JOB = 100
+PROD_MB_PER_JOB = 0
 PROD_RECO_VERSION = ""
-PROD_RUN_SITE = "LNF"
+PROD_RUN_SITE = ""
 PROD_STORAGE_SITE = "LNF"
 PROD_SUBMIT_DELAY = 60
+PROD_SRM_DELAY = 10
+PROD_WORKERS = 4
 PROD_PROXY_FILE = "prod/long_proxy"
 PROD_SOURCE_URI = ""
 
 # Initialize list of runs to process
 PROD_RUN_LIST = []
 
+# Time when next production can be submitted to each CE and SRM and lock to access them from worker threads
+CE_NEXT_TIME = {}
+SRM_NEXT_TIME = {}
+SCHED_LOCK = threading.Lock()
+
+# Lock to avoid mixing output of different productions
+OUTPUT_LOCK = threading.Lock()
+
 def print_help():
 
-    print "%s [-L <run_list_file>] [-r <run>] -v <version> [-j <files_per_job>] [-s <submission_site>] [-Q <CE_queue>] [-P <CE_port>] [-S <source_uri>] [-d <storage_site>] [-D <submit_delay>] [-V] [-h]"%SCRIPT_NAME
+    print "%s [-L <run_list_file>] [-r <run>] -v <version> [-j <files_per_job>] [-b <MB_per_job>] [-s <submission_site>] [-Q <CE_queue>] [-P <CE_port>] [-S <source_uri>] [-d <storage_site>] [-D <submit_delay>] [-T <srm_delay>] [-w <workers>] [-V] [-h]"%SCRIPT_NAME
     print "  -L <run_list_file>\tfile with list of runs to process"
     print "  -r <run_name>\t\tname of run to process"
     print "  -v <version>\t\tversion of PadmeReco to use for production. Must be installed on CVMFS."
     print "  -j <files_per_job>\tnumber of rawdata files to be reconstructed by each job. Default: %d"%PROD_FILES_PER_JOB
-    print "  -s <submission_site>\tsite to be used for job submission. Allowed: %s. Default: %s"%(",".join(PADME_CE_NODE_LIST.keys()),PROD_RUN_SITE)
+    print "  -b <MB_per_job>\tamount of data (MB) to be reconstructed by each job. If given, -j is ignored"
+    print "  -s <submission_site>\tsite to be used for job submission. Allowed: %s. Default: site holding most of the run data on its local storage (%s if none)"%(",".join(PADME_CE_NODE_LIST.keys()),PROD_RUN_SITE_DEFAULT)
     print "  -P <CE_port>\t\tCE port. Default: %s"%PROD_CE_PORT_DEFAULT
     print "  -Q <CE_queue>\t\tCE queue to use for submission. Default from submission site"
     print "  -S <source_uri>\tURI to use to get list of files for production run"
-    print "  -d <storage_site>\tsite where the jobs output will be stored. Allowed: %s. Default: %s"%(",".join(PADME_STORAGE_SITES),PROD_STORAGE_SITE)
-    print "  -D <submit_delay>\tDelay in sec between run submissions. Default: %d sec"%PROD_SUBMIT_DELAY
+    print "  -d <storage_site>\tsite where the jobs output will be stored. Allowed: %s. Default: %s"%(",".join(PADME_SRM_URI.keys()),PROD_STORAGE_SITE)
+    print "  -D <submit_delay>\tMin delay in sec between productions submitted to the same CE. Default: %d sec"%PROD_SUBMIT_DELAY
+    print "  -T <srm_delay>\tMin delay in sec between productions using the same SRM. Default: %d sec"%PROD_SRM_DELAY
+    print "  -w <workers>\t\tNumber of productions created in parallel. Default: %d"%PROD_WORKERS
     print "  -V\t\t\tenable debug mode. Can be repeated to increase verbosity"
     print "  N.B. Multiple -L and -r options can be combined to create a single list of runs. Duplicated runs will be automatically removed."
+    print "       Runs which already have a production with the same version are skipped."
 
 def add_run(run):
 
@@ -98,26 +134,109 @@ def add_run_list(run_list):
             if re.match("^\s*$",run) or re.match("^\s*#.*$",run): continue
             PROD_RUN_LIST.append(run.strip())
 
+def choose_run_site(RS,LC,source_uri,run):
+
+    # Same rule used by PadmeRecoProd when no CE is given: choose the submission site whose local
+    # storage holds most of the run data. Listings are taken from the local listing cache
+    r = re.match("^run_\d+_(\d\d\d\d)\d\d\d\d_\d\d\d\d\d\d$",run)
+    if not r: return PROD_RUN_SITE_DEFAULT
+    listing = LC.list(source_uri,"/daq/%s/rawdata/%s"%(r.group(1),run))
+    if listing == None: return PROD_RUN_SITE_DEFAULT
+    file_list = [ (name,size) for (name,size,mtime,is_dir) in listing if not is_dir ]
+    replicas = RS.run_replicas(r.group(1),run,file_list)
+    ce_nodes = dict([ (site,PADME_CE_NODE_LIST[site][0]) for site in PADME_CE_NODE_LIST.keys() ])
+    return RS.choose_site(ce_nodes,file_list,replicas,PROD_RUN_SITE_DEFAULT)
+
+def reserve_slot(ce_list,srm_list):
+
+    # Choose the CE which can accept a new production first and reserve a submission slot on it
+    # and on all SRMs used by the production, respecting the min delays. Return (ce,start_time)
+    with SCHED_LOCK:
+        ce = min(ce_list,key=lambda c: CE_NEXT_TIME.get(c,0.))
+        start = max([time.time(),CE_NEXT_TIME.get(ce,0.)]+[ SRM_NEXT_TIME.get(srm,0.) for srm in srm_list ])
+        CE_NEXT_TIME[ce] = start+PROD_SUBMIT_DELAY
+        for srm in srm_list: SRM_NEXT_TIME[srm] = start+PROD_SRM_DELAY
+    return (ce,start)
+
+def submit_worker(run_queue,n_runs,ce_queue,srm_list,results):
+
+    # Create productions for runs in queue until queue is empty
+    while True:
+
+        try:
+            (n_run,run,run_site) = run_queue.get_nowait()
+        except Queue.Empty:
+            return
+
+        # Wait for a free submission slot
+        (ce,start) = reserve_slot(PADME_CE_NODE_LIST[run_site],srm_list)
+        if start > time.time(): time.sleep(start-time.time())
+
+        # Extract port number from CE (if any)
+        r = re.match("^(\S+)\:(\d+)$",ce)
+        if r:
+            ce_node = r.group(1)
+            ce_port = r.group(2)
+        else:
+            ce_node = ce
+            ce_port = PROD_CE_PORT_DEFAULT
+
+        # If queue was not defined, use default queue for submission site
+        ce_queue_name = ce_queue
+        if not ce_queue_name: ce_queue_name = PADME_CE_QUEUE[run_site]
+
+        prod_cmd = "%s -r %s -j %d -v %s -C %s -P %s -Q %s -p %s"%(PADMERECOPROD,run,PROD_FILES_PER_JOB,PROD_RECO_VERSION,ce_node,ce_port,ce_queue_name,PROD_PROXY_FILE)
+
+        # Add amount of data per job if specified
+        if PROD_MB_PER_JOB:
+            prod_cmd += " -b %d"%PROD_MB_PER_JOB
+
+        # Add surce URI if specified
+        if PROD_SOURCE_URI:
+            prod_cmd += " -S %s"%PROD_SOURCE_URI
+
+        # Add production storage site if specified
+        if PROD_STORAGE_SITE:
+            prod_cmd += " -d %s"%PROD_STORAGE_SITE
+
+        # Add debug option(s) if required
+        if PROD_DEBUG:
+            for i in range(0,PROD_DEBUG): prod_cmd += " -V"
+
+        # Call PadmeRecoProd for this run and show its output when done
+        p = subprocess.Popen(shlex.split(prod_cmd),stdout=subprocess.PIPE,stderr=subprocess.STDOUT)
+        out = p.communicate()[0]
+        with OUTPUT_LOCK:
+            print
+            print "=== %4d/%-4d === Run %s submitted to CE %s ==="%(n_run,n_runs,run,ce)
+            if PROD_DEBUG: print prod_cmd
+            sys.stdout.write(out)
+            if p.returncode:
+                print "*** ERROR *** Production submission command for run %s returned error %d"%(run,p.returncode)
+            sys.stdout.flush()
+        results[run] = p.returncode
+
 def main(argv):
 
     # Declare that here we can possibly modify these global variables
     global PROD_CE_PORT_DEFAULT
     global PROD_DEBUG
     global PROD_FILES_PER_JOB
+    global PROD_MB_PER_JOB
     global PROD_RECO_VERSION
     global PROD_RUN_SITE
     global PROD_STORAGE_SITE
     global PROD_SUBMIT_DELAY
+    global PROD_SRM_DELAY
+    global PROD_WORKERS
     global PROD_SOURCE_URI
 
     global PROD_RUN_LIST
 
-    PROD_CE_NODE = ""
-    PROD_CE_PORT = ""
     PROD_CE_QUEUE = ""
 
     try:
-        opts,args = getopt.getopt(argv,"hVL:r:j:v:s:P:Q:d:D:S:",[])
+        opts,args = getopt.getopt(argv,"hVL:r:j:b:v:s:P:Q:d:D:S:T:w:",[])
     except getopt.GetoptError as e:
         print "Option error: %s"%str(e)
         print_help()
@@ -152,6 +271,17 @@ def main(argv):
                 print "*** ERROR *** Invalid number of files per job: %d"%PROD_FILES_PER_JOB
                 print_help()
                 sys.exit(2)
+        elif opt == '-b':
+            try:
+                PROD_MB_PER_JOB = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid parameter in amount of data per job: '%s'"%arg
+                print_help()
+                sys.exit(2)
+            if PROD_MB_PER_JOB < 0:
+                print "*** ERROR *** Invalid amount of data per job: %d"%PROD_MB_PER_JOB
+                print_help()
+                sys.exit(2)
         elif opt == '-s':
             if arg in PADME_CE_NODE_LIST.keys():
                 PROD_RUN_SITE = arg
@@ -160,10 +290,10 @@ def main(argv):
                 print_help()
                 sys.exit(2)
         elif opt == '-d':
-            if arg in PADME_STORAGE_SITES:
+            if arg in PADME_SRM_URI.keys():
                 PROD_STORAGE_SITE = arg
             else:
-                print "*** ERROR *** Invalid storage site %s. Valid: %s"%PADME_STORAGE_SITES
+                print "*** ERROR *** Invalid storage site %s. Valid: %s"%(arg,",".join(PADME_SRM_URI.keys()))
                 print_help()
                 sys.exit(2)
         elif opt == '-D':
@@ -177,6 +307,28 @@ def main(argv):
                 print "*** ERROR *** Invalid delay between submissions: %d"%PROD_SUBMIT_DELAY
                 print_help()
                 sys.exit(2)
+        elif opt == '-T':
+            try:
+                PROD_SRM_DELAY = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid parameter for SRM delay: '%s'"%arg
+                print_help()
+                sys.exit(2)
+            if PROD_SRM_DELAY < 0 or PROD_SRM_DELAY > 3600:
+                print "*** ERROR *** Invalid delay between SRM accesses: %d"%PROD_SRM_DELAY
+                print_help()
+                sys.exit(2)
+        elif opt == '-w':
+            try:
+                PROD_WORKERS = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid parameter for number of workers: '%s'"%arg
+                print_help()
+                sys.exit(2)
+            if PROD_WORKERS < 1 or PROD_WORKERS > 100:
+                print "*** ERROR *** Invalid number of workers: %d"%PROD_WORKERS
+                print_help()
+                sys.exit(2)
 
     # Remove duplicates from list of runs to be processed and sort it
     PROD_RUN_LIST = list(set(PROD_RUN_LIST))
@@ -194,9 +346,19 @@ def main(argv):
         print_help()
         sys.exit(2)
 
-    # If queue was not defined, use default queue for submission site
-    if not PROD_CE_QUEUE:
-        PROD_CE_QUEUE = PADME_CE_QUEUE[PROD_RUN_SITE]
+    # Skip runs which already have a production with this version (single DB query for all runs)
+    prod_names = [ "%s_%s"%(run,PROD_RECO_VERSION) for run in PROD_RUN_LIST ]
+    done_runs = DB.get_reco_runs(PROD_RECO_VERSION,prod_names,PROD_RUN_LIST)
+    DB.close_db()
+    if done_runs:
+        print "- Skipping %d runs which already have a production with version %s"%(len(done_runs),PROD_RECO_VERSION)
+        if PROD_DEBUG:
+            for run in sorted(done_runs): print "  %s"%run
+        PROD_RUN_LIST = [ run for run in PROD_RUN_LIST if not run in done_runs ]
+        n_runs = len(PROD_RUN_LIST)
+        if n_runs == 0:
+            print "- No runs left to process"
+            sys.exit(0)
 
     # Create a long-lived proxy (30 days) to be used for all submissions
     print "- Creating long-lived proxy file %s"%PROD_PROXY_FILE
@@ -208,53 +370,69 @@ def main(argv):
     # Create a new VOMS proxy using long-lived proxy
     #PH.create_voms_proxy(PROD_PROXY_FILE)
 
-    # CEs at submission site will be used in round robin to avoid overload
-    PROD_CE_INDEX = 0
-
-    n_run = 0
-    print "- Creating production for %d runs"%n_runs
+    # Refresh in bulk the local cache of rawdata listings used by PadmeRecoProd
+    # The rawdata dir of each year is listed once: runs not modified since their last listing are not listed again
+    PH.debug = PROD_DEBUG
+    PH.renew_voms_proxy(PROD_PROXY_FILE)
+    LC = ListingCache()
+    LC.debug = PROD_DEBUG
+    source_uri = PROD_SOURCE_URI
+    if not source_uri: source_uri = PADME_SOURCE_URI_DEFAULT
+    year_runs = {}
     for run in PROD_RUN_LIST:
+        r = re.match("^run_\d+_(\d\d\d\d)\d\d\d\d_\d\d\d\d\d\d$",run)
+        if r: year_runs.setdefault(r.group(1),[]).append(run)
+    for year in sorted(year_runs.keys()):
+        print "- Refreshing listing cache for %d runs of year %s"%(len(year_runs[year]),year)
+        n_listed = LC.refresh_tree(source_uri,"/daq/%s/rawdata"%year,year_runs[year])
+        if n_listed < 0:
+            print "WARNING unable to refresh listing cache for year %s"%year
+        elif PROD_DEBUG:
+            print "- %d directories listed on storage"%n_listed
+
+    # Create directory hosting all productions with this version before starting the workers
+    version_dir = "prod/%s"%PROD_RECO_VERSION
+    if not os.path.exists(version_dir):
+        print "- Creating production directory %s"%version_dir
+        os.mkdir(version_dir)
+    elif not os.path.isdir(version_dir):
+        print "*** ERROR *** '%s' exists but is not a directory"%version_dir
+        sys.exit(2)
 
-        # Wait before submitting next run
-        if n_run > 0: time.sleep(PROD_SUBMIT_DELAY)
-        n_run += 1
-
-        print
-        print "=== %4d/%-4d === Submitting run %s ==="%(n_run,n_runs,run)
-
-        # Choose CE from site list and extract port number (if any)
-        PROD_CE = PADME_CE_NODE_LIST[PROD_RUN_SITE][PROD_CE_INDEX]
-        r = re.match("^(\S+)\:(\d+)$",PROD_CE)
-        if r:
-            PROD_CE_NODE = r.group(1)
-            PROD_CE_PORT = r.group(2)
+    # If no submission site was given, choose it for each run according to the location of its data
+    RS = RunSites(LC,PADME_SRM_URI,PADME_REPLICA_SITES)
+    run_sites = {}
+    for run in PROD_RUN_LIST:
+        if PROD_RUN_SITE:
+            run_sites[run] = PROD_RUN_SITE
         else:
-            PROD_CE_NODE = PROD_CE
-            PROD_CE_PORT = PROD_CE_PORT_DEFAULT
-
-        PROD_CMD = "%s -r %s -j %d -v %s -C %s -P %s -Q %s -p %s"%(PADMERECOPROD,run,PROD_FILES_PER_JOB,PROD_RECO_VERSION,PROD_CE_NODE,PROD_CE_PORT,PROD_CE_QUEUE,PROD_PROXY_FILE)
-
-        # Add surce URI if specified
-        if PROD_SOURCE_URI:
-            PROD_CMD += " -S %s"%PROD_SOURCE_URI
-
-        # Add production storage site if specified
-        if PROD_STORAGE_SITE:
-            PROD_CMD += " -d %s"%PROD_STORAGE_SITE
-
-        # Add debug option(s) if required
-        if PROD_DEBUG:
-            for i in range(0,PROD_DEBUG): PROD_CMD += " -V"
-
-        # Call PadmeRecoProd for this run
-        if PROD_DEBUG: print PROD_CMD
-        if subprocess.call(shlex.split(PROD_CMD)):
-            print "*** ERROR *** Production submission command returned an error"
-            sys.exit(2)
-
-        # Change CE for next run
-        PROD_CE_INDEX += 1
-        if PROD_CE_INDEX >= len(PADME_CE_NODE_LIST[PROD_RUN_SITE]): PROD_CE_INDEX = 0
+            run_sites[run] = choose_run_site(RS,LC,source_uri,run)
+            if PROD_DEBUG: print "- Run %s will be submitted to site %s"%(run,run_sites[run])
+
+    # Productions are created in parallel by a pool of workers. Each production is sent to the first
+    # CE of its submission site which can accept it without violating the min delay between submissions
+    # to the same CE. Access to the SRMs (source of rawdata and storage site) is rate limited in the same way
+    srm_list = list(set([ source_uri,PADME_SRM_URI[PROD_STORAGE_SITE] ]))
+    run_queue = Queue.Queue()
+    for n_run in range(n_runs): run_queue.put((n_run+1,PROD_RUN_LIST[n_run],run_sites[PROD_RUN_LIST[n_run]]))
+    results = {}
+    n_workers = min(PROD_WORKERS,n_runs)
+    print "- Creating production for %d runs using %d workers"%(n_runs,n_workers)
+    workers = []
+    for i in range(n_workers):
+        worker = threading.Thread(target=submit_worker,args=(run_queue,n_runs,PROD_CE_QUEUE,srm_list,results))
+        worker.daemon = True
+        worker.start()
+        workers.append(worker)
+    for worker in workers: worker.join()
+
+    # Show final report
+    failed = [ run for run in PROD_RUN_LIST if results.get(run,1) != 0 ]
+    print
+    print "- %d productions created, %d failed"%(n_runs-len(failed),len(failed))
+    if failed:
+        for run in failed: print "*** ERROR *** Production for run %s was not created"%run
+        sys.exit(2)
 
 # Execution starts here
 if __name__ == "__main__": main(sys.argv[1:])
@@ -5,11 +5,48 @@ import sys
 import time
 import subprocess
 import re
+import gzip
+import json
 import shlex
 
 class ProdJob:
 
-    def __init__(self,job_id,ce,db,delegation_id,debug):
+    # Status maps are shared by all jobs: define them once at class level
+
+    # Define all known statuses for a submitted job
+    job_sub_status_code = {
+          0: "UNSUBMITTED",
+          1: "REGISTERED",
+          2: "PENDING",
+          3: "IDLE",
+          4: "RUNNING",
+          5: "REALLY-RUNNING",
+          6: "HELD",
+          7: "DONE-OK",
+          8: "DONE-FAILED",
+          9: "CANCELLED",
+         10: "ABORTED",
+         11: "UNKNOWN",
+         12: "UNDEF",
+        100: "SUBMIT-FAILED",
+        107: "DONE-OK, output problem",
+        108: "DONE-FAILED, output problem",
+        109: "CANCELLED, output problem",
+        207: "DONE_OK, RC!=0",
+        307: "DONE_OK, hung job killed"
+    }
+
+    # Exit code of worker scripts when the program was hung and was killed by their watchdog
+    watchdog_exit_code = "3"
+
+    # Optional files shipped by current worker scripts: compressed program logs and job summary
+    optional_files = ("program.out.gz","program.err.gz","job.json")
+
+    # Set when jobs submitted by older worker scripts (shipping none of the optional files) were reported
+    # Each production is handled by its own server process: the report is shown once per production
+    old_worker_reported = False
+
+    def __init__(self,job_id,ce,db,delegation_id,debug,job_name="",job_dir=""):
 
         # Job identifier within the PadmeMCDB database
         self.job_id = job_id
@@ -26,9 +63,11 @@ class ProdJob:
         # Name of delegation to use for job submission
         self.delegation_id = delegation_id
 
-        # Get some job info from DB
-        self.job_name = self.db.get_job_name(self.job_id)
-        self.job_dir = self.db.get_job_dir(self.job_id)
+        # Get some job info from DB unless the caller already provided it
+        self.job_name = job_name
+        if not self.job_name: self.job_name = self.db.get_job_name(self.job_id)
+        self.job_dir = job_dir
+        if not self.job_dir: self.job_dir = self.db.get_job_dir(self.job_id)
 
         # Debug level
         self.debug = debug
@@ -56,27 +95,11 @@ class ProdJob:
         self.job_sub_id = None
         self.ce_job_id = None
 
-        # Define all known statuses for a submitted job
-        self.job_sub_status_code = {
-              0: "UNSUBMITTED",
-              1: "REGISTERED",
-              2: "PENDING",
-              3: "IDLE",
-              4: "RUNNING",
-              5: "REALLY-RUNNING",
-              6: "HELD",
-              7: "DONE-OK",
-              8: "DONE-FAILED",
-              9: "CANCELLED",
-             10: "ABORTED",
-             11: "UNKNOWN",
-             12: "UNDEF",
-            100: "SUBMIT-FAILED",
-            107: "DONE-OK, output problem",
-            108: "DONE-FAILED, output problem",
-            109: "CANCELLED, output problem",
-            207: "DONE_OK, RC!=0"
-        }
+        # Report line of a job in a final state. It is computed only once as it does not change anymore
+        self.final_report = ""
+
+        # If False, jobs in a final state are not reported at each iteration (used for very large productions)
+        self.report_final = True
 
         # Define quit file: if found, job will cleanly quit
         self.quit_file = "%s/quit"%self.job_dir
@@ -100,6 +123,12 @@ class ProdJob:
         # 2: Successful
         # 3: Failed
     
+        # Jobs in a final state do not need any DB or CE access
+        if self.final_report:
+            if self.report_final: print self.final_report
+            if self.job_status == 2: return "SUCCESSFUL"
+            return "FAILED"
+
         # Check quit control file and quit job if found.
         if os.path.exists(self.quit_file):
             print "*** Quit file %s found: quitting job ***"%self.quit_file
@@ -133,17 +162,19 @@ class ProdJob:
 
         # Status 2: Job was successful
         if self.job_status == 2:
-            print "- %-8s %-60s %s %s %s"%(self.job_name,self.ce_job_id,"DONE_OK",location,description)
+            self.final_report = "- %-8s %-60s %s %s %s"%(self.job_name,self.ce_job_id,"DONE_OK",location,description)
+            print self.final_report
             return "SUCCESSFUL"
 
         # Status 3: Job failed. Show how it failed
         if self.job_status == 3:
             if not self.job_sub_id:
-                print "- %-8s %-60s %s"%(self.job_name,"UNDEFINED","SUBMIT_FAILED")
+                self.final_report = "- %-8s %-60s %s"%(self.job_name,"UNDEFINED","SUBMIT_FAILED")
             elif job_sub_status in self.job_sub_status_code.keys():
-                print "- %-8s %-60s %s %s %s"%(self.job_name,self.ce_job_id,self.job_sub_status_code[job_sub_status],location,description)
+                self.final_report = "- %-8s %-60s %s %s %s"%(self.job_name,self.ce_job_id,self.job_sub_status_code[job_sub_status],location,description)
             else:
-                print "- %-8s %-60s %s %s %s"%(self.job_name,self.ce_job_id,"FAILED with status %d (?)"%job_sub_status,location,description)
+                self.final_report = "- %-8s %-60s %s %s %s"%(self.job_name,self.ce_job_id,"FAILED with status %d (?)"%job_sub_status,location,description)
+            print self.final_report
             return "FAILED"
 
         # Status is 1: Job is being processed
@@ -181,7 +212,7 @@ class ProdJob:
 
                 (finalize_ok,sh_file,out_file,err_file) = self.finalize_job()
                 if finalize_ok and (job_exit_code == "0"):
-                    if not self.parse_out_file(out_file):
+                    if not self.parse_job_info(out_file):
                         print "  WARNING problems while parsing output file %s"%out_file
                         self.db.close_job_submit(self.job_sub_id,107,job_description,job_exit_code)
                     elif not self.parse_err_file(err_file):
@@ -196,6 +227,9 @@ class ProdJob:
                 if job_exit_code == "0":
                     print "  WARNING job is DONE_OK and RC is 0 but output retrieval failed"
                     self.db.close_job_submit(self.job_sub_id,107,job_description,job_exit_code)
+                elif job_exit_code == self.watchdog_exit_code:
+                    print "  WARNING job is DONE_OK but program was hung and was killed by the watchdog"
+                    self.db.close_job_submit(self.job_sub_id,307,job_description,job_exit_code)
                 else:
                     print "  WARNING job is DONE_OK but with RC %s"%job_exit_code
                     self.db.close_job_submit(self.job_sub_id,207,job_description,job_exit_code)
@@ -403,21 +437,25 @@ class ProdJob:
 
         # Check if all output files are there
 
-        out_file = "%s/%s/job.out"%(self.job_dir,sub_dir)
-        if not os.path.exists(out_file):
+        out_file = self.find_log_file("%s/%s/job.out"%(self.job_dir,sub_dir))
+        if not out_file:
             output_ok = False
-            print "  WARNING File %s not found"%out_file
+            print "  WARNING File %s/%s/job.out not found"%(self.job_dir,sub_dir)
 
-        err_file = "%s/%s/job.err"%(self.job_dir,sub_dir)
-        if not os.path.exists(err_file):
+        err_file = self.find_log_file("%s/%s/job.err"%(self.job_dir,sub_dir))
+        if not err_file:
             output_ok = False
-            print "  WARNING File %s not found"%err_file
+            print "  WARNING File %s/%s/job.err not found"%(self.job_dir,sub_dir)
     
         sh_file  = "%s/%s/job.sh"%(self.job_dir,sub_dir)
         if not os.path.exists(sh_file):
             output_ok = False
             print "  WARNING File %s not found"%sh_file
 
+        # Compressed program logs and job summary are optional (jobs submitted by older versions do not have them)
+        missing = [ f for f in self.optional_files if not os.path.exists("%s/%s/%s"%(self.job_dir,sub_dir,f)) ]
+        self.report_missing_optional_files(["%s/%s/%s"%(self.job_dir,sub_dir,f) for f in missing])
+
         # Purge job only if all expected files were found
         if output_ok:
             self.purge_job()
@@ -468,6 +506,79 @@ class ProdJob:
             return False
         return True
 
+    def report_missing_optional_files(self,missing):
+
+        # Jobs submitted by older worker scripts have none of the optional files: report them only once
+        if len(missing) == len(self.optional_files):
+            if not ProdJob.old_worker_reported:
+                print "  WARNING No compressed program logs and job summary found: job was submitted by an older worker script (reported only once)"
+                ProdJob.old_worker_reported = True
+            return
+        for f in missing: print "  WARNING File %s not found"%f
+
+    def find_log_file(self,log_file):
+
+        # Return path of log file as it was retrieved (plain or gzip-compressed) or "" if not found
+        if os.path.exists(log_file): return log_file
+        if os.path.exists("%s.gz"%log_file): return "%s.gz"%log_file
+        return ""
+
+    def open_log_file(self,log_file):
+
+        # Open log file for reading, transparently decompressing it if gzip-compressed
+        if log_file.endswith(".gz"): return gzip.open(log_file,"r")
+        return open(log_file,"r")
+
+    def parse_job_info(self,out_file):
+
+        # Get job information from the summary written by the worker script in the same directory as the
+        # output file. Fall back to parsing the output file if the summary is missing or incomplete
+        json_file = "%s/job.json"%os.path.dirname(out_file)
+        if os.path.exists(json_file):
+            if self.parse_json_file(json_file): return True
+            print "  WARNING job summary %s is not usable: parsing output file"%json_file
+        return self.parse_out_file(out_file)
+
+    def parse_json_file(self,json_file):
+
+        # Read job summary and write information to DB
+        try:
+            with open(json_file,"r") as jf: summary = json.load(jf)
+        except (IOError,ValueError) as e:
+            print "  WARNING unable to read job summary %s: %s"%(json_file,e)
+            return False
+
+        # Summary is complete only if the worker script reached its end
+        if not "exit_code" in summary: return False
+
+        reco_processed_events = ""
+        mc_processed_events = ""
+        if "n_events" in summary:
+            if summary.get("program") == "PadmeReco":
+                reco_processed_events = str(summary["n_events"])
+            else:
+                mc_processed_events = str(summary["n_events"])
+
+        file_list = []
+        try:
+            for f in summary.get("files",[]):
+                if f["copied"]: file_list.append((str(f["type"]),str(f["name"]),int(f["size"]),str(f["adler32"]),f.get("storage_uri")))
+        except (KeyError,TypeError,ValueError):
+            print "  WARNING wrong format of output files list in job summary %s"%json_file
+            return False
+
+        # Resource usage is known only if the job processes were sampled at least once
+        resources = {}
+        if summary.get("resources",{}).get("samples",0):
+            for key in ("cpu_min","cpu_avg","cpu_max","rss_peak","read_bytes","write_bytes"):
+                resources[key] = summary["resources"].get(key,None)
+
+        return self.record_job_info(
+            summary.get("worker_node",""),summary.get("wn_user",""),summary.get("wn_dir",""),
+            summary.get("time_start",""),summary.get("time_end",""),summary.get("prog_start",""),summary.get("prog_end",""),
+            reco_processed_events,mc_processed_events,file_list,resources,summary.get("phases",{})
+        )
+
     def parse_out_file(self,out_file):
 
         # Parse log file and write information to DB
@@ -493,7 +604,10 @@ class ProdJob:
 
         mc_processed_events = ""
 
-        jof = open(out_file,"r")
+        resources = {}
+        phases = {}
+
+        jof = self.open_log_file(out_file)
         for line in jof:
 
             r = re.match("^Job running on node (\S*) as user (\S*) in dir (\S*)\s*$",line)
@@ -517,8 +631,9 @@ class ProdJob:
             # Extract PadmeReco final summary information
             if re.match("^RecoInfo - .*$",line):
 
+                # Events of all PadmeReco instances of multicore jobs are added up
                 r = re.match("^.*Processed Events\s+(\d+)\s*$",line)
-                if r: reco_processed_events = r.group(1)
+                if r: reco_processed_events = str(int(reco_processed_events or "0")+int(r.group(1)))
 
                 r = re.match("^.*Total CPU time\s+(\S+)\s+s*$",line)
                 if r: reco_tot_cpu_time = r.group(1)
@@ -541,20 +656,46 @@ class ProdJob:
             # Extract PadmeMC final summary information
             if re.match("^PadmeMCInfo - .*$",line):
 
+                # Events of all PadmeMC instances of multicore jobs are added up
                 r = re.match("^.*Total Events\s+(\d+)\s*$",line)
-                if r: mc_processed_events = r.group(1)
+                if r: mc_processed_events = str(int(mc_processed_events or "0")+int(r.group(1)))
 
-            # Extract info about produced output file(s)
-            r = re.match("^(.*) file (.*) with size (.*) and adler32 (.*) copied.*$",line)
+            # Extract info about produced output file(s) and storage endpoint where they were copied (if reported)
+            r = re.match("^(.*) file (.*) with size (.*) and adler32 (\S*) copied( to (\S+))?.*$",line)
             if r:
                 file_type = r.group(1)
                 file_name = r.group(2)
                 file_size = int(r.group(3))
                 file_adler32 = r.group(4)
-                file_list.append((file_type,file_name,file_size,file_adler32))
+                file_storage_uri = r.group(6)
+                file_list.append((file_type,file_name,file_size,file_adler32,file_storage_uri))
+
+            # Extract resource usage and duration of job phases
+            r = re.match("^Resource usage CPU min (\S+) % avg (\S+) % max (\S+) %\s*$",line)
+            if r:
+                resources["cpu_min"] = float(r.group(1))
+                resources["cpu_avg"] = float(r.group(2))
+                resources["cpu_max"] = float(r.group(3))
+
+            r = re.match("^Resource usage peak RSS (\d+) bytes\s*$",line)
+            if r: resources["rss_peak"] = int(r.group(1))
+
+            r = re.match("^Resource usage read (\d+) bytes written (\d+) bytes\s*$",line)
+            if r:
+                resources["read_bytes"] = int(r.group(1))
+                resources["write_bytes"] = int(r.group(2))
+
+            r = re.match("^Phase (\S+) time (\S+) s\s*$",line)
+            if r: phases[r.group(1)] = float(r.group(2))
 
         jof.close()
 
+        return self.record_job_info(worker_node,wn_user,wn_dir,time_start,time_end,prog_start,prog_end,reco_processed_events,mc_processed_events,file_list,resources,phases)
+
+    def record_job_info(self,worker_node,wn_user,wn_dir,time_start,time_end,prog_start,prog_end,reco_processed_events,mc_processed_events,file_list,resources,phases):
+
+        # Show job information and write it to DB
+
         if worker_node:
             print "  Job run on worker node %s"%worker_node
             self.db.set_job_worker_node(self.job_sub_id,worker_node)
@@ -593,9 +734,26 @@ class ProdJob:
 
         if file_list:
             self.db.set_job_n_files(self.job_id,str(len(file_list)))
-            for (file_type,file_name,file_size,file_adler32) in file_list:
+            # Only jobs with registered input files (reconstruction and merge) link them to their outputs
+            has_lineage = self.db.job_has_lineage(self.job_id)
+            for (file_type,file_name,file_size,file_adler32,file_storage_uri) in file_list:
                 print "\t%s file %s with size %s adler32 %s"%(file_type,file_name,file_size,file_adler32)
-                self.db.create_job_file(self.job_id,file_name,file_type,0,0,file_size,file_adler32)
+                if file_storage_uri: print "\t\tstored on %s"%file_storage_uri
+                # Output files of the PadmeReco instances of multicore jobs are numbered after the instance
+                seq_n = 0
+                r = re.match("^.*_c(\d+)_reco\.root$",file_name)
+                if r: seq_n = int(r.group(1))
+                file_id = self.db.create_job_file(self.job_id,file_name,file_type,seq_n,0,file_size,file_adler32,file_storage_uri)
+                if has_lineage and file_id: self.db.set_lineage_output(self.job_id,seq_n,file_id)
+
+        if resources:
+            print "  Job CPU usage min %s%% avg %s%% max %s%%"%(resources.get("cpu_min"),resources.get("cpu_avg"),resources.get("cpu_max"))
+            print "  Job peak RSS %s bytes - read %s bytes - written %s bytes"%(resources.get("rss_peak"),resources.get("read_bytes"),resources.get("write_bytes"))
+            self.db.set_job_resources(self.job_sub_id,resources.get("cpu_min"),resources.get("cpu_avg"),resources.get("cpu_max"),resources.get("rss_peak"),resources.get("read_bytes"),resources.get("write_bytes"))
+
+        if phases:
+            print "  Job phases setup %s s - run %s s - checksum %s s - upload %s s"%(phases.get("setup"),phases.get("run"),phases.get("checksum"),phases.get("upload"))
+            self.db.set_job_phase_times(self.job_sub_id,phases.get("setup"),phases.get("run"),phases.get("checksum"),phases.get("upload"))
 
         return True
 
@@ -603,7 +761,7 @@ class ProdJob:
 
         n_errors = 0
 
-        jef = open(err_file,"r")
+        jef = self.open_log_file(err_file)
         for line in jef:
 
             # Trap errors of final gfal-copy
@@ -0,0 +1,91 @@
+#!/usr/bin/python
+
+import os
+import re
+
+class ProdLayout:
+
+    # Directory layout of a production
+    #
+    # Job directories are grouped in shards of JOBS_PER_SHARD jobs to avoid
+    # directories with tens of thousands of entries:
+    #
+    #   <prod_dir>/jobs/NN/jobNNNNN
+    #
+    # Productions created before sharding was introduced use a flat layout
+    # (<prod_dir>/jobNNNNN): all lookup and listing methods handle both.
+
+    # Max number of jobs in a production and number of jobs in each shard
+    NJOBS_MAX = 100000
+    JOBS_PER_SHARD = 1000
+
+    # Name of top directory holding all shards
+    JOBS_DIR = "jobs"
+
+    def __init__(self,prod_dir):
+
+        # Production directory (relative to top production manager directory)
+        self.prod_dir = prod_dir
+
+        self.job_name_re = re.compile("^job\d+$")
+        self.shard_re = re.compile("^\d+$")
+
+    def job_name(self,index):
+
+        return "job%05d"%index
+
+    def job_index(self,job_name):
+
+        r = re.match("^job(\d+)$",job_name)
+        if r: return int(r.group(1))
+        return -1
+
+    def shard_name(self,index):
+
+        return "%02d"%(index/self.JOBS_PER_SHARD)
+
+    def job_local_dir(self,index):
+
+        # Path of job directory relative to production directory (stored as job_dir in the DB)
+        return "%s/%s/%s"%(self.JOBS_DIR,self.shard_name(index),self.job_name(index))
+
+    def job_dir(self,index):
+
+        return "%s/%s"%(self.prod_dir,self.job_local_dir(index))
+
+    def create_job_dir(self,index):
+
+        # Create job directory, creating its shard directory when needed. Return path to job dir
+        shard_dir = "%s/%s/%s"%(self.prod_dir,self.JOBS_DIR,self.shard_name(index))
+        if not os.path.isdir(shard_dir): os.makedirs(shard_dir)
+        job_dir = self.job_dir(index)
+        os.mkdir(job_dir)
+        return job_dir
+
+    def list_job_dirs(self):
+
+        # Generator returning (job_name,job_local_dir) for all job directories found in production
+        # Only one directory is listed at a time so memory stays bounded for very large productions
+        jobs_dir = "%s/%s"%(self.prod_dir,self.JOBS_DIR)
+        if os.path.isdir(jobs_dir):
+            for shard in sorted(os.listdir(jobs_dir)):
+                if not self.shard_re.match(shard): continue
+                for job_name in sorted(os.listdir("%s/%s"%(jobs_dir,shard))):
+                    if self.job_name_re.match(job_name):
+                        yield (job_name,"%s/%s/%s"%(self.JOBS_DIR,shard,job_name))
+
+        # Old flat layout
+        if os.path.isdir(self.prod_dir):
+            for job_name in sorted(os.listdir(self.prod_dir)):
+                if self.job_name_re.match(job_name) and os.path.isdir("%s/%s"%(self.prod_dir,job_name)):
+                    yield (job_name,job_name)
+
+    def find_job_dir(self,job_name):
+
+        # Return path of job directory relative to production directory or "" if not found
+        index = self.job_index(job_name)
+        if index >= 0:
+            local_dir = self.job_local_dir(index)
+            if os.path.isdir("%s/%s"%(self.prod_dir,local_dir)): return local_dir
+        if os.path.isdir("%s/%s"%(self.prod_dir,job_name)): return job_name
+        return ""
@@ -0,0 +1,145 @@
+#!/usr/bin/python
+
+import os
+import time
+import shutil
+import subprocess
+import shlex
+
+class ProdPlan:
+
+    # Planner for production creation
+    #
+    # All actions which modify the local disk, the storage system or the DB
+    # while creating a production go through this class. In normal mode the
+    # actions are executed. In fake (dry-run) mode they are only recorded in
+    # memory so that the full production can be inspected and its cost
+    # (directories, files, bytes, DB rows, grid commands) estimated without
+    # touching anything. In both modes the time spent in each creation phase
+    # is measured and shown in the final report.
+
+    def __init__(self,fake=False,debug=0):
+
+        # If True, do not execute any action: just record it
+        self.fake = fake
+
+        # Set to 1 or more to show recorded actions. 2 or more shows content of generated files
+        self.debug = debug
+
+        # Creation phases as list of [name,start,end]
+        self.phases = []
+
+        # Counters of planned actions
+        self.n_dirs = 0
+        self.n_files = 0
+        self.n_bytes = 0
+        self.db_rows = {}
+        self.db_bytes = 0
+        self.commands = []
+
+        # Content of files generated in fake mode
+        self.files = {}
+
+        # Intermediate directories (jobs dir, shards) already counted
+        self.dirs_seen = set()
+
+    def phase(self,name):
+
+        # Close current phase (if any) and start a new one
+        now = time.time()
+        if self.phases and self.phases[-1][2] == None: self.phases[-1][2] = now
+        self.phases.append([name,now,None])
+
+    def end(self):
+
+        if self.phases and self.phases[-1][2] == None: self.phases[-1][2] = time.time()
+
+    def mkdir(self,path):
+
+        self.n_dirs += 1
+        if self.fake:
+            if self.debug: print "(FAKE) mkdir %s"%path
+            return
+        os.mkdir(path)
+
+    def create_job_dir(self,layout,index):
+
+        # Jobs and shard directories are counted only when they are first created (append mode
+        # can start from any job index and find them already in place)
+        jobs_dir = "%s/%s"%(layout.prod_dir,layout.JOBS_DIR)
+        for path in (jobs_dir,"%s/%s"%(jobs_dir,layout.shard_name(index))):
+            if path in self.dirs_seen: continue
+            self.dirs_seen.add(path)
+            if not os.path.isdir(path): self.n_dirs += 1
+        self.n_dirs += 1
+        if self.fake:
+            if self.debug >= 2: print "(FAKE) mkdir %s"%layout.job_dir(index)
+            return
+        layout.create_job_dir(index)
+
+    def copy_file(self,src,dst,mode=None):
+
+        self.n_files += 1
+        if self.fake:
+            # Source file may not exist yet (e.g. the production proxy)
+            if os.path.isfile(src): self.n_bytes += os.path.getsize(src)
+            if self.debug >= 2: print "(FAKE) copy %s to %s"%(src,dst)
+            return
+        shutil.copyfile(src,dst)
+        if mode != None: os.chmod(dst,mode)
+        self.n_bytes += os.path.getsize(dst)
+
+    def write_file(self,path,content):
+
+        self.n_files += 1
+        self.n_bytes += len(content)
+        if self.fake:
+            self.files[path] = content
+            if self.debug >= 2: print "(FAKE) write %s\n%s"%(path,content)
+            return
+        with open(path,"w") as f: f.write(content)
+
+    def run(self,command):
+
+        # Execute a command modifying the external world. Return its return code (0 in fake mode)
+        self.commands.append(command)
+        if self.fake:
+            if self.debug: print "(FAKE) > %s"%command
+            return 0
+        if self.debug: print "> %s"%command
+        return subprocess.call(shlex.split(command))
+
+    def record(self,command):
+
+        # Record a command which the caller executes by itself (e.g. interactive commands)
+        self.commands.append(command)
+        if self.debug: print "> %s"%command
+
+    def add_db_rows(self,table,n_rows=1,n_bytes=0):
+
+        # Record DB rows which will be created by the production
+        if table in self.db_rows:
+            self.db_rows[table] += n_rows
+        else:
+            self.db_rows[table] = n_rows
+        self.db_bytes += n_bytes
+
+    def report(self):
+
+        self.end()
+        if self.fake:
+            print "=== Production plan (FAKE mode: nothing was created) ==="
+        else:
+            print "=== Production creation report ==="
+        print "- Local directories: %d"%self.n_dirs
+        print "- Local files: %d (%d bytes)"%(self.n_files,self.n_bytes)
+        for table in sorted(self.db_rows.keys()):
+            print "- DB rows in table %s: %d"%(table,self.db_rows[table])
+        print "- DB payload: %d bytes"%self.db_bytes
+        print "- Grid/storage commands: %d"%len(self.commands)
+        for command in self.commands: print "  > %s"%command
+        total = 0.
+        for (name,start,end) in self.phases:
+            print "- Phase %-20s %8.3f s"%(name,end-start)
+            total += end-start
+        print "- Total creation time %16.3f s"%total
@@ -0,0 +1,73 @@
+#!/usr/bin/python
+
+class RunSites:
+
+    # Location of the rawdata of a run and choice of its submission site
+    #
+    # Each storage site may hold a replica of the rawdata files of a run. The
+    # listings of the storage sites, taken from a ListingCache, tell which
+    # files have a complete replica on each of them. A computing site is local
+    # to a storage site if its CE nodes belong to the domain of that storage.
+    # When no submission site is given, the reconstruction of a run is sent
+    # to the site whose local storage holds most of the run data.
+
+    # Storage site local to each computing site, identified by the domain of its CE nodes
+    LOCAL_STORAGE = {
+        "lnf.infn.it":     "LNF",
+        "cr.cnaf.infn.it": "CNAF"
+    }
+
+    def __init__(self,listing_cache,srm_uri,replica_sites):
+
+        # Cache used to list rawdata directories on the storage sites
+        self.lc = listing_cache
+
+        # SRM URI of each storage site
+        self.srm_uri = srm_uri
+
+        # Storage sites which can hold replicas of rawdata files, in order of preference
+        self.replica_sites = replica_sites
+
+    def local_storage(self,ce):
+
+        # Return storage site local to a CE or "" if the CE has no local storage
+        # CE can be given as a node name or as a full <node>:<port>/<queue> endpoint
+        host = ce.split("/")[0].split(":")[0]
+        for domain in self.LOCAL_STORAGE.keys():
+            if host.endswith(".%s"%domain): return self.LOCAL_STORAGE[domain]
+        return ""
+
+    def run_replicas(self,year,run,file_list):
+
+        # Return dictionary file_name -> list of storage sites (in order of preference) holding a complete replica of the file
+        # The rawdata dir of each site is listed first (cached and shared by all runs of the year) to avoid listing missing runs
+        replicas = dict([ (name,[]) for (name,size) in file_list ])
+        for site in self.replica_sites:
+            year_listing = self.lc.list(self.srm_uri[site],"/daq/%s/rawdata"%year)
+            if year_listing == None:
+                print "WARNING unable to list rawdata on storage site %s: replicas there will not be used"%site
+                continue
+            if not run in [ name for (name,size,mtime,is_dir) in year_listing if is_dir ]: continue
+            listing = self.lc.list(self.srm_uri[site],"/daq/%s/rawdata/%s"%(year,run))
+            if listing == None:
+                print "WARNING unable to list run %s on storage site %s: replicas there will not be used"%(run,site)
+                continue
+            sizes = dict([ (name,size) for (name,size,mtime,is_dir) in listing if not is_dir ])
+            for (name,size) in file_list:
+                # Files with a different size are still being copied: do not use them
+                if name in sizes and (size == None or sizes[name] == None or sizes[name] == size):
+                    replicas[name].append(site)
+        return replicas
+
+    def choose_site(self,ce_nodes,file_list,replicas,default_site):
+
+        # Return the submission site (from dictionary site -> CE) whose local storage holds most of the data
+        # in file_list, using the replicas found by run_replicas. Use default_site if no site holds any data
+        site_bytes = {}
+        for site in ce_nodes.keys():
+            local = self.local_storage(ce_nodes[site])
+            site_bytes[site] = sum([ size for (f,size) in file_list if size and local and local in replicas[f] ])
+        run_site = default_site
+        for site in sorted(site_bytes.keys()):
+            if site_bytes[site] > site_bytes.get(run_site,0): run_site = site
+        return run_site
@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+import re
+import hashlib
+import struct
+
+class SeedService:
+
+    # Counter-based generator of random seed pairs for MC jobs
+    #
+    # Seed pair number N of a production is obtained from the first 8 bytes of
+    # SHA256("<seed_key>:<N>") so that:
+    #  - the same seed key always produces the same sequence of seed pairs
+    #  - each seed pair can be computed independently of all the others
+    #
+    # Uniqueness is guaranteed by checking all candidate pairs against the seed
+    # table of PadmeMCDB, which holds all seed pairs ever used by MC productions.
+    # Pairs already in use are skipped and replaced by the next ones in sequence.
+
+    # Seeds are 32 bit unsigned integers
+    SEED_MAX = 4294967295
+
+    # Max number of candidate pairs generated for each requested pair before giving up
+    MAX_TRIALS = 10
+
+    def __init__(self,seed_key,db):
+
+        # Key (normally the production name) used to generate the seed sequence
+        self.seed_key = seed_key
+
+        # Handler to PadmeMCDB
+        self.db = db
+
+    def seed_pair(self,counter):
+
+        h = hashlib.sha256("%s:%d"%(self.seed_key,counter)).digest()
+        return struct.unpack(">II",h[:8])
+
+    def segment_pair(self,pair,segment):
+
+        # Seed pair used by a segment of a segmented MC job, derived from the seed pair of the job
+        # N.B. the worker script derives the same pairs: the two algorithms must be kept in sync
+        if segment == 0: return pair
+        h = hashlib.sha256("%d,%d:%d"%(pair[0],pair[1],segment)).digest()
+        return struct.unpack(">II",h[:8])
+
+    def seed_pairs(self,first,n):
+
+        return [ self.seed_pair(counter) for counter in range(first,first+n) ]
+
+    def generate(self,n_pairs):
+
+        # Return a list of n_pairs seed pairs not yet used by any production or None if they cannot be found
+        seeds = []
+        seen = set()
+        counter = 0
+        while len(seeds) < n_pairs:
+            if counter >= self.MAX_TRIALS*n_pairs: return None
+            n_new = n_pairs-len(seeds)
+            candidates = self.seed_pairs(counter,n_new)
+            counter += n_new
+            used = self.db.get_used_seeds(candidates)
+            if used == None: return None
+            for pair in candidates:
+                if pair in used or pair in seen: continue
+                seen.add(pair)
+                seeds.append(pair)
+        return seeds
+
+    def check(self,seeds):
+
+        # Return list of seed pairs which are duplicated in the list or already used in the DB or None on DB error
+        bad = []
+        seen = set()
+        for pair in seeds:
+            if pair in seen: bad.append(pair)
+            seen.add(pair)
+        used = self.db.get_used_seeds(seeds)
+        if used == None: return None
+        for pair in seeds:
+            if pair in used and not pair in bad: bad.append(pair)
+        return bad
+
+    def parse(self,seed_str):
+
+        # Convert a "<seed1>,<seed2>" string to a seed pair. Return None if format is wrong
+        r = re.match("^\s*(\d+),(\d+)\s*$",seed_str)
+        if not r: return None
+        pair = (int(r.group(1)),int(r.group(2)))
+        if pair[0] > self.SEED_MAX or pair[1] > self.SEED_MAX: return None
+        return pair
+
+    def format(self,pair):
+
+        return "%d,%d"%pair
@@ -10,19 +10,87 @@ import subprocess
 import shlex
 import select
 import errno
+import zlib
+import hashlib
+import struct
+import gzip
+import collections
+import json
+import multiprocessing
+import shutil
+import threading
 
 PROXY_FILE = ""
 PROXY_RENEW_TIME = 6*3600
 
+# Size of blocks read to compute adler32 checksum of output files
+ADLER32_BLOCK_SIZE = 16*1024*1024
+
+# Max size of chunks of program output copied to the job output streams
+PUMP_CHUNK_SIZE = 64*1024
+
+# Compressed logs holding the full program output, shipped in the output sandbox
+PROG_OUT_LOG = "program.out.gz"
+PROG_ERR_LOG = "program.err.gz"
+LOG_COMPRESS_LEVEL = 6
+
+# Program output lines copied uncompressed to the job output streams (summary lines are parsed by the production daemon)
+LOG_KEEP_RE = re.compile("^(RecoInfo|PadmeMCInfo) - |^.*(\*\*\* ERROR|Error in <|segmentation violation)")
+
+# Number of last lines of program stderr shown uncompressed when problems are found
+LOG_TAIL_LINES = 50
+
+# Machine-readable job summary, shipped in the output sandbox and read by the production daemon
+JOB_SUMMARY_FILE = "job.json"
+JOB_SUMMARY = {}
+
+# Final summary lines of the program, e.g. "RecoInfo - Total CPU time 12.3 s"
+PROG_INFO_RE = re.compile("^(RecoInfo|PadmeMCInfo) - (.*?)\s+(\S+)(\s+s)?\s*$")
+
+# Lock to avoid mixing output lines of concurrent file exports
+PRINT_LOCK = threading.Lock()
+
+# Interval (s) between samples of resource usage of the processes started by the job. Can be changed with PADME_MONITOR_INTERVAL
+MONITOR_INTERVAL = float(os.getenv('PADME_MONITOR_INTERVAL',"30"))
+MONITOR_STOP = threading.Event()
+MONITOR_THREAD = None
+RESOURCES = {}
+
+# Watchdog of running programs: a program whose processes write no output for WATCHDOG_OUTPUT_TIMEOUT seconds or use no
+# CPU time for WATCHDOG_CPU_TIMEOUT seconds is considered hung and is killed. Timeouts can be changed with PADME_WATCHDOG_OUTPUT
+# and PADME_WATCHDOG_CPU (0 disables the check). Checks are done every PADME_WATCHDOG_INTERVAL seconds
+WATCHDOG_OUTPUT_TIMEOUT = float(os.getenv('PADME_WATCHDOG_OUTPUT',"7200"))
+WATCHDOG_CPU_TIMEOUT = float(os.getenv('PADME_WATCHDOG_CPU',"1800"))
+WATCHDOG_INTERVAL = float(os.getenv('PADME_WATCHDOG_INTERVAL',"60"))
+WATCHDOG_FIRED = threading.Event()
+
+# Exit code of jobs whose program was killed by the watchdog (used by the production daemon to classify the failure)
+WATCHDOG_EXIT_CODE = 3
+
+# Upload of output files: each storage endpoint is tried UPLOAD_TRIES times, pausing UPLOAD_BACKOFF seconds (doubled at each
+# retry) between attempts, before failing over to the next endpoint. Can be changed with PADME_UPLOAD_TRIES and PADME_UPLOAD_BACKOFF
+UPLOAD_TRIES = int(os.getenv('PADME_UPLOAD_TRIES',"3"))
+UPLOAD_BACKOFF = float(os.getenv('PADME_UPLOAD_BACKOFF',"30"))
+
 def now_str():
 
     return time.strftime("%Y-%m-%d %H:%M:%S",time.gmtime())
 
 def get_adler32(outfile):
 
-    adler_cmd = "adler32 %s"%outfile
-    p = subprocess.Popen(shlex.split(adler_cmd),stdin=None,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    return p.communicate()[0].strip()
+    # Compute adler32 checksum of file reading it in large blocks (file was just written: usually in page cache)
+    # N.B. checksum cannot be computed while the program writes the file as ROOT rewrites parts of it when closing
+    adler = 1
+    try:
+        with open(outfile,"rb") as f:
+            while True:
+                buf = f.read(ADLER32_BLOCK_SIZE)
+                if not buf: break
+                adler = zlib.adler32(buf,adler)
+    except IOError as e:
+        print "WARNING - Unable to compute adler32 checksum of %s: %s"%(outfile,e)
+        return ""
+    return "%08x"%(adler & 0xffffffff)
 
 def renew_proxy_handler(signum,frame):
 
@@ -37,55 +105,576 @@ def renew_proxy_handler(signum,frame):
     # Reset alarm
     signal.alarm(PROXY_RENEW_TIME)
 
-def export_file(src_url,dst_url):
+def log(msg):
+
+    # Print a message from any thread without mixing it with other messages
+    with PRINT_LOCK:
+        print msg
+        sys.stdout.flush()
+
+def write_summary():
+
+    # Write job summary to a temporary file and rename it so that a truncated summary is never shipped
+    tmp_file = "%s.tmp"%JOB_SUMMARY_FILE
+    with open(tmp_file,"w") as sf: json.dump(JOB_SUMMARY,sf,indent=1,sort_keys=True)
+    os.rename(tmp_file,JOB_SUMMARY_FILE)
+
+def read_proc_stat(pid):
+
+    # Return (parent pid,CPU time in clock ticks,resident memory in pages) of process pid or None if process is gone
+    try:
+        with open("/proc/%d/stat"%pid,"r") as f: stat = f.read()
+    except IOError:
+        return None
+    # Process name (2nd field) can contain spaces: fields are counted from the end of the name
+    fields = stat[stat.rfind(")")+2:].split()
+    return (int(fields[1]),int(fields[11])+int(fields[12]),int(fields[21]))
+
+def read_proc_io(pid):
+
+    # Return (bytes read,bytes written) by process pid from/to storage devices. Counters are not available on all systems
+    io = {}
+    try:
+        with open("/proc/%d/io"%pid,"r") as f:
+            for l in f:
+                (key,value) = l.split(":")
+                io[key] = int(value)
+    except (IOError,ValueError):
+        return (0,0)
+    return (io.get("read_bytes",0),io.get("write_bytes",0))
+
+def process_tree(root_pid):
+
+    # Return dictionary pid -> (parent pid,CPU time in clock ticks,resident memory in pages) of process root_pid and all its descendants
+    procs = {}
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit(): continue
+        stat = read_proc_stat(int(entry))
+        if stat:
+            procs[int(entry)] = stat
+            children.setdefault(stat[0],[]).append(int(entry))
+    tree = {}
+    todo = [ root_pid ]
+    while todo:
+        pid = todo.pop()
+        if pid in procs: tree[pid] = procs[pid]
+        todo.extend(children.get(pid,[]))
+    return tree
+
+def read_proc_state(pid):
+
+    # Return (state,wait channel,command line) of process pid. Missing values are shown as "?"
+    state = "?"
+    wchan = "?"
+    cmdline = "?"
+    try:
+        with open("/proc/%d/status"%pid,"r") as f:
+            for l in f:
+                if l.startswith("State:"):
+                    state = l.split(":",1)[1].strip()
+                    break
+        with open("/proc/%d/wchan"%pid,"r") as f: wchan = f.read().strip() or "0"
+        with open("/proc/%d/cmdline"%pid,"r") as f: cmdline = f.read().replace("\0"," ").strip()
+    except IOError:
+        pass
+    return (state,wchan,cmdline)
+
+def watchdog_kill(p):
+
+    # Kill a hung program with all its descendants and return the state of its processes just before the kill
+    # All processes are stopped before killing them so that none can start new processes or be reparented in between
+    tree = process_tree(p.pid)
+    procs = []
+    for pid in sorted(tree.keys()):
+        (state,wchan,cmdline) = read_proc_state(pid)
+        procs.append({ "pid": pid, "ppid": tree[pid][0], "cpu_ticks": tree[pid][1], "state": state, "wchan": wchan, "cmdline": cmdline })
+    for pid in tree:
+        try:
+            os.kill(pid,signal.SIGSTOP)
+        except OSError:
+            pass
+    for pid in tree:
+        try:
+            os.kill(pid,signal.SIGKILL)
+        except OSError:
+            pass
+    WATCHDOG_FIRED.set()
+    return procs
+
+def monitor_processes():
+
+    # Sample resource usage of all processes started by the job every MONITOR_INTERVAL seconds until MONITOR_STOP is set
+    # CPU usage is computed from the CPU time used by each process since the previous sample (100% = one core)
+    # I/O counters of processes which ended are kept at their last sampled values
+    hz = float(os.sysconf("SC_CLK_TCK"))
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    job_pid = os.getpid()
+    last_ticks = {}
+    last_io = {}
+    cpu_sum = 0.
+    t_last = time.time()
+    while not MONITOR_STOP.wait(MONITOR_INTERVAL):
+
+        # Tree of processes descending from the job (the job itself is not included)
+        tree = process_tree(job_pid)
+        tree.pop(job_pid,None)
+
+        t_now = time.time()
+        ticks = 0
+        rss = 0
+        for pid in tree:
+            (ppid,cpu_ticks,rss_pages) = tree[pid]
+            ticks += cpu_ticks-last_ticks.get(pid,0)
+            last_ticks[pid] = cpu_ticks
+            rss += rss_pages*page_size
+            last_io[pid] = read_proc_io(pid)
+        cpu = 100.*ticks/hz/max(t_now-t_last,0.001)
+        t_last = t_now
+
+        RESOURCES["samples"] += 1
+        cpu_sum += cpu
+        RESOURCES["cpu_min"] = round(min(RESOURCES.get("cpu_min",cpu),cpu),1)
+        RESOURCES["cpu_max"] = round(max(RESOURCES.get("cpu_max",cpu),cpu),1)
+        RESOURCES["cpu_avg"] = round(cpu_sum/RESOURCES["samples"],1)
+        RESOURCES["rss_peak"] = max(RESOURCES["rss_peak"],rss)
+        RESOURCES["read_bytes"] = sum([ r for (r,w) in last_io.values() ])
+        RESOURCES["write_bytes"] = sum([ w for (r,w) in last_io.values() ])
+
+def start_monitor():
+
+    global MONITOR_THREAD
+
+    # Run resource monitor in background. Thread is a daemon so that it never prevents the job from ending
+    RESOURCES.update({ "interval": MONITOR_INTERVAL, "samples": 0, "rss_peak": 0, "read_bytes": 0, "write_bytes": 0 })
+    MONITOR_THREAD = threading.Thread(target=monitor_processes)
+    MONITOR_THREAD.daemon = True
+    MONITOR_THREAD.start()
+
+def report_usage():
+
+    # Stop resource monitor and show resource usage and duration of job phases in job output and job summary
+    # Checksum and upload times are the total over all output files
+    # Output line formats are parsed by the production daemon: do not change them
+    if MONITOR_THREAD == None: return
+    MONITOR_STOP.set()
+    MONITOR_THREAD.join(MONITOR_INTERVAL)
+    phases = JOB_SUMMARY["phases"]
+    phases["checksum"] = round(sum([ f.get("checksum_time",0.) for f in JOB_SUMMARY["files"] ]),3)
+    phases["upload"] = round(sum([ f["transfer_time"] for f in JOB_SUMMARY["files"] ]),3)
+    JOB_SUMMARY["resources"] = dict(RESOURCES)
+    print "--- Resource usage ---"
+    print "Resource usage samples %d every %.1f s"%(RESOURCES["samples"],MONITOR_INTERVAL)
+    if RESOURCES["samples"]:
+        print "Resource usage CPU min %.1f %% avg %.1f %% max %.1f %%"%(RESOURCES["cpu_min"],RESOURCES["cpu_avg"],RESOURCES["cpu_max"])
+        print "Resource usage peak RSS %d bytes"%RESOURCES["rss_peak"]
+        print "Resource usage read %d bytes written %d bytes"%(RESOURCES["read_bytes"],RESOURCES["write_bytes"])
+    for phase in ("setup","run","checksum","upload"):
+        if phase in phases: print "Phase %s time %.3f s"%(phase,phases[phase])
+    sys.stdout.flush()
+
+def pump_output(p,line_check=None,log_dir=".",info=None):
+
+    # Append stdout and stderr of process p to compressed log files in log_dir in large chunks as soon as data is available
+    # Values found in program summary lines are stored in info (default: program_info of the job summary)
+    # Complete lines matching LOG_KEEP_RE, or lines of stderr for which line_check (if given) returns True, are
+    # also copied uncompressed to our own stdout and stderr. If problems are found or the program fails, the last
+    # lines of its stderr are shown as well. Streams are drained until EOF so no output is lost when the process ends.
+    # If the watchdog finds the program hung, it is killed and the state of its processes is shown with its last output lines.
+    # Return True if problems were found
+    if info == None: info = JOB_SUMMARY.setdefault("program_info",{})
+    problems = False
+    out_fd = p.stdout.fileno()
+    err_fd = p.stderr.fileno()
+    targets = { out_fd: sys.stdout, err_fd: sys.stderr }
+    logs = { out_fd: gzip.open("%s/%s"%(log_dir,PROG_OUT_LOG),"ab",LOG_COMPRESS_LEVEL), err_fd: gzip.open("%s/%s"%(log_dir,PROG_ERR_LOG),"ab",LOG_COMPRESS_LEVEL) }
+    partial = { out_fd: "", err_fd: "" }
+    err_tail = collections.deque([],LOG_TAIL_LINES)
+    out_tail = collections.deque([],LOG_TAIL_LINES)
+    streams = [ out_fd, err_fd ]
+    t_output = time.time()
+    t_cpu = t_output
+    t_check = t_output
+    cpu_ticks = None
+    hung = None
+    while streams:
+
+        # Check if program is hung: no output or no CPU time used by any of its processes for too long
+        now = time.time()
+        if hung != None and now-t_check >= WATCHDOG_INTERVAL:
+            # Streams are still open after the kill (some process escaped from the tree): stop waiting for them
+            break
+        elif hung == None and now-t_check >= WATCHDOG_INTERVAL:
+            t_check = now
+            if WATCHDOG_CPU_TIMEOUT:
+                ticks = sum([ stat[1] for stat in process_tree(p.pid).values() ])
+                if ticks != cpu_ticks:
+                    cpu_ticks = ticks
+                    t_cpu = now
+            if WATCHDOG_OUTPUT_TIMEOUT and now-t_output >= WATCHDOG_OUTPUT_TIMEOUT:
+                hung = "no output for %d s"%(now-t_output)
+            elif WATCHDOG_CPU_TIMEOUT and now-t_cpu >= WATCHDOG_CPU_TIMEOUT:
+                hung = "no CPU time used for %d s"%(now-t_cpu)
+            if hung:
+                procs = watchdog_kill(p)
+                JOB_SUMMARY.setdefault("watchdog",[]).append({ "run_dir": log_dir, "reason": hung, "time": now_str(), "processes": procs })
+                problems = True
+
+        # Trap "Interrupted system call" error (happens when proxy is renewed)
+        try:
+            ret = select.select(streams,[],[],WATCHDOG_INTERVAL)
+        except select.error as ex:
+            if ex[0] == errno.EINTR:
+                continue
+            else:
+                raise
+
+        for fd in ret[0]:
+            try:
+                chunk = os.read(fd,PUMP_CHUNK_SIZE)
+            except OSError as ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                else:
+                    raise
+            if chunk:
+                t_output = time.time()
+                logs[fd].write(chunk)
+                lines = (partial[fd]+chunk).split("\n")
+                partial[fd] = lines.pop()
+            else:
+                # End of stream: handle last incomplete line, if any
+                lines = [ partial[fd] ] if partial[fd] else []
+                streams.remove(fd)
+            for line in lines:
+                problem = fd == err_fd and line_check != None and line_check(line)
+                if problem: problems = True
+                if problem or LOG_KEEP_RE.match(line): targets[fd].write(line+"\n")
+                if fd == out_fd:
+                    r = PROG_INFO_RE.match(line)
+                    if r: info[r.group(2)] = r.group(3)
+                if fd == err_fd: err_tail.append(line)
+                if fd == out_fd: out_tail.append(line)
+
+    logs[out_fd].close()
+    logs[err_fd].close()
+    p.wait()
+    if hung:
+        with PRINT_LOCK:
+            print "WARNING Program in %s killed by watchdog: %s"%(log_dir,hung)
+            sys.stderr.write("--- Watchdog: program in %s killed (%s). State of its processes before the kill ---\n"%(log_dir,hung))
+            for proc in procs: sys.stderr.write("pid %(pid)d ppid %(ppid)d state %(state)s wchan %(wchan)s cmd %(cmdline)s\n"%proc)
+            sys.stderr.write("--- Last %d lines of program output stream ---\n"%len(out_tail))
+            for line in out_tail: sys.stderr.write(line+"\n")
+    if (problems or p.returncode != 0) and err_tail:
+        sys.stderr.write("--- Last %d lines of program error stream (full log in %s) ---\n"%(len(err_tail),os.path.normpath("%s/%s"%(log_dir,PROG_ERR_LOG))))
+        for line in err_tail: sys.stderr.write(line+"\n")
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return problems
+
+def run_instance(cmd,run_dir,line_check,result):
+
+    # Run one program instance in run_dir (where its compressed logs are written) and store its outcome in result
+    # All file descriptors are closed in the child so that concurrent instances do not keep each other's pipes open
+    p = subprocess.Popen(shlex.split(cmd),cwd=run_dir,stdout=subprocess.PIPE,stderr=subprocess.PIPE,close_fds=True)
+    result["run_problems"] = pump_output(p,line_check,run_dir,result["program_info"])
+    result["exit_code"] = p.returncode
+
+def run_instances(instances,line_check=None):
+
+    # Run program instances concurrently, one thread each. instances is a list of (run_dir,command)
+    # Return list of results as dictionaries with run_dir, exit_code, run_problems and program_info
+    results = []
+    threads = []
+    for (run_dir,cmd) in instances:
+        result = { "run_dir": run_dir, "exit_code": -1, "run_problems": False, "program_info": {} }
+        t = threading.Thread(target=run_instance,args=(cmd,run_dir,line_check,result))
+        t.start()
+        results.append(result)
+        threads.append(t)
+
+    # Join with a timeout so that the proxy renewal signal can still be handled
+    for t in threads:
+        while t.is_alive(): t.join(1.)
+    return results
+
+def merge_logs(run_dirs):
+
+    # Concatenate compressed logs of all instances into the job logs (a sequence of gzip members is a valid gzip file)
+    for log_file in (PROG_OUT_LOG,PROG_ERR_LOG):
+        with open(log_file,"wb") as lf:
+            for run_dir in run_dirs:
+                with open("%s/%s"%(run_dir,log_file),"rb") as rf: shutil.copyfileobj(rf,lf)
+
+def segment_seeds(seed_pair,segment):
+
+    # Return seed pair used by a segment of a segmented job. First segment uses the seed pair of the job
+    # N.B. must give the same pairs as SeedService.segment_pair, used to register them in the DB
+    if segment == 0: return seed_pair
+    h = hashlib.sha256("%d,%d:%d"%(int(seed_pair[0]),int(seed_pair[1]),segment)).digest()
+    return struct.unpack(">II",h[:8])
+
+def split_macro(macro_file,n_segments):
+
+    # Write one macro per segment with the events of the /run/beamOn command of macro_file split among segments
+    # Return list of (segment macro file,number of events) or None if macro does not have exactly one /run/beamOn command
+    with open(macro_file,"r") as mf: lines = mf.readlines()
+    beam_on = [ i for i in range(len(lines)) if re.match("^\s*/run/beamOn\s+\d+\s*$",lines[i]) ]
+    if len(beam_on) != 1: return None
+    n_events = int(lines[beam_on[0]].split()[1])
+    segments = []
+    for s in range(n_segments):
+        segment_events = n_events//n_segments
+        if s < n_events%n_segments: segment_events += 1
+        lines[beam_on[0]] = "/run/beamOn %d\n"%segment_events
+        segment_macro = "%s_s%03d.mac"%(os.path.splitext(macro_file)[0],s)
+        with open(segment_macro,"w") as sf: sf.writelines(lines)
+        segments.append((segment_macro,segment_events))
+    return segments
+
+def list_stored_files(dir_url):
+
+    # Return dictionary with the size of all files in storage directory dir_url or None if directory cannot be listed
+    ls_cmd = "gfal-ls -l %s"%dir_url
+    log("> %s"%ls_cmd)
+    p = subprocess.Popen(shlex.split(ls_cmd),stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    (out,err) = p.communicate()
+    if p.returncode != 0:
+        log("WARNING - gfal-ls returned error status %d: %s"%(p.returncode,err.strip()))
+        return None
+    stored = {}
+    for line in out.splitlines():
+        # Long format: <mode> <nlink> <uid> <gid> <size> <month> <day> <time|year> <name>
+        fields = line.split()
+        if len(fields) >= 9 and fields[4].isdigit(): stored[os.path.basename(fields[-1])] = int(fields[4])
+    return stored
+
+def report_stored_file(endpoint,dst_path,dst_file,size,file_type):
+
+    # Report a file stored on endpoint by a previous submission of the job as if it was copied by this one
+    # Outcome line format ("<file_type> file ... copied to <endpoint>") is parsed by the production daemon: do not change it
+    dst_url = "%s%s"%(endpoint,dst_path)
+    sum_cmd = "gfal-sum %s ADLER32"%dst_url
+    log("> %s"%sum_cmd)
+    p = subprocess.Popen(shlex.split(sum_cmd),stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    (out,err) = p.communicate()
+    adler32 = ""
+    if p.returncode == 0 and out.split():
+        adler32 = out.split()[-1]
+    else:
+        log("WARNING - Unable to get adler32 checksum of %s"%dst_url)
+    JOB_SUMMARY["files"].append({
+        "type": file_type,
+        "name": dst_file,
+        "size": size,
+        "adler32": adler32,
+        "url": dst_url,
+        "storage_uri": endpoint,
+        "transfer_time": 0.,
+        "copied": True,
+        "previous_submission": True
+    })
+    log("%s file %s with size %s and adler32 %s copied to %s"%(file_type,dst_file,size,adler32,endpoint))
+
+def store_segment_file(src_url,dst_url,adler32=""):
+
+    # Copy output file of a segment to a temporary name and rename it only when the copy is complete, so that a file
+    # with the final name is never truncated even if the job is killed during the transfer. The file of a segment
+    # which is simulated again (its other files were not stored by the previous submission) is replaced
+    log("Copying %s to %s"%(src_url,dst_url))
+    part_url = "%s.part"%dst_url
+    if adler32:
+        copy_cmd = "gfal-copy -f -K ADLER32:%s %s %s"%(adler32,src_url,part_url)
+    else:
+        copy_cmd = "gfal-copy -f %s %s"%(src_url,part_url)
+    log("> %s"%copy_cmd)
+    p = subprocess.Popen(shlex.split(copy_cmd),stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    (out,err) = p.communicate()
+    if p.returncode != 0:
+        sys.stderr.write(err)
+        return p.returncode
+    rename_cmd = "gfal-rename %s %s"%(part_url,dst_url)
+    log("> %s"%rename_cmd)
+    rc = subprocess.call(rename_cmd.split())
+    if rc != 0:
+        log("WARNING - File %s exists. Replacing it."%dst_url)
+        rm_cmd = "gfal-rm %s"%dst_url
+        log("> %s"%rm_cmd)
+        subprocess.call(rm_cmd.split())
+        log("> %s"%rename_cmd)
+        rc = subprocess.call(rename_cmd.split())
+    return rc
+
+def export_file(src_url,dst_url,adler32=""):
 
-    print "Copying",src_url,"to",dst_url
+    log("Copying %s to %s"%(src_url,dst_url))
 
     # Check if destination file already exists and rename it
-    # This can happen if job log retrieval fails after the job
-    # has successfully completed
+    # This can happen if job log retrieval fails after the job has successfully completed
+    # Only if the file exists the destination directory is listed once to find the first free backup name
     stat_cmd = "gfal-stat %s"%dst_url
-    print ">",stat_cmd
-    rc = subprocess.call(stat_cmd.split())
-    if rc == 0:
-        print "WARNING - File %s exists. Attempting to rename it."%dst_url
-        idx = 0
-        while idx<100:
-            new_url = "%s.%02d"%(dst_url,idx)
-            rename_cmd = "gfal-rename %s %s"%(dst_url,new_url)
-            print ">",rename_cmd
-            rc = subprocess.call(rename_cmd.split())
-            if rc == 0:
-                # Rename succeeded: we can proceed with the copy
-                print "WARNING - Existing file renamed to %s"%new_url
-                break
-            # Rename failed: file already exists. Try next index
-            idx += 1
-            if idx == 100:
-                print "ERROR - File %s - Too many copies. Cannot rename existing file."%dst_url
-                return 1
-
-    copy_cmd = "gfal-copy %s %s"%(src_url,dst_url)
-    print ">",copy_cmd
+    log("> %s"%stat_cmd)
+    p = subprocess.Popen(shlex.split(stat_cmd),stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    p.communicate()
+    if p.returncode == 0:
+        log("WARNING - File %s exists. Attempting to rename it."%dst_url)
+        (dir_url,dst_file) = dst_url.rsplit("/",1)
+        stored = list_stored_files(dir_url)
+        if stored == None:
+            log("WARNING - Unable to list %s: trying first backup name"%dir_url)
+            stored = {}
+        free = [ idx for idx in range(100) if not "%s.%02d"%(dst_file,idx) in stored ]
+        if not free:
+            log("ERROR - File %s - Too many copies. Cannot rename existing file."%dst_url)
+            return 1
+        new_url = "%s.%02d"%(dst_url,free[0])
+        rename_cmd = "gfal-rename %s %s"%(dst_url,new_url)
+        log("> %s"%rename_cmd)
+        rc = subprocess.call(rename_cmd.split())
+        if rc != 0:
+            log("ERROR - Unable to rename existing file %s to %s"%(dst_url,new_url))
+            return rc
+        log("WARNING - Existing file renamed to %s"%new_url)
+
+    # If checksum is known, ask gfal-copy to verify it on the destination at the end of the transfer
+    if adler32:
+        copy_cmd = "gfal-copy -K ADLER32:%s %s %s"%(adler32,src_url,dst_url)
+    else:
+        copy_cmd = "gfal-copy %s %s"%(src_url,dst_url)
+    log("> %s"%copy_cmd)
     rc = subprocess.call(copy_cmd.split())
 
     return rc
 
+def upload_file(copy,src_url,dst_path,endpoints,adler32=""):
+
+    # Copy src_url to dst_path (storage directory and file name) on the first storage endpoint which accepts it
+    # copy is the function doing a single copy attempt (export_file or store_segment_file)
+    # Return (return code of last attempt,endpoint used or None if all endpoints failed)
+    rc = 1
+    for endpoint in endpoints:
+        pause = UPLOAD_BACKOFF
+        for n_try in range(UPLOAD_TRIES):
+            if n_try:
+                log("WARNING - Copy to %s failed with error status %d: trying again in %.0f s"%(endpoint,rc,pause))
+                time.sleep(pause)
+                pause *= 2
+            rc = copy(src_url,"%s%s"%(endpoint,dst_path),adler32)
+            if rc == 0: return (0,endpoint)
+        log("WARNING - Unable to copy %s to %s after %d attempts"%(src_url,endpoint,UPLOAD_TRIES))
+    return (rc,None)
+
+def probe_endpoints(endpoints,storage_dir,probe_mb,job_name):
+
+    # Measure upload throughput to each storage endpoint copying a probe file of probe_mb MB to the storage directory
+    # Return endpoints ordered by decreasing throughput. Endpoints where the probe failed follow the others in their original order
+    probe_file = "%s/upload_probe.dat"%os.getcwd()
+    with open(probe_file,"wb") as pf:
+        for i in range(probe_mb): pf.write(os.urandom(1000000))
+    rates = {}
+    for endpoint in endpoints:
+        probe_url = "%s%s/.probe_%s"%(endpoint,storage_dir,job_name)
+        copy_cmd = "gfal-copy -f file://%s %s"%(probe_file,probe_url)
+        log("> %s"%copy_cmd)
+        t_start = time.time()
+        p = subprocess.Popen(shlex.split(copy_cmd),stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        (out,err) = p.communicate()
+        t_copy = time.time()-t_start
+        if p.returncode != 0:
+            log("WARNING - Upload probe of %s failed with error status %d"%(endpoint,p.returncode))
+            continue
+        rates[endpoint] = round(probe_mb/max(t_copy,0.001),2)
+        log("Upload probe of %s: %.2f MB/s"%(endpoint,rates[endpoint]))
+        rm_cmd = "gfal-rm %s"%probe_url
+        log("> %s"%rm_cmd)
+        subprocess.call(rm_cmd.split())
+    os.remove(probe_file)
+    JOB_SUMMARY["upload_probe"] = rates
+    ordered = sorted([ e for e in endpoints if e in rates ],key=lambda e: -rates[e])
+    return ordered+[ e for e in endpoints if not e in rates ]
+
+def export_output(job_dir,src_file,dst_file,dst_path,endpoints,file_type,results,segment=False):
+
+    # Export one output file to the first storage endpoint accepting it, reporting progress, timing and outcome
+    # Output files of segments are stored with a temporary name
+    # Outcome line format ("<file_type> file ... copied to <endpoint>") is parsed by the production daemon: do not change it
+    size = os.path.getsize(src_file)
+    t_start = time.time()
+    adler32 = get_adler32(src_file)
+    t_checksum = time.time()-t_start
+    src_url = "file://%s/%s"%(job_dir,src_file)
+    log("%s transfer of %s (%d bytes) starting at %s (UTC)"%(file_type,src_file,size,now_str()))
+    t_start = time.time()
+    if segment:
+        (rc,endpoint) = upload_file(store_segment_file,src_url,dst_path,endpoints,adler32)
+    else:
+        (rc,endpoint) = upload_file(export_file,src_url,dst_path,endpoints,adler32)
+    t_copy = time.time()-t_start
+    dst_url = "%s%s"%(endpoint or endpoints[0],dst_path)
+    JOB_SUMMARY["files"].append({
+        "type": file_type,
+        "name": dst_file,
+        "size": size,
+        "adler32": adler32,
+        "checksum_time": round(t_checksum,3),
+        "url": dst_url,
+        "storage_uri": endpoint,
+        "transfer_time": round(t_copy,3),
+        "copied": rc == 0
+    })
+    if rc:
+        log("WARNING - gfal-copy returned error status %d"%rc)
+        log("%s transfer of %s failed after %.1f s"%(file_type,src_file,t_copy))
+        results[dst_file] = False
+    else:
+        log("%s transfer of %s completed in %.1f s (%.2f MB/s)"%(file_type,src_file,t_copy,size/1.E6/max(t_copy,0.001)))
+        if adler32: log("Checksum ADLER32:%s verified on %s"%(adler32,dst_url))
+        log("%s file %s with size %s and adler32 %s copied to %s"%(file_type,dst_file,size,adler32,endpoint))
+        results[dst_file] = True
+
 def main(argv):
 
     global PROXY_FILE
     global PROXY_RENEW_TIME
 
+    # Immediately create empty program logs and job summary so that all output sandbox files exist even if the program is never run
+    for log_file in (PROG_OUT_LOG,PROG_ERR_LOG): gzip.open(log_file,"wb").close()
+    write_summary()
+
     # Top CVMFS directory for PadmeMC
     padmemc_cvmfs_dir = "/cvmfs/padme.infn.it/PadmeMC"
 
-    (macro_file,PROXY_FILE,prod_name,job_name,mc_version,storage_dir,srm_uri,rndm_seeds) = argv
+    (macro_file,PROXY_FILE,prod_name,job_name,mc_version,storage_dir,srm_uri,rndm_seeds) = argv[:8]
+
+    # Optional number of sequential segments in which the events of the job are simulated
+    n_segments = 1
+    if len(argv) > 8: n_segments = int(argv[8])
+
+    # Output files are uploaded to the first storage endpoint of the comma-separated list srm_uri which accepts them
+    # Optional size (MB) of a probe file used to order the endpoints by measured upload throughput (0: keep given order)
+    endpoints = srm_uri.split(",")
+    probe_mb = 0
+    if len(argv) > 9: probe_mb = int(argv[9])
 
     job_dir = os.getcwd()
 
+    # Get processor model (useful to troubleshoot variations in execution time)
+    processor = "UNKNOWN"
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo","r") as cpuinfo:
+            for l in cpuinfo:
+                m = re.match("^\s*model name\s+:\s+(.*)$",l)
+                if m:
+                    processor = m.group(1)
+                    break
+
     print "=== PadmeMC Production %s Job %s ==="%(prod_name,job_name)
-    print "Job starting at %s (UTC)"%now_str()
+    time_start = now_str()
+    t_job_start = time.time()
+    print "Job starting at %s (UTC)"%time_start
     print "Job running on node %s as user %s in dir %s"%(os.getenv('HOSTNAME'),os.getenv('USER'),job_dir)
+    print "Processor %s"%processor
 
     print "PadmeMC version %s"%mc_version
     print "SRM server URI %s"%srm_uri
@@ -93,18 +682,44 @@ def main(argv):
     print "MC macro file %s"%macro_file
     print "Proxy file %s"%PROXY_FILE
     print "Random seeds %s"%rndm_seeds
+    if n_segments > 1: print "Segments %d"%n_segments
+    if len(endpoints) > 1: print "Storage endpoints in order of preference %s"%" ".join(endpoints)
+    if probe_mb: print "Upload probe size %d MB"%probe_mb
+
+    # Initial job summary: it is completed while the job runs and written again when the job ends
+    JOB_SUMMARY.update({
+        "prod_name": prod_name,
+        "job_name": job_name,
+        "program": "PadmeMC",
+        "program_version": mc_version,
+        "worker_node": os.getenv('HOSTNAME'),
+        "wn_user": os.getenv('USER'),
+        "wn_dir": job_dir,
+        "processor": processor,
+        "n_cpus": multiprocessing.cpu_count(),
+        "time_start": time_start,
+        "program_info": {},
+        "phases": {},
+        "files": []
+    })
+    write_summary()
+    start_monitor()
 
     # Change permission rights for long-lived proxy (must be 600)
     os.chmod(PROXY_FILE,0600)
 
-    # Extract random seeds
-    r = re.match("(\d+),(\d+)",rndm_seeds)
-    if r:
-        padme_seed1 = r.group(1)
-        padme_seed2 = r.group(2)
-    else:
-        print "ERROR Random string has wrong format: %s"%rndm_seeds
-        exit(2)
+    # Extract random seeds: one pair for each PadmeMC instance, separated by ":"
+    seed_pairs = []
+    for seeds in rndm_seeds.split(":"):
+        r = re.match("(\d+),(\d+)",seeds)
+        if r:
+            seed_pairs.append((r.group(1),r.group(2)))
+        else:
+            print "ERROR Random string has wrong format: %s"%rndm_seeds
+            exit(2)
+    n_cores = len(seed_pairs)
+    JOB_SUMMARY["n_cores"] = n_cores
+    JOB_SUMMARY["n_segments"] = n_segments
 
     # Check if software directory for this version is available on CVMFS (try a few times before giving up)
     padmemc_version_dir = "%s/%s"%(padmemc_cvmfs_dir,mc_version)
@@ -127,6 +742,16 @@ def main(argv):
     padmemc_gdml_dir = "%s/gdml"%padmemc_version_dir
     os.symlink(padmemc_gdml_dir,"gdml")
 
+    # With more than one instance, each one runs in its own directory
+    if n_cores == 1:
+        run_dirs = [ "." ]
+    else:
+        run_dirs = [ "core_%d"%k for k in range(n_cores) ]
+        for run_dir in run_dirs:
+            os.mkdir(run_dir)
+            os.symlink(padmemc_gdml_dir,"%s/gdml"%run_dir)
+        print "Running %d PadmeMC instances"%n_cores
+
     # Enable timer to renew VOMS proxy every 6h
     signal.signal(signal.SIGALRM,renew_proxy_handler)
     signal.alarm(PROXY_RENEW_TIME)
@@ -149,10 +774,10 @@ else
     echo "PADMEMC_EXE = $PADMEMC_EXE"
 fi
 echo "LD_LIBRARY_PATH = $LD_LIBRARY_PATH"
-export PADME_SEED1=%s
-export PADME_SEED2=%s
+export PADME_SEED1=$1
+export PADME_SEED2=$2
 echo "Random seeds: $PADME_SEED1 $PADME_SEED2"
-$PADMEMC_EXE %s
+$PADMEMC_EXE $3
 rc=$?
 if [ $rc -ne 0 ]; then
   echo "*** ERROR *** PadmeMC returned error code $rc"
@@ -162,110 +787,142 @@ ls -l
 date
 echo "--- Ending PADMEMC production ---"
 exit $rc
-"""%(padmemc_init_file,padme_seed1,padme_seed2,macro_file)
+"""%padmemc_init_file
     with open("job.sh","w") as sf: sf.write(script)
 
-    # Run job script sending its output/error to stdout/stderr
-    print "Program starting at %s (UTC)"%now_str()
-    job_cmd = "/bin/bash job.sh"
-    p = subprocess.Popen(shlex.split(job_cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
+    # In segmented mode the events of the job are simulated in sequential segments, each with its own macro,
+    # seeds and output files. Output files of each segment are stored as soon as the segment ends, while the
+    # next segment runs, so that a job killed before its end only loses the segment which was running
+    if n_segments == 1:
+        segments = [ (macro_file,0) ]
+    else:
+        segments = split_macro(macro_file,n_segments)
+        if segments == None:
+            print "ERROR Macro file %s must contain exactly one /run/beamOn command to be split in segments"%macro_file
+            exit(2)
+        print "Running %d segments of %d events per instance"%(n_segments,segments[0][1])
+
+        # Segments stored by a previous submission of this job (on any storage endpoint) are not simulated again
+        # If a file is found on more than one endpoint, the first endpoint in the list is used
+        stored = {}
+        stored_endpoint = {}
+        for endpoint in reversed(endpoints):
+            listing = list_stored_files("%s%s"%(endpoint,storage_dir))
+            if listing == None:
+                print "WARNING Unable to list storage directory on %s: segments stored there will be simulated again"%endpoint
+                continue
+            for name in listing:
+                stored[name] = listing[name]
+                stored_endpoint[name] = endpoint
+
+    # Run job script in all instance directories copying program output to compressed logs and
+    # summary lines to job output streams
+    JOB_SUMMARY["prog_start"] = now_str()
+    print "Program starting at %s (UTC)"%JOB_SUMMARY["prog_start"]
+    t_prog_start = time.time()
+    JOB_SUMMARY["phases"]["setup"] = round(t_prog_start-t_job_start,3)
+    JOB_SUMMARY["instances"] = []
+    rc_mc = 0
     run_problems = False
-    while True:
-
-        # Handle script output and error streams with select.
-        # Trap "Interrupted system call" error (happens when proxy is renewed)
-        reads = [p.stdout.fileno(),p.stderr.fileno()]
-        try:
-            ret = select.select(reads,[],[],1.)
-        except select.error as ex:
-            if ex[0] == errno.EINTR:
+    results = {}
+    threads = []
+    t_export_start = None
+    for s in range(n_segments):
+        (segment_macro,segment_events) = segments[s]
+
+        # Each instance produces its own output files, named after the segment and the instance if there are more than one
+        outputs = []
+        for k in range(n_cores):
+            file_tag = job_name
+            if n_segments > 1: file_tag += "_s%03d"%s
+            if n_cores > 1: file_tag += "_c%d"%k
+            outputs.append((run_dirs[k],"data.root","%s_%s_data.root"%(prod_name,file_tag),"MCDATA"))
+            outputs.append((run_dirs[k],"hsto.root","%s_%s_hsto.root"%(prod_name,file_tag),"MCHSTO"))
+
+        if n_segments > 1:
+            if all([ stored.get(dst_file,0) for (run_dir,out_file,dst_file,file_type) in outputs ]):
+                print "Segment %d was stored by a previous submission: skipping it"%s
+                for (run_dir,out_file,dst_file,file_type) in outputs:
+                    report_stored_file(stored_endpoint[dst_file],"%s/%s"%(storage_dir,dst_file),dst_file,stored[dst_file],file_type)
+                JOB_SUMMARY["n_events"] = JOB_SUMMARY.get("n_events",0)+segment_events*n_cores
                 continue
-            else:
-                raise
-
-        # Here we can parse the full stdout and stderr streams of the job checking for problems
-        for fd in ret[0]:
-            if fd == p.stdout.fileno():
-                read = p.stdout.readline()
-                sys.stdout.write(read)
-            elif fd == p.stderr.fileno():
-                read = p.stderr.readline()
-                sys.stderr.write(read)
-
-        if p.poll() != None: break
-
-    rc_mc = p.returncode
-
-    print "Program ending at %s (UTC)"%now_str()
+            print "--- Segment %d starting at %s (UTC) ---"%(s,now_str())
+
+        instances = []
+        for k in range(n_cores):
+            (padme_seed1,padme_seed2) = segment_seeds(seed_pairs[k],s)
+            instances.append((run_dirs[k],"/bin/bash %s/job.sh %s %s %s/%s"%(job_dir,padme_seed1,padme_seed2,job_dir,segment_macro)))
+        runs = run_instances(instances)
+        if n_segments > 1:
+            for run in runs: run["segment"] = s
+        JOB_SUMMARY["instances"].extend(runs)
+        if n_cores == 1 and n_segments == 1: JOB_SUMMARY["program_info"] = runs[0]["program_info"]
+
+        # Job fails if any instance failed. Events of all instances are added up
+        for run in runs:
+            if n_cores > 1: print "Instance in %s exited with return code %s"%(run["run_dir"],run["exit_code"])
+            if run["exit_code"] != 0 and rc_mc == 0: rc_mc = run["exit_code"]
+            if run["run_problems"]: run_problems = True
+            n_events = run["program_info"].get("Total Events","")
+            if n_events.isdigit(): JOB_SUMMARY["n_events"] = JOB_SUMMARY.get("n_events",0)+int(n_events)
+        if rc_mc != 0 or run_problems: break
+
+        if t_export_start == None:
+            t_export_start = time.time()
+
+            # Order storage endpoints by upload throughput measured just before the first output files are saved
+            if probe_mb and len(endpoints) > 1:
+                endpoints = probe_endpoints(endpoints,storage_dir,probe_mb,job_name)
+                print "Storage endpoints ordered by upload throughput %s"%" ".join(endpoints)
+        if n_segments == 1:
+            print "--- Saving output files ---"
+        else:
+            print "--- Saving output files of segment %d ---"%s
+
+        # All output files are exported concurrently
+        # Output files of segments are renamed so that the next segment can run while they are exported
+        for (run_dir,out_file,dst_file,file_type) in outputs:
+            src_file = os.path.normpath("%s/%s"%(run_dir,out_file))
+            if not os.path.exists(src_file):
+                print "WARNING File %s does not exist in current directory"%src_file
+                results[dst_file] = False
+                continue
+            if n_segments > 1:
+                os.rename(src_file,os.path.normpath("%s/%s"%(run_dir,dst_file)))
+                src_file = os.path.normpath("%s/%s"%(run_dir,dst_file))
+            dst_path = "%s/%s"%(storage_dir,dst_file)
+            t = threading.Thread(target=export_output,args=(job_dir,src_file,dst_file,dst_path,endpoints,file_type,results,n_segments > 1))
+            t.start()
+            threads.append(t)
+    if n_cores > 1: merge_logs(run_dirs)
+
+    JOB_SUMMARY["prog_end"] = now_str()
+    JOB_SUMMARY["phases"]["run"] = round(time.time()-t_prog_start,3)
+    JOB_SUMMARY["prog_exit_code"] = rc_mc
+    JOB_SUMMARY["run_problems"] = run_problems
+    print "Program ending at %s (UTC)"%JOB_SUMMARY["prog_end"]
     print "Script exited with return code %s"%rc_mc
 
+    # Join with a timeout so that the proxy renewal signal can still be handled
+    for t in threads:
+        while t.is_alive(): t.join(1.)
+    if threads: print "All output transfers ended after %.1f s"%(time.time()-t_export_start)
+
     if rc_mc != 0 or run_problems:
         if run_problems:
             print "WARNING Problems found while parsing program output. Please check log."
         if rc_mc != 0:
             print "WARNING Simulation ended with non-zero return code. Please check log."
-        print "Output files will not be saved to tape storage."
-        sys.exit(1)
-
-    print "--- Saving output files ---"
-
-    data_ok = True
-    if os.path.exists("data.root"):
-
-        data_src_file = "data.root"
-        data_size = os.path.getsize(data_src_file)
-        data_adler32 = get_adler32(data_src_file)
-        data_src_url = "file://%s/%s"%(job_dir,data_src_file)
-
-        data_dst_file = "%s_%s_data.root"%(prod_name,job_name)
-        data_dst_url = "%s%s/%s"%(srm_uri,storage_dir,data_dst_file)
-
-        #print "Copying",data_src_url,"to",data_dst_url
-        #data_copy_cmd = "gfal-copy %s %s"%(data_src_url,data_dst_url)
-        #print ">",data_copy_cmd
-        #rc = subprocess.call(data_copy_cmd.split())
-        rc = export_file(data_src_url,data_dst_url)
-        if rc:
-            print "WARNING - gfal-copy returned error status %d"%rc
-            data_ok = False
-        else:
-            print "MCDATA file %s with size %s and adler32 %s copied"%(data_dst_file,data_size,data_adler32)
-
-    else:
-
-        print "WARNING File data.root does not exist in current directory"
-        data_ok = False
-
-    hsto_ok = True
-    if os.path.exists("hsto.root"):
-
-        hsto_src_file = "hsto.root"
-        hsto_size = os.path.getsize(hsto_src_file)
-        hsto_adler32 = get_adler32(hsto_src_file)
-        hsto_src_url = "file://%s/%s"%(job_dir,hsto_src_file)
-        
-        hsto_dst_file = "%s_%s_hsto.root"%(prod_name,job_name)
-        hsto_dst_url = "%s%s/%s"%(srm_uri,storage_dir,hsto_dst_file)
-
-        #print "Copying %s to %s"%(hsto_src_url,hsto_dst_url)
-        #hsto_copy_cmd = "gfal-copy %s %s"%(hsto_src_url,hsto_dst_url)
-        #print ">",hsto_copy_cmd
-        #rc = subprocess.call(hsto_copy_cmd.split())
-        rc = export_file(hsto_src_url,hsto_dst_url)
-        if rc:
-            print "WARNING - gfal-copy returned error status %d"%rc
-            hsto_ok = False
+        if WATCHDOG_FIRED.is_set():
+            print "WARNING Program was hung and was killed by the watchdog. Please check diagnostics in job error stream."
+        if n_segments == 1:
+            print "Output files will not be saved to tape storage."
         else:
-            print "MCHSTO file %s with size %s and adler32 %s copied"%(hsto_dst_file,hsto_size,hsto_adler32)
-
-    else:
-
-        print "WARNING File hsto.root does not exist in current directory"
-        hsto_ok = False
+            print "Output files of the failed segment will not be saved to tape storage."
+        if WATCHDOG_FIRED.is_set(): sys.exit(WATCHDOG_EXIT_CODE)
+        sys.exit(1)
 
-    #if not (os.path.exists("data.root") and os.path.exists("hsto.root")): sys.exit(1)
-    if not (data_ok and hsto_ok):
+    if not all(results.values()):
         sys.exit(1)
 
     print "Job ending at %s (UTC)"%now_str()
@@ -273,4 +930,16 @@ exit $rc
 # Execution starts here
 if __name__ == "__main__":
 
-    main(sys.argv[1:])
+    # Always write final job summary, whatever the way the job ends
+    rc = 1
+    try:
+        main(sys.argv[1:])
+        rc = 0
+    except SystemExit as ex:
+        rc = ex.code
+    finally:
+        report_usage()
+        JOB_SUMMARY["time_end"] = now_str()
+        JOB_SUMMARY["exit_code"] = rc
+        write_summary()
+    sys.exit(rc)
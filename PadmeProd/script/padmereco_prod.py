@@ -10,19 +10,92 @@ import subprocess
 import shlex
 import select
 import errno
+import zlib
+import gzip
+import collections
+import json
+import multiprocessing
+import threading
+import shutil
 
 PROXY_FILE = ""
 PROXY_RENEW_TIME = 6*3600
 
+# Size of blocks read to compute adler32 checksum of output files
+ADLER32_BLOCK_SIZE = 16*1024*1024
+
+# Max size of chunks of program output copied to the job output streams
+PUMP_CHUNK_SIZE = 64*1024
+
+# Compressed logs holding the full program output, shipped in the output sandbox
+PROG_OUT_LOG = "program.out.gz"
+PROG_ERR_LOG = "program.err.gz"
+LOG_COMPRESS_LEVEL = 6
+
+# Program output lines copied uncompressed to the job output streams (summary lines are parsed by the production daemon)
+LOG_KEEP_RE = re.compile("^(RecoInfo|PadmeMCInfo) - |^.*(\*\*\* ERROR|Error in <|segmentation violation)")
+
+# Number of last lines of program stderr shown uncompressed when problems are found
+LOG_TAIL_LINES = 50
+
+# Machine-readable job summary, shipped in the output sandbox and read by the production daemon
+JOB_SUMMARY_FILE = "job.json"
+JOB_SUMMARY = {}
+
+# Final summary lines of the program, e.g. "RecoInfo - Total CPU time 12.3 s"
+PROG_INFO_RE = re.compile("^(RecoInfo|PadmeMCInfo) - (.*?)\s+(\S+)(\s+s)?\s*$")
+
+# Number of input files copied in parallel to local disk when staging is enabled
+STAGE_STREAMS = 4
+STAGE_LOCK = threading.Lock()
+
+# Lock to avoid mixing output lines of concurrent threads
+PRINT_LOCK = threading.Lock()
+
+# Interval (s) between samples of resource usage of the processes started by the job. Can be changed with PADME_MONITOR_INTERVAL
+MONITOR_INTERVAL = float(os.getenv('PADME_MONITOR_INTERVAL',"30"))
+MONITOR_STOP = threading.Event()
+MONITOR_THREAD = None
+RESOURCES = {}
+
+# Watchdog of running programs: a program whose processes write no output for WATCHDOG_OUTPUT_TIMEOUT seconds or use no
+# CPU time for WATCHDOG_CPU_TIMEOUT seconds is considered hung and is killed. Timeouts can be changed with PADME_WATCHDOG_OUTPUT
+# and PADME_WATCHDOG_CPU (0 disables the check). Checks are done every PADME_WATCHDOG_INTERVAL seconds
+WATCHDOG_OUTPUT_TIMEOUT = float(os.getenv('PADME_WATCHDOG_OUTPUT',"7200"))
+WATCHDOG_CPU_TIMEOUT = float(os.getenv('PADME_WATCHDOG_CPU',"1800"))
+WATCHDOG_INTERVAL = float(os.getenv('PADME_WATCHDOG_INTERVAL',"60"))
+WATCHDOG_FIRED = threading.Event()
+
+# Exit code of jobs whose program was killed by the watchdog (used by the production daemon to classify the failure)
+WATCHDOG_EXIT_CODE = 3
+
+# Upload of output files: each storage endpoint is tried UPLOAD_TRIES times, pausing UPLOAD_BACKOFF seconds (doubled at each
+# retry) between attempts, before failing over to the next endpoint. Can be changed with PADME_UPLOAD_TRIES and PADME_UPLOAD_BACKOFF
+UPLOAD_TRIES = int(os.getenv('PADME_UPLOAD_TRIES',"3"))
+UPLOAD_BACKOFF = float(os.getenv('PADME_UPLOAD_BACKOFF',"30"))
+
+# Error shown by PadmeReco when it cannot open an input file
+XROOTD_OPEN_ERROR_RE = re.compile("^.*Error in <TNetXNGFile::Open>: \[ERROR\]")
+
 def now_str():
 
     return time.strftime("%Y-%m-%d %H:%M:%S",time.gmtime())
 
 def get_adler32(outfile):
 
-    adler_cmd = "adler32 %s"%outfile
-    p = subprocess.Popen(shlex.split(adler_cmd),stdin=None,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    return p.communicate()[0].strip()
+    # Compute adler32 checksum of file reading it in large blocks (file was just written: usually in page cache)
+    # N.B. checksum cannot be computed while the program writes the file as ROOT rewrites parts of it when closing
+    adler = 1
+    try:
+        with open(outfile,"rb") as f:
+            while True:
+                buf = f.read(ADLER32_BLOCK_SIZE)
+                if not buf: break
+                adler = zlib.adler32(buf,adler)
+    except IOError as e:
+        print "WARNING - Unable to compute adler32 checksum of %s: %s"%(outfile,e)
+        return ""
+    return "%08x"%(adler & 0xffffffff)
 
 def renew_proxy_handler(signum,frame):
 
@@ -37,63 +110,555 @@ def renew_proxy_handler(signum,frame):
     # Reset alarm
     signal.alarm(PROXY_RENEW_TIME)
 
-def export_file(src_url,dst_url):
+def log(msg):
+
+    # Print a message from any thread without mixing it with other messages
+    with PRINT_LOCK:
+        print msg
+        sys.stdout.flush()
+
+def write_summary():
+
+    # Write job summary to a temporary file and rename it so that a truncated summary is never shipped
+    tmp_file = "%s.tmp"%JOB_SUMMARY_FILE
+    with open(tmp_file,"w") as sf: json.dump(JOB_SUMMARY,sf,indent=1,sort_keys=True)
+    os.rename(tmp_file,JOB_SUMMARY_FILE)
+
+def read_proc_stat(pid):
+
+    # Return (parent pid,CPU time in clock ticks,resident memory in pages) of process pid or None if process is gone
+    try:
+        with open("/proc/%d/stat"%pid,"r") as f: stat = f.read()
+    except IOError:
+        return None
+    # Process name (2nd field) can contain spaces: fields are counted from the end of the name
+    fields = stat[stat.rfind(")")+2:].split()
+    return (int(fields[1]),int(fields[11])+int(fields[12]),int(fields[21]))
+
+def read_proc_io(pid):
+
+    # Return (bytes read,bytes written) by process pid from/to storage devices. Counters are not available on all systems
+    io = {}
+    try:
+        with open("/proc/%d/io"%pid,"r") as f:
+            for l in f:
+                (key,value) = l.split(":")
+                io[key] = int(value)
+    except (IOError,ValueError):
+        return (0,0)
+    return (io.get("read_bytes",0),io.get("write_bytes",0))
+
+def process_tree(root_pid):
+
+    # Return dictionary pid -> (parent pid,CPU time in clock ticks,resident memory in pages) of process root_pid and all its descendants
+    procs = {}
+    children = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit(): continue
+        stat = read_proc_stat(int(entry))
+        if stat:
+            procs[int(entry)] = stat
+            children.setdefault(stat[0],[]).append(int(entry))
+    tree = {}
+    todo = [ root_pid ]
+    while todo:
+        pid = todo.pop()
+        if pid in procs: tree[pid] = procs[pid]
+        todo.extend(children.get(pid,[]))
+    return tree
+
+def read_proc_state(pid):
+
+    # Return (state,wait channel,command line) of process pid. Missing values are shown as "?"
+    state = "?"
+    wchan = "?"
+    cmdline = "?"
+    try:
+        with open("/proc/%d/status"%pid,"r") as f:
+            for l in f:
+                if l.startswith("State:"):
+                    state = l.split(":",1)[1].strip()
+                    break
+        with open("/proc/%d/wchan"%pid,"r") as f: wchan = f.read().strip() or "0"
+        with open("/proc/%d/cmdline"%pid,"r") as f: cmdline = f.read().replace("\0"," ").strip()
+    except IOError:
+        pass
+    return (state,wchan,cmdline)
+
+def watchdog_kill(p):
+
+    # Kill a hung program with all its descendants and return the state of its processes just before the kill
+    # All processes are stopped before killing them so that none can start new processes or be reparented in between
+    tree = process_tree(p.pid)
+    procs = []
+    for pid in sorted(tree.keys()):
+        (state,wchan,cmdline) = read_proc_state(pid)
+        procs.append({ "pid": pid, "ppid": tree[pid][0], "cpu_ticks": tree[pid][1], "state": state, "wchan": wchan, "cmdline": cmdline })
+    for pid in tree:
+        try:
+            os.kill(pid,signal.SIGSTOP)
+        except OSError:
+            pass
+    for pid in tree:
+        try:
+            os.kill(pid,signal.SIGKILL)
+        except OSError:
+            pass
+    WATCHDOG_FIRED.set()
+    return procs
+
+def monitor_processes():
+
+    # Sample resource usage of all processes started by the job every MONITOR_INTERVAL seconds until MONITOR_STOP is set
+    # CPU usage is computed from the CPU time used by each process since the previous sample (100% = one core)
+    # I/O counters of processes which ended are kept at their last sampled values
+    hz = float(os.sysconf("SC_CLK_TCK"))
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    job_pid = os.getpid()
+    last_ticks = {}
+    last_io = {}
+    cpu_sum = 0.
+    t_last = time.time()
+    while not MONITOR_STOP.wait(MONITOR_INTERVAL):
+
+        # Tree of processes descending from the job (the job itself is not included)
+        tree = process_tree(job_pid)
+        tree.pop(job_pid,None)
+
+        t_now = time.time()
+        ticks = 0
+        rss = 0
+        for pid in tree:
+            (ppid,cpu_ticks,rss_pages) = tree[pid]
+            ticks += cpu_ticks-last_ticks.get(pid,0)
+            last_ticks[pid] = cpu_ticks
+            rss += rss_pages*page_size
+            last_io[pid] = read_proc_io(pid)
+        cpu = 100.*ticks/hz/max(t_now-t_last,0.001)
+        t_last = t_now
+
+        RESOURCES["samples"] += 1
+        cpu_sum += cpu
+        RESOURCES["cpu_min"] = round(min(RESOURCES.get("cpu_min",cpu),cpu),1)
+        RESOURCES["cpu_max"] = round(max(RESOURCES.get("cpu_max",cpu),cpu),1)
+        RESOURCES["cpu_avg"] = round(cpu_sum/RESOURCES["samples"],1)
+        RESOURCES["rss_peak"] = max(RESOURCES["rss_peak"],rss)
+        RESOURCES["read_bytes"] = sum([ r for (r,w) in last_io.values() ])
+        RESOURCES["write_bytes"] = sum([ w for (r,w) in last_io.values() ])
+
+def start_monitor():
+
+    global MONITOR_THREAD
+
+    # Run resource monitor in background. Thread is a daemon so that it never prevents the job from ending
+    RESOURCES.update({ "interval": MONITOR_INTERVAL, "samples": 0, "rss_peak": 0, "read_bytes": 0, "write_bytes": 0 })
+    MONITOR_THREAD = threading.Thread(target=monitor_processes)
+    MONITOR_THREAD.daemon = True
+    MONITOR_THREAD.start()
+
+def report_usage():
+
+    # Stop resource monitor and show resource usage and duration of job phases in job output and job summary
+    # Checksum and upload times are the total over all output files
+    # Output line formats are parsed by the production daemon: do not change them
+    if MONITOR_THREAD == None: return
+    MONITOR_STOP.set()
+    MONITOR_THREAD.join(MONITOR_INTERVAL)
+    phases = JOB_SUMMARY["phases"]
+    phases["checksum"] = round(sum([ f.get("checksum_time",0.) for f in JOB_SUMMARY["files"] ]),3)
+    phases["upload"] = round(sum([ f["transfer_time"] for f in JOB_SUMMARY["files"] ]),3)
+    JOB_SUMMARY["resources"] = dict(RESOURCES)
+    print "--- Resource usage ---"
+    print "Resource usage samples %d every %.1f s"%(RESOURCES["samples"],MONITOR_INTERVAL)
+    if RESOURCES["samples"]:
+        print "Resource usage CPU min %.1f %% avg %.1f %% max %.1f %%"%(RESOURCES["cpu_min"],RESOURCES["cpu_avg"],RESOURCES["cpu_max"])
+        print "Resource usage peak RSS %d bytes"%RESOURCES["rss_peak"]
+        print "Resource usage read %d bytes written %d bytes"%(RESOURCES["read_bytes"],RESOURCES["write_bytes"])
+    for phase in ("setup","run","checksum","upload"):
+        if phase in phases: print "Phase %s time %.3f s"%(phase,phases[phase])
+    sys.stdout.flush()
+
+def pump_output(p,line_check=None,log_dir=".",info=None):
+
+    # Append stdout and stderr of process p to compressed log files in log_dir in large chunks as soon as data is available
+    # Values found in program summary lines are stored in info (default: program_info of the job summary)
+    # Complete lines matching LOG_KEEP_RE, or lines of stderr for which line_check (if given) returns True, are
+    # also copied uncompressed to our own stdout and stderr. If problems are found or the program fails, the last
+    # lines of its stderr are shown as well. Streams are drained until EOF so no output is lost when the process ends.
+    # If the watchdog finds the program hung, it is killed and the state of its processes is shown with its last output lines.
+    # Return True if problems were found
+    if info == None: info = JOB_SUMMARY.setdefault("program_info",{})
+    problems = False
+    out_fd = p.stdout.fileno()
+    err_fd = p.stderr.fileno()
+    targets = { out_fd: sys.stdout, err_fd: sys.stderr }
+    logs = { out_fd: gzip.open("%s/%s"%(log_dir,PROG_OUT_LOG),"ab",LOG_COMPRESS_LEVEL), err_fd: gzip.open("%s/%s"%(log_dir,PROG_ERR_LOG),"ab",LOG_COMPRESS_LEVEL) }
+    partial = { out_fd: "", err_fd: "" }
+    err_tail = collections.deque([],LOG_TAIL_LINES)
+    out_tail = collections.deque([],LOG_TAIL_LINES)
+    streams = [ out_fd, err_fd ]
+    t_output = time.time()
+    t_cpu = t_output
+    t_check = t_output
+    cpu_ticks = None
+    hung = None
+    while streams:
+
+        # Check if program is hung: no output or no CPU time used by any of its processes for too long
+        now = time.time()
+        if hung != None and now-t_check >= WATCHDOG_INTERVAL:
+            # Streams are still open after the kill (some process escaped from the tree): stop waiting for them
+            break
+        elif hung == None and now-t_check >= WATCHDOG_INTERVAL:
+            t_check = now
+            if WATCHDOG_CPU_TIMEOUT:
+                ticks = sum([ stat[1] for stat in process_tree(p.pid).values() ])
+                if ticks != cpu_ticks:
+                    cpu_ticks = ticks
+                    t_cpu = now
+            if WATCHDOG_OUTPUT_TIMEOUT and now-t_output >= WATCHDOG_OUTPUT_TIMEOUT:
+                hung = "no output for %d s"%(now-t_output)
+            elif WATCHDOG_CPU_TIMEOUT and now-t_cpu >= WATCHDOG_CPU_TIMEOUT:
+                hung = "no CPU time used for %d s"%(now-t_cpu)
+            if hung:
+                procs = watchdog_kill(p)
+                JOB_SUMMARY.setdefault("watchdog",[]).append({ "run_dir": log_dir, "reason": hung, "time": now_str(), "processes": procs })
+                problems = True
+
+        # Trap "Interrupted system call" error (happens when proxy is renewed)
+        try:
+            ret = select.select(streams,[],[],WATCHDOG_INTERVAL)
+        except select.error as ex:
+            if ex[0] == errno.EINTR:
+                continue
+            else:
+                raise
+
+        for fd in ret[0]:
+            try:
+                chunk = os.read(fd,PUMP_CHUNK_SIZE)
+            except OSError as ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                else:
+                    raise
+            if chunk:
+                t_output = time.time()
+                logs[fd].write(chunk)
+                lines = (partial[fd]+chunk).split("\n")
+                partial[fd] = lines.pop()
+            else:
+                # End of stream: handle last incomplete line, if any
+                lines = [ partial[fd] ] if partial[fd] else []
+                streams.remove(fd)
+            for line in lines:
+                problem = fd == err_fd and line_check != None and line_check(line)
+                if problem: problems = True
+                if problem or LOG_KEEP_RE.match(line): targets[fd].write(line+"\n")
+                if fd == out_fd:
+                    r = PROG_INFO_RE.match(line)
+                    if r: info[r.group(2)] = r.group(3)
+                if fd == err_fd: err_tail.append(line)
+                if fd == out_fd: out_tail.append(line)
+
+    logs[out_fd].close()
+    logs[err_fd].close()
+    p.wait()
+    if hung:
+        with PRINT_LOCK:
+            print "WARNING Program in %s killed by watchdog: %s"%(log_dir,hung)
+            sys.stderr.write("--- Watchdog: program in %s killed (%s). State of its processes before the kill ---\n"%(log_dir,hung))
+            for proc in procs: sys.stderr.write("pid %(pid)d ppid %(ppid)d state %(state)s wchan %(wchan)s cmd %(cmdline)s\n"%proc)
+            sys.stderr.write("--- Last %d lines of program output stream ---\n"%len(out_tail))
+            for line in out_tail: sys.stderr.write(line+"\n")
+    if (problems or p.returncode != 0) and err_tail:
+        sys.stderr.write("--- Last %d lines of program error stream (full log in %s) ---\n"%(len(err_tail),os.path.normpath("%s/%s"%(log_dir,PROG_ERR_LOG))))
+        for line in err_tail: sys.stderr.write(line+"\n")
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return problems
+
+def check_err_line(line):
+
+    # Return True if a line of the program error stream shows a problem
+    return XROOTD_OPEN_ERROR_RE.match(line) != None
+
+def run_program(cmd,run_dir,line_check,info):
+
+    # Run a command in run_dir (where compressed logs are written). Return (exit_code,problems)
+    # All file descriptors are closed in the child so that concurrent instances do not keep each other's pipes open
+    p = subprocess.Popen(shlex.split(cmd),cwd=run_dir,stdout=subprocess.PIPE,stderr=subprocess.PIPE,close_fds=True)
+    problems = pump_output(p,line_check,run_dir,info)
+    return (p.returncode,problems)
+
+def run_instance(run_dir,run_list,line_check,result):
+
+    # Run one PadmeReco instance reading the input files in run_list from their remote location
+    cmd = "/bin/bash %s/job.sh %s data.root"%(os.getcwd(),os.path.abspath(run_list))
+    (result["exit_code"],result["run_problems"]) = run_program(cmd,run_dir,line_check,result["program_info"])
+
+def stage_files(urls,stage_dir,staged,stats):
+
+    # Copy input files to stage_dir with up to STAGE_STREAMS parallel copies
+    # staged maps each url to the local file or, if the copy failed, to the url itself (file will be read remotely)
+    t_start = time.time()
+    for i in range(0,len(urls),STAGE_STREAMS):
+        threads = []
+        for url in urls[i:i+STAGE_STREAMS]:
+            t = threading.Thread(target=stage_file,args=(url,stage_dir,staged,stats))
+            t.start()
+            threads.append(t)
+        for t in threads: t.join()
+    stats["time"] += time.time()-t_start
+
+def stage_file(url,stage_dir,staged,stats):
+
+    # Copy one input file to local disk
+    local_file = "%s/%s"%(os.path.abspath(stage_dir),os.path.basename(url))
+    cmd = "gfal-copy -f %s file://%s"%(url,local_file)
+    p = subprocess.Popen(shlex.split(cmd),stdout=subprocess.PIPE,stderr=subprocess.STDOUT,close_fds=True)
+    (out,err) = p.communicate()
+    if p.returncode == 0 and os.path.exists(local_file):
+        staged[url] = local_file
+        with STAGE_LOCK:
+            stats["files"] += 1
+            stats["bytes"] += os.path.getsize(local_file)
+    else:
+        log("WARNING - Unable to stage %s (gfal-copy returned %d): file will be read remotely"%(url,p.returncode))
+        staged[url] = url
+        with STAGE_LOCK: stats["failed"] += 1
+
+def run_staged_instance(run_dir,run_list,line_check,stage_chunk,result):
+
+    # Run PadmeReco in sequence on chunks of stage_chunk input files from run_list. While a chunk is processed, the
+    # files of the next one are copied to local disk. Files of a chunk are deleted as soon as the chunk is processed
+    # so at most two chunks are on disk at any time. Outputs of all chunks are then merged in a single file
+    with open(run_list,"r") as rl: urls = [ l.strip() for l in rl if l.strip() ]
+    chunks = [ urls[i:i+stage_chunk] for i in range(0,len(urls),stage_chunk) ]
+    stage_dir = "%s/stage"%run_dir
+    os.mkdir(stage_dir)
+    stats = { "files": 0, "bytes": 0, "failed": 0, "time": 0., "stall": 0. }
+    result["staging"] = stats
+    staged = {}
+    stager = threading.Thread(target=stage_files,args=(chunks[0],stage_dir,staged,stats))
+    stager.start()
+    n_events = 0
+    chunk_outputs = []
+    for i in range(len(chunks)):
+
+        # Time spent waiting for the files of this chunk is a stall of the processing
+        t_wait = time.time()
+        while stager.is_alive(): stager.join(1.)
+        stats["stall"] += time.time()-t_wait
+        if i+1 < len(chunks):
+            stager = threading.Thread(target=stage_files,args=(chunks[i+1],stage_dir,staged,stats))
+            stager.start()
+
+        chunk_list = "%s/chunk_%03d.list"%(run_dir,i)
+        with open(chunk_list,"w") as cl:
+            for url in chunks[i]: cl.write("%s\n"%staged[url])
+        chunk_output = "chunk_%03d.root"%i
+        info = {}
+        cmd = "/bin/bash %s/job.sh %s %s"%(os.getcwd(),os.path.abspath(chunk_list),chunk_output)
+        (rc,problems) = run_program(cmd,run_dir,line_check,info)
+        log("Chunk %d/%d in %s (%d files) processed with return code %d"%(i+1,len(chunks),run_dir,len(chunks[i]),rc))
+        for url in chunks[i]:
+            if staged[url] != url and os.path.exists(staged[url]): os.remove(staged[url])
+        result["program_info"] = info
+        if info.get("Processed Events","").isdigit(): n_events += int(info["Processed Events"])
+        if problems: result["run_problems"] = True
+        if rc != 0:
+            result["exit_code"] = rc
+            while stager.is_alive(): stager.join(1.)
+            return
+        chunk_outputs.append(chunk_output)
+    result["program_info"]["Processed Events"] = str(n_events)
+
+    # Merge outputs of all chunks
+    if len(chunk_outputs) == 1:
+        os.rename("%s/%s"%(run_dir,chunk_outputs[0]),"%s/data.root"%run_dir)
+        result["exit_code"] = 0
+    else:
+        cmd = "/bin/bash %s/merge.sh data.root %s"%(os.getcwd()," ".join(chunk_outputs))
+        (result["exit_code"],problems) = run_program(cmd,run_dir,None,{})
+        for chunk_output in chunk_outputs: os.remove("%s/%s"%(run_dir,chunk_output))
+
+def run_instances(instances,line_check=None,stage_chunk=0):
+
+    # Run PadmeReco instances concurrently, one thread each. instances is a list of (run_dir,input_list)
+    # With stage_chunk>0 input files are staged to local disk in chunks of stage_chunk files
+    # Return list of results as dictionaries with run_dir, exit_code, run_problems and program_info
+    results = []
+    threads = []
+    for (run_dir,run_list) in instances:
+        result = { "run_dir": run_dir, "exit_code": -1, "run_problems": False, "program_info": {} }
+        if stage_chunk:
+            t = threading.Thread(target=run_staged_instance,args=(run_dir,run_list,line_check,stage_chunk,result))
+        else:
+            t = threading.Thread(target=run_instance,args=(run_dir,run_list,line_check,result))
+        t.start()
+        results.append(result)
+        threads.append(t)
+
+    # Join with a timeout so that the proxy renewal signal can still be handled
+    for t in threads:
+        while t.is_alive(): t.join(1.)
+    return results
+
+def merge_logs(run_dirs):
+
+    # Concatenate compressed logs of all instances into the job logs (a sequence of gzip members is a valid gzip file)
+    for log_file in (PROG_OUT_LOG,PROG_ERR_LOG):
+        with open(log_file,"wb") as lf:
+            for run_dir in run_dirs:
+                with open("%s/%s"%(run_dir,log_file),"rb") as rf: shutil.copyfileobj(rf,lf)
+
+def list_stored_files(dir_url):
+
+    # Return dictionary with the size of all files in storage directory dir_url or None if directory cannot be listed
+    ls_cmd = "gfal-ls -l %s"%dir_url
+    log("> %s"%ls_cmd)
+    p = subprocess.Popen(shlex.split(ls_cmd),stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    (out,err) = p.communicate()
+    if p.returncode != 0:
+        log("WARNING - gfal-ls returned error status %d: %s"%(p.returncode,err.strip()))
+        return None
+    stored = {}
+    for line in out.splitlines():
+        # Long format: <mode> <nlink> <uid> <gid> <size> <month> <day> <time|year> <name>
+        fields = line.split()
+        if len(fields) >= 9 and fields[4].isdigit(): stored[os.path.basename(fields[-1])] = int(fields[4])
+    return stored
+
+def export_file(src_url,dst_url,adler32=""):
 
     print "Copying",src_url,"to",dst_url
 
     # Check if destination file already exists and rename it
-    # This can happen if job log retrieval fails after the job
-    # has successfully completed
+    # This can happen if job log retrieval fails after the job has successfully completed
+    # Only if the file exists the destination directory is listed once to find the first free backup name
     stat_cmd = "gfal-stat %s"%dst_url
     print ">",stat_cmd
-    rc = subprocess.call(stat_cmd.split())
-    if rc == 0:
+    p = subprocess.Popen(shlex.split(stat_cmd),stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    p.communicate()
+    if p.returncode == 0:
         print "WARNING - File %s exists. Attempting to rename it."%dst_url
-        idx = 0
-        while idx<100:
-            new_url = "%s.%02d"%(dst_url,idx)
-            rename_cmd = "gfal-rename %s %s"%(dst_url,new_url)
-            print ">",rename_cmd
-            rc = subprocess.call(rename_cmd.split())
-            if rc == 0:
-                # Rename succeeded: we can proceed with the copy
-                print "WARNING - Existing file renamed to %s"%new_url
-                break
-            # Rename failed: file already exists. Try next index
-            idx += 1
-            if idx == 100:
-                print "ERROR - File %s - Too many copies. Cannot rename existing file."%dst_url
-                return 1
-
-    copy_cmd = "gfal-copy %s %s"%(src_url,dst_url)
+        (dir_url,dst_file) = dst_url.rsplit("/",1)
+        stored = list_stored_files(dir_url)
+        if stored == None:
+            print "WARNING - Unable to list %s: trying first backup name"%dir_url
+            stored = {}
+        free = [ idx for idx in range(100) if not "%s.%02d"%(dst_file,idx) in stored ]
+        if not free:
+            print "ERROR - File %s - Too many copies. Cannot rename existing file."%dst_url
+            return 1
+        new_url = "%s.%02d"%(dst_url,free[0])
+        rename_cmd = "gfal-rename %s %s"%(dst_url,new_url)
+        print ">",rename_cmd
+        rc = subprocess.call(rename_cmd.split())
+        if rc != 0:
+            print "ERROR - Unable to rename existing file %s to %s"%(dst_url,new_url)
+            return rc
+        print "WARNING - Existing file renamed to %s"%new_url
+
+    # If checksum is known, ask gfal-copy to verify it on the destination at the end of the transfer
+    if adler32:
+        copy_cmd = "gfal-copy -K ADLER32:%s %s %s"%(adler32,src_url,dst_url)
+    else:
+        copy_cmd = "gfal-copy %s %s"%(src_url,dst_url)
     print ">",copy_cmd
     rc = subprocess.call(copy_cmd.split())
 
     return rc
 
+def upload_file(copy,src_url,dst_path,endpoints,adler32=""):
+
+    # Copy src_url to dst_path (storage directory and file name) on the first storage endpoint which accepts it
+    # copy is the function doing a single copy attempt (export_file or store_segment_file)
+    # Return (return code of last attempt,endpoint used or None if all endpoints failed)
+    rc = 1
+    for endpoint in endpoints:
+        pause = UPLOAD_BACKOFF
+        for n_try in range(UPLOAD_TRIES):
+            if n_try:
+                log("WARNING - Copy to %s failed with error status %d: trying again in %.0f s"%(endpoint,rc,pause))
+                time.sleep(pause)
+                pause *= 2
+            rc = copy(src_url,"%s%s"%(endpoint,dst_path),adler32)
+            if rc == 0: return (0,endpoint)
+        log("WARNING - Unable to copy %s to %s after %d attempts"%(src_url,endpoint,UPLOAD_TRIES))
+    return (rc,None)
+
 def main(argv):
 
     global PROXY_FILE
     global PROXY_RENEW_TIME
 
+    # Immediately create empty program logs and job summary so that all output sandbox files exist even if the program is never run
+    for log_file in (PROG_OUT_LOG,PROG_ERR_LOG): gzip.open(log_file,"wb").close()
+    write_summary()
+
     # Top CVMFS directory for PadmeReco
     padmereco_cvmfs_dir = "/cvmfs/padme.infn.it/PadmeReco"
 
-    output_file = "data.root"
+    (input_list,PROXY_FILE,prod_name,job_name,reco_version,storage_dir,srm_uri) = argv[:7]
+
+    # Output files are uploaded to the first storage endpoint of the comma-separated list srm_uri which accepts them
+    endpoints = srm_uri.split(",")
 
-    (input_list,PROXY_FILE,prod_name,job_name,reco_version,storage_dir,srm_uri) = argv
+    # Optional number of cores: input files are split among as many PadmeReco instances
+    n_cores = 1
+    if len(argv) > 7: n_cores = int(argv[7])
+
+    # Optional size of chunks of input files staged to local disk (0: read input files remotely)
+    stage_chunk = 0
+    if len(argv) > 8: stage_chunk = int(argv[8])
 
     job_dir = os.getcwd()
 
+    # Get processor model (useful to troubleshoot variations in execution time)
+    processor = "UNKNOWN"
+    if os.path.exists("/proc/cpuinfo"):
+        with open("/proc/cpuinfo","r") as cpuinfo:
+            for l in cpuinfo:
+                m = re.match("^\s*model name\s+:\s+(.*)$",l)
+                if m:
+                    processor = m.group(1)
+                    break
+
     print "=== PadmeReco Production %s Job %s ==="%(prod_name,job_name)
-    print "Job starting at %s (UTC)"%now_str()
+    time_start = now_str()
+    t_job_start = time.time()
+    print "Job starting at %s (UTC)"%time_start
     print "Job running on node %s as user %s in dir %s"%(os.getenv('HOSTNAME'),os.getenv('USER'),job_dir)
+    print "Processor %s"%processor
 
     print "PadmeReco version",reco_version
     print "SRM server URI",srm_uri
     print "Storage directory",storage_dir
     print "Input file list",input_list
     print "Proxy file",PROXY_FILE
+    print "Cores",n_cores
+    if stage_chunk: print "Input files staged to local disk in chunks of",stage_chunk
+
+    # Initial job summary: it is completed while the job runs and written again when the job ends
+    JOB_SUMMARY.update({
+        "prod_name": prod_name,
+        "job_name": job_name,
+        "program": "PadmeReco",
+        "program_version": reco_version,
+        "worker_node": os.getenv('HOSTNAME'),
+        "wn_user": os.getenv('USER'),
+        "wn_dir": job_dir,
+        "processor": processor,
+        "n_cpus": multiprocessing.cpu_count(),
+        "time_start": time_start,
+        "program_info": {},
+        "phases": {},
+        "files": []
+    })
+    write_summary()
+    start_monitor()
 
     # Change permission rights for long-lived proxy (must be 600)
     os.chmod(PROXY_FILE,0600)
@@ -122,6 +687,28 @@ def main(argv):
         print "ERROR File %s not found"%padmereco_init_file
         exit(2)
 
+    # With more than one instance, each one processes a contiguous slice of the input list in its own directory
+    with open(input_list,"r") as il: input_files = [ l.strip() for l in il if l.strip() ]
+    n_cores = max(1,min(n_cores,len(input_files)))
+    JOB_SUMMARY["n_cores"] = n_cores
+    JOB_SUMMARY["n_input_files"] = len(input_files)
+    if n_cores == 1:
+        run_dirs = [ "." ]
+        run_lists = [ input_list ]
+    else:
+        run_dirs = []
+        run_lists = []
+        for k in range(n_cores):
+            run_dir = "core_%d"%k
+            os.mkdir(run_dir)
+            os.symlink(config_dir,"%s/config"%run_dir)
+            run_list = "%s/job.list"%run_dir
+            with open(run_list,"w") as rl:
+                for input_file in input_files[k*len(input_files)//n_cores:(k+1)*len(input_files)//n_cores]: rl.write("%s\n"%input_file)
+            run_dirs.append(run_dir)
+            run_lists.append(run_list)
+        print "Running %d PadmeReco instances on %d input files"%(n_cores,len(input_files))
+
     # Enable timer to renew VOMS proxy every 6h
     signal.signal(signal.SIGALRM,renew_proxy_handler)
     signal.alarm(PROXY_RENEW_TIME)
@@ -144,7 +731,7 @@ else
     echo "PADMERECO_EXE = $PADMERECO_EXE"
 fi
 echo "LD_LIBRARY_PATH = $LD_LIBRARY_PATH"
-$PADMERECO_EXE -l %s -o %s -n 0
+$PADMERECO_EXE -l $1 -o $2 -n 0
 rc=$?
 if [ $rc -ne 0 ]; then
   echo "*** ERROR *** PadmeReco returned error code $rc"
@@ -154,43 +741,50 @@ ls -l
 date
 echo "--- Ending PADMERECO production ---"
 exit $rc
-"""%(padmereco_init_file,input_list,output_file)
+"""%padmereco_init_file
     with open("job.sh","w") as sf: sf.write(script)
 
-    # Run job script sending its output/error to stdout/stderr
-    print "Program starting at %s (UTC)"%now_str()
-    job_cmd = "/bin/bash job.sh"
-    p = subprocess.Popen(shlex.split(job_cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
+    # Outputs of staged chunks are merged with hadd
+    if stage_chunk:
+        with open("merge.sh","w") as mf: mf.write("#!/bin/bash\n. %s\nhadd -f \"$@\"\n"%padmereco_init_file)
+
+    # Run job script in all instance directories copying program output to compressed logs and
+    # summary lines to job output streams checking for problems
+    JOB_SUMMARY["prog_start"] = now_str()
+    print "Program starting at %s (UTC)"%JOB_SUMMARY["prog_start"]
+    t_prog_start = time.time()
+    JOB_SUMMARY["phases"]["setup"] = round(t_prog_start-t_job_start,3)
+    runs = run_instances(zip(run_dirs,run_lists),check_err_line,stage_chunk)
+    if n_cores > 1: merge_logs(run_dirs)
+
+    JOB_SUMMARY["prog_end"] = now_str()
+    JOB_SUMMARY["phases"]["run"] = round(time.time()-t_prog_start,3)
+    JOB_SUMMARY["instances"] = runs
+    if n_cores == 1: JOB_SUMMARY["program_info"] = runs[0]["program_info"]
+
+    # Job fails if any instance failed. Events of all instances are added up
+    rc_reco = 0
     run_problems = False
-    while True:
-
-        # Handle script output and error streams with select.
-        # Trap "Interrupted system call" error (happens when proxy is renewed)
-        reads = [p.stdout.fileno(),p.stderr.fileno()]
-        try:
-            ret = select.select(reads,[],[],1.)
-        except select.error as ex:
-            if ex[0] == errno.EINTR:
-                continue
-            else:
-                raise
-
-        # Here we can parse the full stdout and stderr streams of the job checking for problems
-        for fd in ret[0]:
-            if fd == p.stdout.fileno():
-                read = p.stdout.readline()
-                sys.stdout.write(read)
-            elif fd == p.stderr.fileno():
-                read = p.stderr.readline()
-                sys.stderr.write(read)
-                if re.match("^.*Error in <TNetXNGFile::Open>: \[ERROR\]",read): run_problems = True
-
-        if p.poll() != None: break
-
-    rc_reco = p.returncode
-
-    print "Program ending at %s (UTC)"%now_str()
+    for run in runs:
+        if n_cores > 1: print "Instance in %s exited with return code %s"%(run["run_dir"],run["exit_code"])
+        if run["exit_code"] != 0 and rc_reco == 0: rc_reco = run["exit_code"]
+        if run["run_problems"]: run_problems = True
+        n_events = run["program_info"].get("Processed Events","")
+        if n_events.isdigit(): JOB_SUMMARY["n_events"] = JOB_SUMMARY.get("n_events",0)+int(n_events)
+    JOB_SUMMARY["prog_exit_code"] = rc_reco
+    JOB_SUMMARY["run_problems"] = run_problems
+
+    # Report staging throughput and time spent by PadmeReco waiting for staged files
+    if stage_chunk:
+        staging = { "files": 0, "bytes": 0, "failed": 0, "time": 0., "stall": 0. }
+        for run in runs:
+            if "staging" in run:
+                for k in staging: staging[k] += run["staging"][k]
+        staging["time"] = round(staging["time"],3)
+        staging["stall"] = round(staging["stall"],3)
+        JOB_SUMMARY["staging"] = staging
+        print "Staged %d input files (%d failed) with %d bytes in %.1f s (%.2f MB/s). Processing stalled for %.1f s"%(staging["files"],staging["failed"],staging["bytes"],staging["time"],staging["bytes"]/1.E6/max(staging["time"],0.001),staging["stall"])
+    print "Program ending at %s (UTC)"%JOB_SUMMARY["prog_end"]
     print "Script exited with return code %s"%rc_reco
 
     if rc_reco != 0 or run_problems:
@@ -198,37 +792,62 @@ exit $rc
             print "WARNING Problems found while parsing program output. Please check log."
         if rc_reco != 0:
             print "WARNING Reconstruction ended with non-zero return code. Please check log."
+        if WATCHDOG_FIRED.is_set():
+            print "WARNING Program was hung and was killed by the watchdog. Please check diagnostics in job error stream."
         print "Output files will not be saved to tape storage."
+        if WATCHDOG_FIRED.is_set(): sys.exit(WATCHDOG_EXIT_CODE)
         sys.exit(1)
 
     print "--- Saving output files ---"
 
     data_ok = True
-    if os.path.exists(output_file):
+    for k in range(n_cores):
+
+        # Each instance produces its own output file, named after the instance if there are more than one
+        output_file = os.path.normpath("%s/data.root"%run_dirs[k])
+        if n_cores == 1:
+            data_dst_file = "%s_%s_reco.root"%(prod_name,job_name)
+        else:
+            data_dst_file = "%s_%s_c%d_reco.root"%(prod_name,job_name,k)
+
+        if not os.path.exists(output_file):
+            print "WARNING File %s does not exist in current directory"%output_file
+            data_ok = False
+            continue
 
         data_src_file = output_file
         data_size = os.path.getsize(data_src_file)
+        t_start = time.time()
         data_adler32 = get_adler32(data_src_file)
+        t_checksum = time.time()-t_start
         data_src_url = "file://%s/%s"%(job_dir,data_src_file)
 
-        data_dst_file = "%s_%s_reco.root"%(prod_name,job_name)
-        data_dst_url = "%s%s/%s"%(srm_uri,storage_dir,data_dst_file)
+        data_dst_path = "%s/%s"%(storage_dir,data_dst_file)
 
         #print "Copying",data_src_url,"to",data_dst_url
         #data_copy_cmd = "gfal-copy %s %s"%(data_src_url,data_dst_url)
         #print ">",data_copy_cmd
         #rc = subprocess.call(data_copy_cmd.split())
-        rc = export_file(data_src_url,data_dst_url)
+        t_start = time.time()
+        (rc,data_endpoint) = upload_file(export_file,data_src_url,data_dst_path,endpoints,data_adler32)
+        data_dst_url = "%s%s"%(data_endpoint or endpoints[0],data_dst_path)
+        JOB_SUMMARY["files"].append({
+            "type": "RECODATA",
+            "name": data_dst_file,
+            "size": data_size,
+            "adler32": data_adler32,
+            "checksum_time": round(t_checksum,3),
+            "url": data_dst_url,
+            "storage_uri": data_endpoint,
+            "transfer_time": round(time.time()-t_start,3),
+            "copied": rc == 0
+        })
         if rc:
             print "WARNING - gfal-copy returned error status %d"%rc
             data_ok = False
         else:
-            print "RECODATA file %s with size %s and adler32 %s copied"%(data_dst_file,data_size,data_adler32)
-
-    else:
-
-        print "WARNING File %s does not exist in current directory"%output_file
-        data_ok = False
+            if data_adler32: print "Checksum ADLER32:%s verified on %s"%(data_adler32,data_dst_url)
+            print "RECODATA file %s with size %s and adler32 %s copied to %s"%(data_dst_file,data_size,data_adler32,data_endpoint)
 
     if not data_ok:
         sys.exit(1)
@@ -238,4 +857,16 @@ exit $rc
 # Execution starts here
 if __name__ == "__main__":
 
-    main(sys.argv[1:])
+    # Always write final job summary, whatever the way the job ends
+    rc = 1
+    try:
+        main(sys.argv[1:])
+        rc = 0
+    except SystemExit as ex:
+        rc = ex.code
+    finally:
+        report_usage()
+        JOB_SUMMARY["time_end"] = now_str()
+        JOB_SUMMARY["exit_code"] = rc
+        write_summary()
+    sys.exit(rc)
@@ -5,18 +5,19 @@ import sys
 import getopt
 import time
 import subprocess
-import shutil
 import shlex
 import re
 import daemon
 import daemon.pidfile
-import random
 import pexpect
 import getpass
 
 from PadmeProdServer import PadmeProdServer
 from PadmeMCDB import PadmeMCDB
 from ProxyHandler import ProxyHandler
+from ProdLayout import ProdLayout
+from SeedService import SeedService
+from ProdPlan import ProdPlan
 
 # Get location of padme-prod software from PADME_PROD env variable
 # Default to ./padme-prod if not set
@@ -46,7 +47,7 @@ PADME_CE_NODE = {
 # Initialize global parameters and set some default values
 PROD_NAME = ""
 PROD_NJOBS = 0
-PROD_NJOBS_MAX = 1000
+PROD_NJOBS_MAX = ProdLayout.NJOBS_MAX
 PROD_MACRO_FILE = ""
 PROD_STORAGE_DIR = ""
 PROD_DIR = ""
@@ -68,12 +69,20 @@ PROD_DESCRIPTION_FILE = ""
 PROD_USER_REQ = "Unknown"
 PROD_NEVENTS_REQ = 0
 PROD_RANDOM_LIST = ""
+PROD_SEED_KEY = ""
+PROD_FAKE = False
+PROD_NCORES = 1
+PROD_NCORES_MAX = 32
+PROD_NSEGMENTS = 1
+PROD_NSEGMENTS_MAX = 100
+PROD_BACKUP_SITES = []
+PROD_UPLOAD_PROBE = 0
 
 def print_help():
 
-    print "PadmeMCProd -n <prod_name> -j <number_of_jobs> -v <version> [-m <macro_file>] [-s <submission_site>] [-C <CE_node> [-P <CE_port]] [-d <storage_site>] [-D <desc_file>] [-U <user>] [-N <events>] [-R <seed_list>] [-V] [-h]"
+    print "PadmeMCProd -n <prod_name> -j <number_of_jobs> -v <version> [-m <macro_file>] [-s <submission_site>] [-C <CE_node> [-P <CE_port]] [-d <storage_site>] [-D <desc_file>] [-U <user>] [-N <events>] [-R <seed_list>] [-K <seed_key>] [-c <cores>] [-g <segments>] [-B <storage_site>] [-T <probe_MB>] [-f] [-V] [-h]"
     print "  -n <prod_name>\tName for the production"
-    print "  -j <number_of_jobs>\tNumber of production jobs to submit. Must be >0 and <=1000"
+    print "  -j <number_of_jobs>\tNumber of production jobs to submit. Must be >0 and <=%d"%PROD_NJOBS_MAX
     print "  -v <version>\t\tVersion of PadmeMC to use for production. Must be installed on CVMFS."
     print "  -m <macro_file>\tMacro file with G4 cards to use. Default: macro/<prod_name>.mac"
     print "  -s <submission_site>\tSite to be used for job submission. Allowed: %s. Default: %s"%(",".join(PADME_CE_NODE.keys()),PROD_RUN_SITE)
@@ -83,7 +92,13 @@ def print_help():
     print "  -D <desc_file>\tFile containing a text describing the production (to be stored in the DB). Default: description/<prod_name>.txt"
     print "  -U <user>\t\tName of user who requested the production (to be stored in the DB). '%s' if not given."%PROD_USER_REQ
     print "  -N <events>\t\tTotal number of events requested by user (to be stored in the DB). %d if not given."%PROD_NEVENTS_REQ
-    print "  -R <seed_list>\tFile with list of random seed pairs to use for jobs. Default: generate automatically."
+    print "  -R <seed_list>\tFile with list of random seed pairs to use for jobs (one per job and core). Default: generate automatically."
+    print "  -K <seed_key>\tKey used to generate random seed pairs. Default: <prod_name>"
+    print "  -c <cores>\t\tNumber of cores requested by each job, which runs one PadmeMC instance per core. Must be >0 and <=%d. Default: %d"%(PROD_NCORES_MAX,PROD_NCORES)
+    print "  -g <segments>\t\tNumber of sequential segments in which the events of each job are simulated. Output files of each segment are stored as soon as it ends. Must be >0 and <=%d. Default: %d"%(PROD_NSEGMENTS_MAX,PROD_NSEGMENTS)
+    print "  -B <storage_site>\tBackup site used by the jobs if output cannot be stored on <storage_site>. Can be repeated to define an ordered list of fallbacks"
+    print "  -T <probe_MB>\t\tSize (MB) of a test file uploaded by each job to all storage sites to choose the fastest one. 0 to disable. Default: %d"%PROD_UPLOAD_PROBE
+    print "  -f\t\t\tFAKE mode: show what would be created without touching grid, storage and DB"
     print "  -V\t\t\tEnable debug mode. Can be repeated to increase verbosity"
 
 def main(argv):
@@ -107,9 +122,15 @@ def main(argv):
     global PROD_USER_REQ
     global PROD_NEVENTS_REQ
     global PROD_RANDOM_LIST
+    global PROD_SEED_KEY
+    global PROD_FAKE
+    global PROD_NCORES
+    global PROD_NSEGMENTS
+    global PROD_BACKUP_SITES
+    global PROD_UPLOAD_PROBE
 
     try:
-        opts,args = getopt.getopt(argv,"hVn:j:v:m:s:C:P:d:D:U:N:R:",[])
+        opts,args = getopt.getopt(argv,"hVn:j:v:m:s:C:P:d:D:U:N:R:K:c:g:B:T:f",[])
     except getopt.GetoptError as e:
         print "Option error: %s"%str(e)
         print_help()
@@ -121,6 +142,8 @@ def main(argv):
             sys.exit(0)
         elif opt == '-V':
             PROD_DEBUG += 1
+        elif opt == '-f':
+            PROD_FAKE = True
         elif opt == '-n':
             PROD_NAME = arg
         elif opt == '-m':
@@ -141,6 +164,8 @@ def main(argv):
             PROD_USER_REQ = arg
         elif opt == '-R':
             PROD_RANDOM_LIST = arg
+        elif opt == '-K':
+            PROD_SEED_KEY = arg
         elif opt == '-s':
             if arg in PADME_CE_NODE.keys():
                 PROD_RUN_SITE = arg
@@ -169,12 +194,47 @@ def main(argv):
                 print "*** ERROR *** Invalid total number of events requested: '%s'"%arg
                 print_help()
                 sys.exit(2)
+        elif opt == '-c':
+            try:
+                PROD_NCORES = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid number of cores: '%s'"%arg
+                print_help()
+                sys.exit(2)
+        elif opt == '-g':
+            try:
+                PROD_NSEGMENTS = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid number of segments: '%s'"%arg
+                print_help()
+                sys.exit(2)
+        elif opt == '-B':
+            if arg in PADME_SRM_URI.keys():
+                if not arg in PROD_BACKUP_SITES: PROD_BACKUP_SITES.append(arg)
+            else:
+                print "*** ERROR *** Invalid backup storage site %s. Valid: %s"%(arg,",".join(PADME_SRM_URI.keys()))
+                print_help()
+                sys.exit(2)
+        elif opt == '-T':
+            try:
+                PROD_UPLOAD_PROBE = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid upload probe size: '%s'"%arg
+                print_help()
+                sys.exit(2)
+
+    # All actions creating the production go through the planner (only recorded in FAKE mode)
+    PLAN = ProdPlan(PROD_FAKE,PROD_DEBUG)
+    PLAN.phase("Checks")
 
     if not PROD_NAME:
         print "*** ERROR *** No production name specified."
         print_help()
         sys.exit(2)
 
+    # Random seeds are generated from the production name unless a different key is given
+    if not PROD_SEED_KEY: PROD_SEED_KEY = PROD_NAME
+
     if not PROD_MC_VERSION:
         print "*** ERROR *** No software version specified."
         print_help()
@@ -191,6 +251,14 @@ def main(argv):
     # Define storage SRM URI according to chosen storage site (will add more options)
     PROD_SRM = PADME_SRM_URI[PROD_STORAGE_SITE]
 
+    # Jobs fall back to backup storage sites (in the given order) if they cannot store output on the main one
+    PROD_SRM_BACKUP = [ PADME_SRM_URI[site] for site in PROD_BACKUP_SITES if site != PROD_STORAGE_SITE ]
+
+    if PROD_UPLOAD_PROBE < 0:
+        print "*** ERROR *** Invalid upload probe size requested: %d MB"%PROD_UPLOAD_PROBE
+        print_help()
+        sys.exit(2)
+
     if PROD_NJOBS == 0:
         print "*** ERROR *** Number of jobs was not specified."
         print_help()
@@ -201,6 +269,16 @@ def main(argv):
         print_help()
         sys.exit(2)
 
+    if PROD_NCORES < 1 or PROD_NCORES > PROD_NCORES_MAX:
+        print "*** ERROR *** Invalid number of cores per job requested: %d - Max allowed: %d."%(PROD_NCORES,PROD_NCORES_MAX)
+        print_help()
+        sys.exit(2)
+
+    if PROD_NSEGMENTS < 1 or PROD_NSEGMENTS > PROD_NSEGMENTS_MAX:
+        print "*** ERROR *** Invalid number of segments per job requested: %d - Max allowed: %d."%(PROD_NSEGMENTS,PROD_NSEGMENTS_MAX)
+        print_help()
+        sys.exit(2)
+
     # If configuration file was not specified, use default
     if not PROD_MACRO_FILE: PROD_MACRO_FILE = "macro/%s.mac"%PROD_NAME
 
@@ -209,6 +287,14 @@ def main(argv):
         print "*** ERROR *** Macro file '%s' does not exist"%PROD_MACRO_FILE
         sys.exit(2)
 
+    # Events of segmented jobs are split among segments changing the /run/beamOn command of the macro
+    if PROD_NSEGMENTS > 1:
+        with open(PROD_MACRO_FILE,"r") as mf:
+            n_beam_on = len([ l for l in mf if re.match("^\s*/run/beamOn\s+\d+\s*$",l) ])
+        if n_beam_on != 1:
+            print "*** ERROR *** Macro file '%s' must contain exactly one /run/beamOn command to be split in segments"%PROD_MACRO_FILE
+            sys.exit(2)
+
     # If storage directory was not specified, use default
     if PROD_STORAGE_DIR == "":
         PROD_STORAGE_DIR = "/mc/%s/%s/sim"%(PROD_MC_VERSION,PROD_NAME)
@@ -217,7 +303,7 @@ def main(argv):
     if PROD_DIR == "":
         version_dir = "prod/%s"%PROD_MC_VERSION
         if not os.path.exists(version_dir):
-            os.mkdir(version_dir)
+            PLAN.mkdir(version_dir)
         elif not os.path.isdir(version_dir):
             print "*** ERROR *** '%s' exists but is not a directory"%version_dir
             sys.exit(2)
@@ -244,13 +330,23 @@ def main(argv):
     print "- Main production directory: %s"%PROD_DIR
     print "- Production script: %s"%PROD_SCRIPT
     print "- PadmeMC macro file: %s"%PROD_MACRO_FILE
+    if PROD_NCORES > 1:
+        print "- Cores per job: %d (one PadmeMC instance per core)"%PROD_NCORES
+    if PROD_NSEGMENTS > 1:
+        print "- Segments per job: %d"%PROD_NSEGMENTS
     print "- Storage SRM: %s"%PROD_SRM
+    if PROD_SRM_BACKUP:
+        print "- Backup storage SRM: %s"%" ".join(PROD_SRM_BACKUP)
+    if PROD_UPLOAD_PROBE:
+        print "- Upload probe size: %d MB"%PROD_UPLOAD_PROBE
     print "- Storage directory: %s"%PROD_STORAGE_DIR
     print "- MyProxy name: %s"%PROD_MYPROXY_NAME
     if PROD_RANDOM_LIST:
         print "- Random seeds list: %s"%PROD_RANDOM_LIST
     else:
-        print "- Random seeds automatically generated"
+        print "- Random seeds automatically generated with key '%s'"%PROD_SEED_KEY
+    if PROD_FAKE:
+        print "- FAKE mode: nothing will be created"
     if PROD_DEBUG:
         print "- Debug level: %d"%PROD_DEBUG
 
@@ -265,69 +361,105 @@ def main(argv):
         sys.exit(2)
 
     # Create list of random seeds reading them from list, if available, or automatically
+    PLAN.phase("Seeds")
+    # Seed pairs are checked against all pairs ever used in the DB to avoid correlated samples
+    SS = SeedService(PROD_SEED_KEY,DB)
+    n_seeds = PROD_NJOBS*PROD_NCORES
     random_seeds = []
     if PROD_RANDOM_LIST:
         if os.path.exists(PROD_RANDOM_LIST):
             with open(PROD_RANDOM_LIST,"r") as rl:
                 for line in rl:
                     # Skip empty and comment lines
-                    if re.match("^\s*$",run) or re.match("^\s*#.*$",line): continue
+                    if re.match("^\s*$",line) or re.match("^\s*#.*$",line): continue
                     # Check if the format is <seed1>,<seed2>
-                    if re.match("^\s*\d+,\d+\s*$",line):
-                        random_seeds.append(line.strip())
+                    pair = SS.parse(line)
+                    if pair:
+                        random_seeds.append(pair)
                     else:
                         print "*** ERROR *** Ill formatted line found in random seeds list %s"%PROD_RANDOM_LIST
                         print line
                         sys.exit(2)
             # Verify we have enough random seeds
-            if len(random_seeds) < PROD_NJOBS:
-                print "*** ERROR *** Random seeds list %s contains %d seed pairs but % are required"%(PROD_RANDOM_LIST,len(random_seeds),PROD_NJOBS)
+            if len(random_seeds) < n_seeds:
+                print "*** ERROR *** Random seeds list %s contains %d seed pairs but %d are required"%(PROD_RANDOM_LIST,len(random_seeds),n_seeds)
+                sys.exit(2)
+            random_seeds = random_seeds[:n_seeds]
+            # Verify that seed pairs are unique and were never used before
+            bad_seeds = SS.check(random_seeds)
+            if bad_seeds == None:
+                print "*** ERROR *** Unable to check random seed pairs against the DB"
+                sys.exit(2)
+            if bad_seeds:
+                print "*** ERROR *** Random seeds list %s contains %d seed pairs which are duplicated or already used"%(PROD_RANDOM_LIST,len(bad_seeds))
+                for pair in bad_seeds: print SS.format(pair)
                 sys.exit(2)
 
         else:
             print "*** ERROR *** Specified random seeds list %s was not found"%PROD_RANDOM_LIST
             sys.exit(2)
     else:
-        # Generate random seed pairs for all jobs using the Python "random" package
-        # As we do not initialize the seed in the "random" package,
-        # "the default is to use the current system time in milliseconds from epoch (1970)"
-        # Therefore each time we run the script we should get a different set of random seeds.
-        for j in range(0,PROD_NJOBS):
-            random_seeds.append("%d,%d"%(random.randint(0,4294967295),random.randint(0,4294967295)))
+        # Generate random seed pairs for all jobs from the seed key
+        # Pairs already used by other productions are skipped
+        random_seeds = SS.generate(n_seeds)
+        if random_seeds == None:
+            print "*** ERROR *** Unable to generate %d unused random seed pairs with key '%s'"%(n_seeds,PROD_SEED_KEY)
+            sys.exit(2)
+
+    # Segments of segmented jobs (except the first one) use seed pairs derived from the seed pairs of the job
+    # Derived pairs must not be in use either and are registered together with the seed pairs of the jobs
+    segment_seeds = []
+    if PROD_NSEGMENTS > 1:
+        segment_seeds = [ SS.segment_pair(pair,s) for pair in random_seeds for s in range(1,PROD_NSEGMENTS) ]
+        bad_seeds = SS.check(random_seeds+segment_seeds)
+        if bad_seeds == None:
+            print "*** ERROR *** Unable to check random seed pairs against the DB"
+            sys.exit(2)
+        if bad_seeds:
+            print "*** ERROR *** %d seed pairs derived for job segments are duplicated or already used. Please use a different seed key or list"%len(bad_seeds)
+            for pair in bad_seeds: print SS.format(pair)
+            sys.exit(2)
 
     # Create long-lived proxy on MyProxy server (also create a local proxy to talk to storage SRM)
-    grid_passwd = getpass.getpass(prompt="Enter GRID pass phrase for this identity:")
+    PLAN.phase("Setup")
     proxy_cmd = "myproxy-init --proxy_lifetime %d --cred_lifetime %d --voms %s --pshost %s --dn_as_username --credname %s --local_proxy"%(PROD_PROXY_LIFETIME,PROD_MYPROXY_LIFETIME,PROD_PROXY_VOMS,PROD_MYPROXY_SERVER,PROD_MYPROXY_NAME)
-    if PROD_DEBUG: print ">",proxy_cmd
-    child = pexpect.spawn(proxy_cmd)
-    try:
-        child.expect("Enter GRID pass phrase for this identity:")
-        if PROD_DEBUG: print child.before
-        child.sendline(grid_passwd)
-        child.expect("Enter MyProxy pass phrase:")
-        if PROD_DEBUG: print child.before
-        child.sendline(PROD_MYPROXY_PASSWD)
-        child.expect("Verifying - Enter MyProxy pass phrase:")
-        if PROD_DEBUG: print child.before
-        child.sendline(PROD_MYPROXY_PASSWD)
-    except:
-        print "*** ERROR *** Unable to register long-lived proxy on %s"%PROD_MYPROXY_SERVER
-        print str(child)
-        sys.exit(2)
+    if PROD_FAKE:
+        PLAN.run(proxy_cmd)
+    else:
+        grid_passwd = getpass.getpass(prompt="Enter GRID pass phrase for this identity:")
+        PLAN.record(proxy_cmd)
+        child = pexpect.spawn(proxy_cmd)
+        try:
+            child.expect("Enter GRID pass phrase for this identity:")
+            if PROD_DEBUG: print child.before
+            child.sendline(grid_passwd)
+            child.expect("Enter MyProxy pass phrase:")
+            if PROD_DEBUG: print child.before
+            child.sendline(PROD_MYPROXY_PASSWD)
+            child.expect("Verifying - Enter MyProxy pass phrase:")
+            if PROD_DEBUG: print child.before
+            child.sendline(PROD_MYPROXY_PASSWD)
+        except:
+            print "*** ERROR *** Unable to register long-lived proxy on %s"%PROD_MYPROXY_SERVER
+            print str(child)
+            sys.exit(2)
 
     # Get position of local proxy to be sent to Condor
+    # In FAKE mode use the default location as no proxy was created
     voms_proxy_local = ""
+    if PROD_FAKE: voms_proxy_local = "/tmp/x509up_u%d"%os.getuid()
     voms_cmd = "voms-proxy-info"
-    if PROD_DEBUG: print "> %s"%voms_cmd
-    p = subprocess.Popen(shlex.split(voms_cmd),stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-    (out,err) = p.communicate()
-    if p.returncode == 0:
-        for l in iter(out.splitlines()):
-            if PROD_DEBUG > 1: print l
-            r = re.match("^\s*path\s+:\s+(\S+)\s*$",l)
-            if r:
-                voms_proxy_local = r.group(1)
-                break
+    if PROD_DEBUG and not PROD_FAKE: print "> %s"%voms_cmd
+    if not PROD_FAKE:
+        p = subprocess.Popen(shlex.split(voms_cmd),stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        (out,err) = p.communicate()
+        if p.returncode == 0:
+            for l in iter(out.splitlines()):
+                if PROD_DEBUG > 1: print l
+                r = re.match("^\s*path\s+:\s+(\S+)\s*$",l)
+                if r:
+                    voms_proxy_local = r.group(1)
+                    break
     if voms_proxy_local == "":
         print "*** ERROR *** Unable get path to local VOMS proxy"
         sys.exit(2)
@@ -336,10 +468,9 @@ def main(argv):
     # Create production directory in the storage SRM (try 3 times before giving up)
     print "- Creating production dir %s on %s"%(PROD_STORAGE_DIR,PROD_SRM)
     gfal_mkdir_cmd = "gfal-mkdir -p %s%s"%(PROD_SRM,PROD_STORAGE_DIR)
-    if PROD_DEBUG: print ">",gfal_mkdir_cmd
     n_try = 0
     while True:
-        if subprocess.call(shlex.split(gfal_mkdir_cmd)) == 0: break
+        if PLAN.run(gfal_mkdir_cmd) == 0: break
         n_try += 1
         if n_try >= 3:
             print "*** ERROR *** unable to create production dir %s on %s"%(PROD_STORAGE_DIR,PROD_SRM)
@@ -347,30 +478,58 @@ def main(argv):
         print "WARNING gfal-mkdir failed. Retry in 5 seconds."
         time.sleep(5)
 
+    # Backup storage sites are only used if the main one fails: do not stop the production if they are not available
+    for srm in PROD_SRM_BACKUP:
+        print "- Creating production dir %s on %s"%(PROD_STORAGE_DIR,srm)
+        if PLAN.run("gfal-mkdir -p %s%s"%(srm,PROD_STORAGE_DIR)):
+            print "WARNING unable to create production dir %s on backup storage %s"%(PROD_STORAGE_DIR,srm)
+
     # Create production directory to host support dirs for all jobs
     print "- Creating production dir %s"%PROD_DIR
     try:
-        os.mkdir(PROD_DIR)
+        PLAN.mkdir(PROD_DIR)
     except:
         print "*** ERROR *** unable to create local production dir %s"%PROD_DIR
         sys.exit(2)
 
-    # Create new production in DB
+    # Create new production in DB and register seed pairs used by this production
+    PLAN.phase("DB")
     print "- Creating new production in DB"
     proxy_info = "%s:%d %s %s"%(PROD_MYPROXY_SERVER,PROD_MYPROXY_PORT,PROD_MYPROXY_NAME,PROD_MYPROXY_PASSWD)
-    prodId = DB.create_mcprod(PROD_NAME,PROD_DESCRIPTION,PROD_USER_REQ,PROD_NEVENTS_REQ,PROD_CE,PROD_MC_VERSION,PROD_DIR,PROD_SRM,PROD_STORAGE_DIR,proxy_info,PROD_NJOBS)
+    PLAN.add_db_rows("production")
+    PLAN.add_db_rows("mc_prod",1,len(PROD_DESCRIPTION))
+    PLAN.add_db_rows("seed",len(random_seeds)+len(segment_seeds))
+    if PROD_FAKE:
+        prodId = 0
+    else:
+        prodId = DB.create_mcprod(PROD_NAME,PROD_DESCRIPTION,PROD_USER_REQ,PROD_NEVENTS_REQ,PROD_CE,PROD_MC_VERSION,PROD_DIR,PROD_SRM,PROD_STORAGE_DIR,proxy_info,PROD_NJOBS,random_seeds+segment_seeds)
+        if not prodId:
+            # Nothing was written to the DB: remove the (still empty) dirs created for this production
+            print "*** ERROR *** Unable to create production or register its random seed pairs in DB (seed pairs may have been used by a concurrent production)"
+            os.rmdir(PROD_DIR)
+            for srm in [PROD_SRM]+PROD_SRM_BACKUP:
+                if PLAN.run("gfal-rmdir %s%s"%(srm,PROD_STORAGE_DIR)):
+                    print "WARNING unable to remove production dir %s on %s"%(PROD_STORAGE_DIR,srm)
+            sys.exit(2)
 
     # Create job structures
+    PLAN.phase("Jobs")
     print "- Creating directory structure for production jobs"
+    layout = ProdLayout(PROD_DIR)
+
+    # All jobs share the same macro: read it once (stored only once in the DB)
+    with open(PROD_MACRO_FILE,"r") as jcf: jobCfg=jcf.read()
+    PLAN.add_db_rows("job_config",1,len(jobCfg))
+
     for j in range(0,PROD_NJOBS):
 
-        jobName = "job%05d"%j
+        jobName = layout.job_name(j)
 
         # Create dir to hold individual job info
-        jobLocalDir = jobName
-        jobDir = "%s/%s"%(PROD_DIR,jobLocalDir)
+        jobLocalDir = layout.job_local_dir(j)
+        jobDir = layout.job_dir(j)
         try:
-            os.mkdir(jobDir)
+            PLAN.create_job_dir(layout,j)
         except:
             print "*** ERROR *** Unable to create job directory %s"%jobDir
             sys.exit(2)
@@ -378,7 +537,7 @@ def main(argv):
         # Copy production script to job dir
         jobScript = "%s/job.py"%jobDir
         try:
-            shutil.copyfile(PROD_SCRIPT,jobScript)
+            PLAN.copy_file(PROD_SCRIPT,jobScript)
         except:
             print "*** ERROR *** Unable to copy job script file %s to %s"%(PROD_SCRIPT,jobScript)
             sys.exit(2)
@@ -386,45 +545,53 @@ def main(argv):
         # Copy common configuration file to job dir
         jobCfgFile = "%s/job.mac"%jobDir
         try:
-            shutil.copyfile(PROD_MACRO_FILE,jobCfgFile)
+            PLAN.copy_file(PROD_MACRO_FILE,jobCfgFile)
         except:
             print "*** ERROR *** Unable to copy job macro file %s to %s"%(PROD_MACRO_FILE,jobCfgFile)
             sys.exit(2)
 
-        # Get random seed pair from list
-        jobSeeds = random_seeds.pop(0)
+        # Get random seed pairs from list: one per core, separated by ":"
+        jobSeeds = ":".join([ SS.format(pair) for pair in random_seeds[j*PROD_NCORES:(j+1)*PROD_NCORES] ])
 
         # Create SUB file in job dir
         jobSUB = "%s/job.sub"%jobDir
-        with open(jobSUB,"w") as jf:
-            jf.write("universe = vanilla\n")
-            jf.write("+Owner = undefined\n")
-            jf.write("executable = /usr/bin/python\n")
-            jf.write("transfer_executable = False\n")
-            jf.write("arguments = -u job.py job.mac %s %s %s %s %s %s\n"%(PROD_NAME,jobName,PROD_MC_VERSION,PROD_STORAGE_DIR,PROD_SRM,jobSeeds))
-            jf.write("output = job.out\n")
-            jf.write("error = job.err\n")
-            jf.write("log = job.log\n")
-            jf.write("should_transfer_files = yes\n")
-            jf.write("transfer_input_files = job.py,job.mac,%s\n"%voms_proxy_local)
-            jf.write("transfer_output_files = job.sh\n")
-            jf.write("when_to_transfer_output = on_exit\n")
-            jf.write("x509userproxy = %s\n"%voms_proxy_local)
-            jf.write("MyProxyHost = %s:%d\n"%(PROD_MYPROXY_SERVER,PROD_MYPROXY_PORT))
-            jf.write("MyProxyCredentialName = %s\n"%PROD_MYPROXY_NAME)
-            jf.write("MyProxyPassword = %s\n"%PROD_MYPROXY_PASSWD)
-            jf.write("MyProxyRefreshThreshold = 600\n")
-            jf.write("MyProxyNewProxyLifetime = 1440\n")
-            jf.write("queue\n")
+        sub = "universe = vanilla\n"
+        sub += "+Owner = undefined\n"
+        sub += "executable = /usr/bin/python\n"
+        sub += "transfer_executable = False\n"
+        jobArgs = "-u job.py job.mac %s %s %s %s %s %s"%(PROD_NAME,jobName,PROD_MC_VERSION,PROD_STORAGE_DIR,",".join([PROD_SRM]+PROD_SRM_BACKUP),jobSeeds)
+        if PROD_NSEGMENTS > 1 or PROD_UPLOAD_PROBE: jobArgs += " %d"%PROD_NSEGMENTS
+        if PROD_UPLOAD_PROBE: jobArgs += " %d"%PROD_UPLOAD_PROBE
+        sub += "arguments = %s\n"%jobArgs
+        sub += "output = job.out\n"
+        sub += "error = job.err\n"
+        sub += "log = job.log\n"
+        if PROD_NCORES > 1: sub += "request_cpus = %d\n"%PROD_NCORES
+        sub += "should_transfer_files = yes\n"
+        sub += "transfer_input_files = job.py,job.mac,%s\n"%voms_proxy_local
+        sub += "transfer_output_files = job.sh,program.out.gz,program.err.gz,job.json\n"
+        sub += "when_to_transfer_output = on_exit\n"
+        sub += "x509userproxy = %s\n"%voms_proxy_local
+        sub += "MyProxyHost = %s:%d\n"%(PROD_MYPROXY_SERVER,PROD_MYPROXY_PORT)
+        sub += "MyProxyCredentialName = %s\n"%PROD_MYPROXY_NAME
+        sub += "MyProxyPassword = %s\n"%PROD_MYPROXY_PASSWD
+        sub += "MyProxyRefreshThreshold = 600\n"
+        sub += "MyProxyNewProxyLifetime = 1440\n"
+        sub += "queue\n"
+        PLAN.write_file(jobSUB,sub)
 
         # Create job entry in DB and register job (jobList is only used in Reco jobs)
-        with open(jobCfgFile,"r") as jcf: jobCfg=jcf.read()
         jobList = ""
-        DB.create_job(prodId,jobName,jobLocalDir,jobCfg,jobList,jobSeeds)
+        PLAN.add_db_rows("job",1,len(jobName)+len(jobLocalDir)+len(jobSeeds))
+        if not PROD_FAKE: DB.create_job(prodId,jobName,jobLocalDir,jobCfg,jobList,jobSeeds)
 
     # From now on we do not need the DB anymore: close connection
     DB.close_db()
 
+    # Show what was (or would have been) created. In FAKE mode we stop here
+    PLAN.report()
+    if PROD_FAKE: sys.exit(0)
+
     # Prepare daemon context
 
     # Assume that the current directory is the top level MC Production directory
@@ -7,11 +7,13 @@ import subprocess
 import re
 import shlex
 import random
+import resource
 
 from PadmeMCDB import PadmeMCDB
 from Logger import Logger
 from ProxyHandler import ProxyHandler
 from ProdJob import ProdJob
+from ProdLayout import ProdLayout
 
 class PadmeProdServer:
 
@@ -79,12 +81,26 @@ class PadmeProdServer:
         # Define name of control file: if found, this production will cleanly quit
         quit_file = "%s/quit"%prod_dir
 
-        # Get list of job ids for this production
-        job_id_list = self.db.get_job_list(self.prod_id)
-        if len(job_id_list) != prod_njobs:
-            print "*** ERROR *** Number of jobs in DB and in production are different: %s != %s"%(len(job_id_list),prod_njobs)
+        # Get id, name and directory of all jobs of this production with a single DB query
+        job_info_list = self.db.get_job_list_info(self.prod_id)
+        if len(job_info_list) != prod_njobs:
+            print "*** ERROR *** Number of jobs in DB and in production are different: %s != %s"%(len(job_info_list),prod_njobs)
             sys.exit(1)
 
+        # Verify that all job directories exist
+        layout = ProdLayout(prod_dir)
+        job_dir_set = set()
+        for (job_name,job_local_dir) in layout.list_job_dirs(): job_dir_set.add(job_local_dir)
+        for (job_id,job_name,job_local_dir,job_status) in job_info_list:
+            if not job_local_dir in job_dir_set:
+                print "*** ERROR *** Directory '%s' of job %s not found in production directory '%s'"%(job_local_dir,job_name,prod_dir)
+                sys.exit(1)
+        job_dir_set = None
+
+        # For very large productions do not report jobs in a final state at each iteration
+        report_final = True
+        if prod_njobs > ProdLayout.JOBS_PER_SHARD: report_final = False
+
         # Get list of available CEs
         ce_list = list(prod_ce.split(" "))
 
@@ -101,8 +117,17 @@ class PadmeProdServer:
 
         # Create and configure job handlers. Assign each job to a different CE (round robin)
         ce_idx = random.randint(0,len(ce_list)-1)
-        for job_id in job_id_list:
-            self.job_list.append(ProdJob(job_id,ce_list[ce_idx],self.db,self.debug))
+        for (job_id,job_name,job_local_dir,job_status) in job_info_list:
+            job = ProdJob(job_id,ce_list[ce_idx],self.db,self.debug,job_name,"%s/%s"%(prod_dir,job_local_dir))
+            job.report_final = report_final
+            # Jobs which reached a final state in a previous run of the production daemon are not resubmitted
+            if job_status == 2 or job_status == 3:
+                job.job_status = job_status
+                if job_status == 2:
+                    job.final_report = "- %-8s %-60s %s"%(job_name,"PREVIOUS-RUN","DONE_OK")
+                else:
+                    job.final_report = "- %-8s %-60s %s"%(job_name,"PREVIOUS-RUN","FAILED")
+            self.job_list.append(job)
             ce_idx += 1
             if ce_idx >= len(ce_list): ce_idx = 0
     
@@ -129,6 +154,7 @@ class PadmeProdServer:
                 self.quit_production()
 
             # Call method to check jobs status and handle each job accordingly
+            cycle_start = time.time()
             (jobs_created,jobs_active,jobs_success,jobs_fail,jobs_undef) = self.handle_jobs()
 
             # Update database if any new job reached final state
@@ -141,6 +167,9 @@ class PadmeProdServer:
             # Show current production state
             print "Jobs: unsubmitted %d active %d success %d fail %d undef %d"%(jobs_created,jobs_active,jobs_success,jobs_fail,jobs_undef)
 
+            # Show duration of this iteration and memory used by the daemon (ru_maxrss is in kB)
+            print "Iteration time %.1f s - Max memory %.1f MB"%(time.time()-cycle_start,resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.)
+
             # If all jobs are in a final state (either success or fail), production is over
             if jobs_created+jobs_active+jobs_undef == 0:
                 print "--- No unfinished jobs left: production is done ---"
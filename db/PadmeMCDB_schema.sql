@@ -54,9 +54,11 @@ CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`job` (
   `id` INT UNSIGNED NOT NULL AUTO_INCREMENT COMMENT 'Id of job (internal to DB).',
   `production_id` INT UNSIGNED NOT NULL COMMENT 'Production of which this job is part',
   `name` VARCHAR(250) NOT NULL COMMENT 'Name of the job. Usually jobNNNN. Max length set to 200 char due to MySQL UNIQUE key limit.',
-  `configuration` TEXT NULL COMMENT 'Copy of configuration file (if any) used for this job',
-  `input_list` TEXT NULL COMMENT 'List of input files (if any) used for this job',
-  `job_dir` VARCHAR(1024) NULL COMMENT 'Directory used to store job files (script,jdl,log,...). Path is relative to top production manager directory. Usually set to \"prod/<prod_name>/<job_name>\".',
+  `configuration` TEXT NULL COMMENT 'Copy of configuration file (if any) used for this job. Only used by old jobs: see config_hash',
+  `config_hash` CHAR(40) NULL COMMENT 'SHA1 hash of configuration file (if any) used for this job. Configuration is stored in job_config table',
+  `input_prefix` VARCHAR(1024) NULL COMMENT 'Common prefix of all files in input_list',
+  `input_list` TEXT NULL COMMENT 'List of input files (if any) used for this job. If input_prefix is set, only the part following the prefix is stored',
+  `job_dir` VARCHAR(1024) NULL COMMENT 'Directory used to store job files (script,jdl,log,...). Path is relative to production directory. Usually set to \"jobs/<NN>/<job_name>\" (\"<job_name>\" for old productions).',
   `random` VARCHAR(1024) NULL COMMENT 'Random settings for this job.',
   `status` INT NULL COMMENT 'Job status\n0: Created\n1: Active\n2: Successful\n3: Failed\n',
   `time_create` DATETIME NULL COMMENT 'Time when job was created (UTC)',
@@ -74,6 +76,40 @@ CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`job` (
 ENGINE = InnoDB;
 
 
+-- -----------------------------------------------------
+-- Table `PadmeMCDB`.`job_config`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `PadmeMCDB`.`job_config` ;
+
+CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`job_config` (
+  `id` INT UNSIGNED NOT NULL AUTO_INCREMENT COMMENT 'Id of configuration (internal to DB).',
+  `production_id` INT UNSIGNED NOT NULL COMMENT 'Production using this configuration',
+  `hash` CHAR(40) NOT NULL COMMENT 'SHA1 hash of configuration. Referenced by job.config_hash',
+  `configuration` TEXT NULL COMMENT 'Configuration file shared by all jobs with this hash',
+  PRIMARY KEY (`id`),
+  UNIQUE INDEX `prodid_hash_UNIQUE` (`production_id` ASC, `hash` ASC),
+  CONSTRAINT `fk_job_config_production`
+    FOREIGN KEY (`production_id`)
+    REFERENCES `PadmeMCDB`.`production` (`id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION)
+ENGINE = InnoDB;
+
+
+-- -----------------------------------------------------
+-- Table `PadmeMCDB`.`seed`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `PadmeMCDB`.`seed` ;
+
+CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`seed` (
+  `seed1` INT UNSIGNED NOT NULL COMMENT 'First random seed of the pair',
+  `seed2` INT UNSIGNED NOT NULL COMMENT 'Second random seed of the pair',
+  `production_id` INT UNSIGNED NULL COMMENT 'Production which used this seed pair. Not a foreign key: seed pairs are never reused, even if the production is removed',
+  PRIMARY KEY (`seed1`, `seed2`),
+  INDEX `seed_prodid_idx` (`production_id` ASC))
+ENGINE = InnoDB;
+
+
 -- -----------------------------------------------------
 -- Table `PadmeMCDB`.`file`
 -- -----------------------------------------------------
@@ -90,6 +126,8 @@ CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`file` (
   `n_events` BIGINT UNSIGNED NULL COMMENT 'Number of events in file',
   `size` BIGINT UNSIGNED NULL COMMENT 'Size of file in bytes',
   `adler32` CHAR(8) NULL COMMENT 'ADLER32 checksum for file',
+  `storage_uri` VARCHAR(1024) NULL COMMENT 'URI of the storage endpoint where the file was copied. NULL: storage_uri of the production.',
+  `retired` DATETIME NULL COMMENT 'Time when the file was removed from storage after being merged into a larger file (UTC).',
   PRIMARY KEY (`id`),
   UNIQUE INDEX `name_UNIQUE` (`name` ASC),
   INDEX `fk_file_job1_idx` (`job_id` ASC),
@@ -101,6 +139,36 @@ CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`file` (
 ENGINE = InnoDB;
 
 
+-- -----------------------------------------------------
+-- Table `PadmeMCDB`.`file_lineage`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `PadmeMCDB`.`file_lineage` ;
+
+CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`file_lineage` (
+  `id` INT UNSIGNED NOT NULL AUTO_INCREMENT COMMENT 'Id of lineage entry (internal to DB).',
+  `input_name` VARCHAR(250) NOT NULL COMMENT 'Name of the input file (N.B. filename only, not full path).',
+  `kind` VARCHAR(32) NOT NULL DEFAULT 'RECO' COMMENT 'Kind of processing of the input file: RECO (reconstruction) or MERGE (merge of small files).',
+  `reco_version` VARCHAR(250) NULL COMMENT 'Version of the PadmeReco program used to process the input file. NULL for MERGE lineage.',
+  `job_id` INT UNSIGNED NOT NULL COMMENT 'Id of the job which processes the input file.',
+  `output_seq_index` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'Sequential number within the job of the output file built from the input file (PadmeReco instance of multicore jobs).',
+  `output_file_id` INT UNSIGNED NULL COMMENT 'Id of the file produced by the job. Set when the job output is registered.',
+  PRIMARY KEY (`id`),
+  INDEX `input_kind_version_idx` (`input_name` ASC, `kind` ASC, `reco_version` ASC),
+  INDEX `fk_file_lineage_job_idx` (`job_id` ASC),
+  INDEX `fk_file_lineage_file_idx` (`output_file_id` ASC),
+  CONSTRAINT `fk_file_lineage_job`
+    FOREIGN KEY (`job_id`)
+    REFERENCES `PadmeMCDB`.`job` (`id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION,
+  CONSTRAINT `fk_file_lineage_file`
+    FOREIGN KEY (`output_file_id`)
+    REFERENCES `PadmeMCDB`.`file` (`id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION)
+ENGINE = InnoDB;
+
+
 -- -----------------------------------------------------
 -- Table `PadmeMCDB`.`mc_prod`
 -- -----------------------------------------------------
@@ -144,6 +212,34 @@ CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`reco_prod` (
 ENGINE = InnoDB;
 
 
+-- -----------------------------------------------------
+-- Table `PadmeMCDB`.`merge_prod`
+-- -----------------------------------------------------
+DROP TABLE IF EXISTS `PadmeMCDB`.`merge_prod` ;
+
+CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`merge_prod` (
+  `id` INT UNSIGNED NOT NULL AUTO_INCREMENT COMMENT 'Id of production. Positive number.',
+  `production_id` INT UNSIGNED NOT NULL COMMENT 'Pointer to production table',
+  `description` TEXT NULL COMMENT 'Free field to hold a human readable description of the production',
+  `source_production_id` INT UNSIGNED NOT NULL COMMENT 'Production whose output files are merged',
+  `file_type` VARCHAR(1024) NULL COMMENT 'Type of the output files which are merged (e.g. MCHSTO, RECODATA)',
+  `target_size` BIGINT UNSIGNED NULL COMMENT 'Target size (bytes) of merged files',
+  PRIMARY KEY (`id`),
+  INDEX `fk_merge_prod_production1_idx` (`production_id` ASC),
+  INDEX `fk_merge_prod_production2_idx` (`source_production_id` ASC),
+  CONSTRAINT `fk_merge_prod_production1`
+    FOREIGN KEY (`production_id`)
+    REFERENCES `PadmeMCDB`.`production` (`id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION,
+  CONSTRAINT `fk_merge_prod_production2`
+    FOREIGN KEY (`source_production_id`)
+    REFERENCES `PadmeMCDB`.`production` (`id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION)
+ENGINE = InnoDB;
+
+
 -- -----------------------------------------------------
 -- Table `PadmeMCDB`.`job_submit`
 -- -----------------------------------------------------
@@ -153,7 +249,7 @@ CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`job_submit` (
   `id` INT UNSIGNED NOT NULL AUTO_INCREMENT COMMENT 'Id of job submisson (internal to DB).',
   `job_id` INT UNSIGNED NOT NULL COMMENT 'Reference to job being submitted',
   `submit_index` INT NULL COMMENT 'Submission index (0: initial submission, 1: first resubmission, etc.)',
-  `status` INT NULL COMMENT 'Submitted Job Status\n0: UNSUBMITTED\n1: REGISTERED\n2: PENDING\n3: IDLE\n4: RUNNING\n5: REALLY-RUNNING\n6: HELD\n7: DONE-OK\n8: DONE-FAILED\n9: CANCELLED\n10: ABORTED\n11: UNKNOWN\n12: UNDEF\n107: DONE-OK, output problem\n108: DONE-FAILED, output problem\n109: CANCELLED, output problem\n207: DONE_OK, rc!=0\n',
+  `status` INT NULL COMMENT 'Submitted Job Status\n0: UNSUBMITTED\n1: REGISTERED\n2: PENDING\n3: IDLE\n4: RUNNING\n5: REALLY-RUNNING\n6: HELD\n7: DONE-OK\n8: DONE-FAILED\n9: CANCELLED\n10: ABORTED\n11: UNKNOWN\n12: UNDEF\n107: DONE-OK, output problem\n108: DONE-FAILED, output problem\n109: CANCELLED, output problem\n207: DONE_OK, rc!=0\n307: DONE_OK, hung job killed\n',
   `exit_code` VARCHAR(45) NULL COMMENT 'Exit code of job (if any)',
   `description` VARCHAR(1024) NULL COMMENT 'Description associated to final job status (if any).',
   `ce_job_id` VARCHAR(1024) NULL COMMENT 'Id assigned to the job by the CE.',
@@ -166,6 +262,16 @@ CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`job_submit` (
   `time_job_end` DATETIME NULL COMMENT 'Time when job ended (UTC)',
   `time_run_start` DATETIME NULL COMMENT 'Time when program actually started (UTC).',
   `time_run_end` DATETIME NULL COMMENT 'Time when program actually ended (UTC).',
+  `cpu_min` FLOAT NULL COMMENT 'Minimum CPU usage (%) of job processes over all samples (100% = one core).',
+  `cpu_avg` FLOAT NULL COMMENT 'Average CPU usage (%) of job processes over all samples (100% = one core).',
+  `cpu_max` FLOAT NULL COMMENT 'Maximum CPU usage (%) of job processes over all samples (100% = one core).',
+  `rss_peak` BIGINT UNSIGNED NULL COMMENT 'Peak resident memory (bytes) of job processes.',
+  `read_bytes` BIGINT UNSIGNED NULL COMMENT 'Bytes read from storage devices by job processes.',
+  `write_bytes` BIGINT UNSIGNED NULL COMMENT 'Bytes written to storage devices by job processes.',
+  `setup_time` FLOAT NULL COMMENT 'Duration (s) of job setup, from job start to program start.',
+  `run_time` FLOAT NULL COMMENT 'Duration (s) of program execution.',
+  `checksum_time` FLOAT NULL COMMENT 'Time (s) spent computing checksums of output files.',
+  `upload_time` FLOAT NULL COMMENT 'Duration (s) of output files upload.',
   PRIMARY KEY (`id`),
   INDEX `fk_job_submit_job1_idx` (`job_id` ASC),
   UNIQUE INDEX `job_id_index_UNIQUE` (`job_id` ASC, `submit_index` ASC),
@@ -177,6 +283,25 @@ CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`job_submit` (
 ENGINE = InnoDB;
 
 
+-- -----------------------------------------------------
+-- View `PadmeMCDB`.`job_payload`
+-- Full configuration and input list of each job
+-- -----------------------------------------------------
+DROP VIEW IF EXISTS `PadmeMCDB`.`job_payload` ;
+
+CREATE VIEW `PadmeMCDB`.`job_payload` AS
+SELECT
+  j.id            AS job_id,
+  j.production_id AS production_id,
+  j.name          AS name,
+  COALESCE(c.configuration,j.configuration) AS configuration,
+  CASE WHEN j.input_prefix IS NULL OR j.input_prefix = '' THEN j.input_list
+       ELSE CONCAT(j.input_prefix,REPLACE(TRIM(TRAILING '\n' FROM j.input_list),'\n',CONCAT('\n',j.input_prefix)),'\n')
+  END             AS input_list
+FROM job j
+  LEFT JOIN job_config c ON c.production_id=j.production_id AND c.hash=j.config_hash;
+
+
 SET SQL_MODE=@OLD_SQL_MODE;
 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS;
 SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS;
@@ -0,0 +1,159 @@
+-- Updates to apply to an existing PadmeMCDB database to bring it in line with PadmeMCDB_schema.sql
+-- Sections are in chronological order: apply only those not yet applied to your database
+
+USE `PadmeMCDB` ;
+
+-- -----------------------------------------------------
+-- Shared job configurations and compressed input lists
+-- -----------------------------------------------------
+
+ALTER TABLE `PadmeMCDB`.`job`
+  ADD COLUMN `config_hash` CHAR(40) NULL COMMENT 'SHA1 hash of configuration file (if any) used for this job. Configuration is stored in job_config table' AFTER `configuration`,
+  ADD COLUMN `input_prefix` VARCHAR(1024) NULL COMMENT 'Common prefix of all files in input_list' AFTER `config_hash`;
+
+CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`job_config` (
+  `id` INT UNSIGNED NOT NULL AUTO_INCREMENT COMMENT 'Id of configuration (internal to DB).',
+  `production_id` INT UNSIGNED NOT NULL COMMENT 'Production using this configuration',
+  `hash` CHAR(40) NOT NULL COMMENT 'SHA1 hash of configuration. Referenced by job.config_hash',
+  `configuration` TEXT NULL COMMENT 'Configuration file shared by all jobs with this hash',
+  PRIMARY KEY (`id`),
+  UNIQUE INDEX `prodid_hash_UNIQUE` (`production_id` ASC, `hash` ASC),
+  CONSTRAINT `fk_job_config_production`
+    FOREIGN KEY (`production_id`)
+    REFERENCES `PadmeMCDB`.`production` (`id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION)
+ENGINE = InnoDB;
+
+CREATE OR REPLACE VIEW `PadmeMCDB`.`job_payload` AS
+SELECT
+  j.id            AS job_id,
+  j.production_id AS production_id,
+  j.name          AS name,
+  COALESCE(c.configuration,j.configuration) AS configuration,
+  CASE WHEN j.input_prefix IS NULL OR j.input_prefix = '' THEN j.input_list
+       ELSE CONCAT(j.input_prefix,REPLACE(TRIM(TRAILING '\n' FROM j.input_list),'\n',CONCAT('\n',j.input_prefix)),'\n')
+  END             AS input_list
+FROM job j
+  LEFT JOIN job_config c ON c.production_id=j.production_id AND c.hash=j.config_hash;
+
+-- Move configurations of existing jobs to the job_config table
+INSERT IGNORE INTO `PadmeMCDB`.`job_config` (production_id,hash,configuration)
+  SELECT production_id,SHA1(configuration),configuration FROM `PadmeMCDB`.`job` WHERE configuration IS NOT NULL AND configuration != '';
+UPDATE `PadmeMCDB`.`job` SET config_hash = SHA1(configuration), configuration = NULL WHERE configuration IS NOT NULL AND configuration != '';
+
+-- -----------------------------------------------------
+-- Global index of random seed pairs used by MC productions
+-- -----------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`seed` (
+  `seed1` INT UNSIGNED NOT NULL COMMENT 'First random seed of the pair',
+  `seed2` INT UNSIGNED NOT NULL COMMENT 'Second random seed of the pair',
+  `production_id` INT UNSIGNED NULL COMMENT 'Production which used this seed pair. Not a foreign key: seed pairs are never reused, even if the production is removed',
+  PRIMARY KEY (`seed1`, `seed2`),
+  INDEX `seed_prodid_idx` (`production_id` ASC))
+ENGINE = InnoDB;
+
+-- Register seed pairs used by existing MC jobs
+INSERT IGNORE INTO `PadmeMCDB`.`seed` (seed1,seed2,production_id)
+  SELECT SUBSTRING_INDEX(random,',',1),SUBSTRING_INDEX(random,',',-1),production_id FROM `PadmeMCDB`.`job` WHERE random REGEXP '^[0-9]+,[0-9]+$';
+
+-- -----------------------------------------------------
+-- Lineage of input files processed by reconstruction jobs
+-- -----------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`file_lineage` (
+  `id` INT UNSIGNED NOT NULL AUTO_INCREMENT COMMENT 'Id of lineage entry (internal to DB).',
+  `input_name` VARCHAR(250) NOT NULL COMMENT 'Name of the input file (N.B. filename only, not full path).',
+  `reco_version` VARCHAR(250) NOT NULL COMMENT 'Version of the PadmeReco program used to process the input file.',
+  `job_id` INT UNSIGNED NOT NULL COMMENT 'Id of the job which processes the input file.',
+  `output_file_id` INT UNSIGNED NULL COMMENT 'Id of the file produced by the job. Set when the job output is registered.',
+  PRIMARY KEY (`id`),
+  INDEX `input_version_idx` (`input_name` ASC, `reco_version` ASC),
+  INDEX `fk_file_lineage_job_idx` (`job_id` ASC),
+  INDEX `fk_file_lineage_file_idx` (`output_file_id` ASC),
+  CONSTRAINT `fk_file_lineage_job`
+    FOREIGN KEY (`job_id`)
+    REFERENCES `PadmeMCDB`.`job` (`id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION,
+  CONSTRAINT `fk_file_lineage_file`
+    FOREIGN KEY (`output_file_id`)
+    REFERENCES `PadmeMCDB`.`file` (`id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION)
+ENGINE = InnoDB;
+
+-- -----------------------------------------------------
+-- Resource usage and phase durations of submitted jobs
+-- -----------------------------------------------------
+
+ALTER TABLE `PadmeMCDB`.`job_submit`
+  ADD COLUMN `cpu_min` FLOAT NULL COMMENT 'Minimum CPU usage (%) of job processes over all samples (100% = one core).' AFTER `time_run_end`,
+  ADD COLUMN `cpu_avg` FLOAT NULL COMMENT 'Average CPU usage (%) of job processes over all samples (100% = one core).' AFTER `cpu_min`,
+  ADD COLUMN `cpu_max` FLOAT NULL COMMENT 'Maximum CPU usage (%) of job processes over all samples (100% = one core).' AFTER `cpu_avg`,
+  ADD COLUMN `rss_peak` BIGINT UNSIGNED NULL COMMENT 'Peak resident memory (bytes) of job processes.' AFTER `cpu_max`,
+  ADD COLUMN `read_bytes` BIGINT UNSIGNED NULL COMMENT 'Bytes read from storage devices by job processes.' AFTER `rss_peak`,
+  ADD COLUMN `write_bytes` BIGINT UNSIGNED NULL COMMENT 'Bytes written to storage devices by job processes.' AFTER `read_bytes`,
+  ADD COLUMN `setup_time` FLOAT NULL COMMENT 'Duration (s) of job setup, from job start to program start.' AFTER `write_bytes`,
+  ADD COLUMN `run_time` FLOAT NULL COMMENT 'Duration (s) of program execution.' AFTER `setup_time`,
+  ADD COLUMN `checksum_time` FLOAT NULL COMMENT 'Time (s) spent computing checksums of output files.' AFTER `run_time`,
+  ADD COLUMN `upload_time` FLOAT NULL COMMENT 'Duration (s) of output files upload.' AFTER `checksum_time`;
+
+-- -----------------------------------------------------
+-- Productions merging small output files of other productions
+-- Lineage of merged files is stored in file_lineage with kind set to 'MERGE'
+-- -----------------------------------------------------
+
+CREATE TABLE IF NOT EXISTS `PadmeMCDB`.`merge_prod` (
+  `id` INT UNSIGNED NOT NULL AUTO_INCREMENT COMMENT 'Id of production. Positive number.',
+  `production_id` INT UNSIGNED NOT NULL COMMENT 'Pointer to production table',
+  `description` TEXT NULL COMMENT 'Free field to hold a human readable description of the production',
+  `source_production_id` INT UNSIGNED NOT NULL COMMENT 'Production whose output files are merged',
+  `file_type` VARCHAR(1024) NULL COMMENT 'Type of the output files which are merged (e.g. MCHSTO, RECODATA)',
+  `target_size` BIGINT UNSIGNED NULL COMMENT 'Target size (bytes) of merged files',
+  PRIMARY KEY (`id`),
+  INDEX `fk_merge_prod_production1_idx` (`production_id` ASC),
+  INDEX `fk_merge_prod_production2_idx` (`source_production_id` ASC),
+  CONSTRAINT `fk_merge_prod_production1`
+    FOREIGN KEY (`production_id`)
+    REFERENCES `PadmeMCDB`.`production` (`id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION,
+  CONSTRAINT `fk_merge_prod_production2`
+    FOREIGN KEY (`source_production_id`)
+    REFERENCES `PadmeMCDB`.`production` (`id`)
+    ON DELETE NO ACTION
+    ON UPDATE NO ACTION)
+ENGINE = InnoDB;
+
+ALTER TABLE `PadmeMCDB`.`file`
+  ADD COLUMN `retired` DATETIME NULL COMMENT 'Time when the file was removed from storage after being merged into a larger file (UTC).' AFTER `adler32`;
+
+-- -----------------------------------------------------
+-- Storage endpoint of each file: jobs can copy their output files to alternative endpoints
+-- -----------------------------------------------------
+
+ALTER TABLE `PadmeMCDB`.`file`
+  ADD COLUMN `storage_uri` VARCHAR(1024) NULL COMMENT 'URI of the storage endpoint where the file was copied. NULL: storage_uri of the production.' AFTER `adler32`;
+
+-- -----------------------------------------------------
+-- Multicore reconstruction jobs produce one output file per PadmeReco instance, each built from its own slice of the input files
+-- -----------------------------------------------------
+
+ALTER TABLE `PadmeMCDB`.`file_lineage`
+  ADD COLUMN `output_seq_index` INT UNSIGNED NOT NULL DEFAULT 0 COMMENT 'Sequential number within the job of the output file built from the input file (PadmeReco instance of multicore jobs).' AFTER `job_id`;
+
+-- -----------------------------------------------------
+-- Explicit kind of lineage (RECO or MERGE) instead of the 'merge' pseudo reco version
+-- -----------------------------------------------------
+
+ALTER TABLE `PadmeMCDB`.`file_lineage`
+  ADD COLUMN `kind` VARCHAR(32) NOT NULL DEFAULT 'RECO' COMMENT 'Kind of processing of the input file: RECO (reconstruction) or MERGE (merge of small files).' AFTER `input_name`,
+  MODIFY COLUMN `reco_version` VARCHAR(250) NULL COMMENT 'Version of the PadmeReco program used to process the input file. NULL for MERGE lineage.';
+
+UPDATE `PadmeMCDB`.`file_lineage` SET kind = 'MERGE', reco_version = NULL WHERE reco_version = 'merge';
+
+ALTER TABLE `PadmeMCDB`.`file_lineage`
+  DROP INDEX `input_version_idx`,
+  ADD INDEX `input_kind_version_idx` (`input_name` ASC, `kind` ASC, `reco_version` ASC);
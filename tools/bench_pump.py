@@ -0,0 +1,130 @@
+#!/usr/bin/python
+
+import os
+import sys
+import re
+import getopt
+import time
+import subprocess
+import select
+import errno
+
+# Get location of padme-prod software from PADME_PROD env variable
+# Default to ./padme-prod if not set
+PADME_PROD = os.getenv('PADME_PROD',"./padme-prod")
+
+# Output pump used by the worker scripts
+sys.path.append("%s/PadmeProd/script"%PADME_PROD)
+from padmereco_prod import pump_output,check_err_line,PROG_OUT_LOG,PROG_ERR_LOG
+
+# Synthetic chatty program: writes n_lines lines of given length, one every err_every to stderr
+CHATTY_PROGRAM = """
+import sys
+line = "x"*%d+"\\n"
+for i in range(%d):
+    if i%%%d == 0:
+        sys.stderr.write("Warning in <TFile::Init>: line %%d "%%i+line)
+    else:
+        sys.stdout.write("G4WT0 > line %%d "%%i+line)
+"""
+
+def print_help():
+    print "bench_pump [-n <n_lines>] [-l <line_length>] [-e <err_every>] [-r <repeats>] [-h]"
+    print "-n <n_lines>\t\tNumber of lines written by the synthetic program. Default: 1000000"
+    print "-l <line_length>\tLength of each line. Default: 100"
+    print "-e <err_every>\t\tWrite one line every <err_every> to stderr. Default: 10"
+    print "-r <repeats>\t\tNumber of times each pump is run. Default: 3"
+    print "Compare the output pump of the worker scripts with the old select+readline loop"
+
+def legacy_pump(p):
+
+    # Loop used by the worker scripts before the chunk pump was introduced
+    run_problems = False
+    while True:
+        reads = [p.stdout.fileno(),p.stderr.fileno()]
+        try:
+            ret = select.select(reads,[],[],1.)
+        except select.error as ex:
+            if ex[0] == errno.EINTR:
+                continue
+            else:
+                raise
+        for fd in ret[0]:
+            if fd == p.stdout.fileno():
+                read = p.stdout.readline()
+                sys.stdout.write(read)
+            elif fd == p.stderr.fileno():
+                read = p.stderr.readline()
+                sys.stderr.write(read)
+                if re.match("^.*Error in <TNetXNGFile::Open>: \[ERROR\]",read): run_problems = True
+        if p.poll() != None: break
+    return run_problems
+
+def run_pump(pump,program,out_file,err_file):
+
+    # Run synthetic program sending its output through pump to the given files. Return (wall,cpu,bytes)
+    (stdout,stderr) = (sys.stdout,sys.stderr)
+    sys.stdout = open(out_file,"w")
+    sys.stderr = open(err_file,"w")
+    t_start = time.time()
+    cpu_start = os.times()
+    p = subprocess.Popen([sys.executable,"-c",program],stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+    pump(p)
+    p.wait()
+    cpu_end = os.times()
+    t_wall = time.time()-t_start
+    sys.stdout.close()
+    sys.stderr.close()
+    (sys.stdout,sys.stderr) = (stdout,stderr)
+    n_bytes = os.path.getsize(out_file)+os.path.getsize(err_file)
+
+    # Compressed program logs are written by the chunk pump in the current directory
+    for log_file in (PROG_OUT_LOG,PROG_ERR_LOG):
+        if os.path.exists(log_file):
+            n_bytes += os.path.getsize(log_file)
+            os.remove(log_file)
+    return (t_wall,(cpu_end[0]-cpu_start[0])+(cpu_end[1]-cpu_start[1]),n_bytes)
+
+def main(argv):
+
+    try:
+        opts,args = getopt.getopt(argv,"hn:l:e:r:",[])
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+
+    n_lines = 1000000
+    line_length = 100
+    err_every = 10
+    repeats = 3
+    for opt,arg in opts:
+        if opt == '-h':
+            print_help()
+            sys.exit(0)
+        try:
+            if opt == '-n':
+                n_lines = int(arg)
+            elif opt == '-l':
+                line_length = int(arg)
+            elif opt == '-e':
+                err_every = int(arg)
+            elif opt == '-r':
+                repeats = int(arg)
+        except ValueError:
+            print "*** ERROR *** Invalid value '%s' for option %s"%(arg,opt)
+            sys.exit(2)
+
+    program = CHATTY_PROGRAM%(line_length,n_lines,err_every)
+    out_file = "bench_pump_%d.out"%os.getpid()
+    err_file = "bench_pump_%d.err"%os.getpid()
+    print "Synthetic program: %d lines of %d chars, 1 every %d on stderr"%(n_lines,line_length,err_every)
+    pumps = [ ("readline",legacy_pump), ("chunk",lambda p: pump_output(p,check_err_line)) ]
+    for (name,pump) in pumps:
+        for r in range(repeats):
+            (t_wall,t_cpu,n_bytes) = run_pump(pump,program,out_file,err_file)
+            print "%-8s run %d: wall %7.2f s - pump CPU %7.2f s - %d bytes written"%(name,r,t_wall,t_cpu,n_bytes)
+    os.remove(out_file)
+    os.remove(err_file)
+
+# Execution starts here
+if __name__ == "__main__": main(sys.argv[1:])
@@ -201,17 +201,27 @@ def main(argv):
             res = c.fetchall()
             for job in res: job_list.append(job[0])
 
-        # Rename files associated to the jobs
+        # Input files of deleted jobs must be reconstructed again
+        if job_list:
+            if fake_mode:
+                print "DELETE FROM file_lineage WHERE job_id IN (%s)"%",".join([ str(job_id) for job_id in job_list ])
+            else:
+                c.execute("""DELETE FROM file_lineage WHERE job_id IN (%s)"""%",".join(["%s"]*len(job_list)),job_list)
+
+        # Rename files associated to the jobs and collect all storage endpoints used by them
+        storage_uris = [ storage_uri ]
         for job_id in job_list:
-            c.execute("""SELECT id,name FROM file WHERE job_id=%s""",(job_id,))
+            c.execute("""SELECT id,name,storage_uri FROM file WHERE job_id=%s""",(job_id,))
             if c.rowcount != 0:
                 res = c.fetchall()
-                for (file_id,file_name) in res:
+                for (file_id,file_name,file_uri) in res:
 
                     file_name_new = file_name.replace(prod_name,prod_name_new)
 
-                    # Rename file on storage
-                    cmd = "gfal-rename %s%s/%s %s%s/%s"%(storage_uri,storage_dir,file_name,storage_uri,storage_dir,file_name_new)
+                    # Rename file on storage (on the endpoint where the job copied it, if known)
+                    if not file_uri: file_uri = storage_uri
+                    if not file_uri in storage_uris: storage_uris.append(file_uri)
+                    cmd = "gfal-rename %s%s/%s %s%s/%s"%(file_uri,storage_dir,file_name,file_uri,storage_dir,file_name_new)
                     print "> %s"%cmd
                     file_renamed = False
                     if fake_mode:
@@ -238,29 +248,29 @@ def main(argv):
                         else:
                             c.execute("""UPDATE file SET name = %s WHERE id = %s""",(file_name_new,file_id))
 
-        # Rename storage dir
-        cmd = "gfal-rename %s%s %s%s"%(storage_uri,storage_dir,storage_uri,storage_dir_new)
-        print "> %s"%cmd
-        storage_dir_renamed = False
-        if fake_mode:
-            storage_dir_renamed = True
-        else:
+        # Rename storage dir on all endpoints holding files of the production
+        failed_uris = []
+        for uri in storage_uris:
+            cmd = "gfal-rename %s%s %s%s"%(uri,storage_dir,uri,storage_dir_new)
+            print "> %s"%cmd
+            if fake_mode: continue
             attempts = 0
             while True:
                 (rc,out,err) = execute_command(cmd)
-                if rc == 0:
-                    storage_dir_renamed = True
-                    break
+                if rc == 0: break
                 print "WARNING command returned error %d"%rc
                 print "- STDOUT -\n%s"%out
                 print "- STDERR -\n%s"%err
                 attempts += 1
                 if attempts >= 3:
                     print "WARNING %d renaming attempts failed: giving up"%attempts
+                    failed_uris.append(uri)
                     break
 
-        # Change storage dir in DB
-        if storage_dir_renamed:
+        # Change storage dir in DB only if it was renamed on all endpoints
+        if failed_uris:
+            print "WARNING Storage dir %s was not renamed on %s: storage dir in DB not changed"%(storage_dir," ".join(failed_uris))
+        else:
             if fake_mode:
                 print "UPDATE production SET storage_dir = %s WHERE id = %d"%(storage_dir_new,prod_id)
             else:
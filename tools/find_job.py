@@ -0,0 +1,95 @@
+#!/usr/bin/python
+
+import MySQLdb
+import os
+import sys
+import getopt
+
+# Get location of padme-prod software from PADME_PROD env variable
+# Default to ./padme-prod if not set
+PADME_PROD = os.getenv('PADME_PROD',"./padme-prod")
+
+# Production directory layout helpers are shared with the production daemon
+sys.path.append("%s/PadmeProd/code"%PADME_PROD)
+from ProdLayout import ProdLayout
+
+# Get DB connection parameters from environment variables
+DB_HOST   = os.getenv('PADME_MCDB_HOST'  ,'percona.lnf.infn.it')
+DB_PORT   = int(os.getenv('PADME_MCDB_PORT'  ,'3306'))
+DB_USER   = os.getenv('PADME_MCDB_USER'  ,'padmeMCDB')
+DB_PASSWD = os.getenv('PADME_MCDB_PASSWD','unknown')
+DB_NAME   = os.getenv('PADME_MCDB_NAME'  ,'PadmeMCDB')
+
+def print_help():
+    print "find_job -p <prod_name> [-j <job_name>] [-h]"
+    print "-p <prod_name>\tName of the production"
+    print "-j <job_name>\tName of the job to look for. If not given, all job directories of the production are listed"
+    print "N.B. this script must be run from the main production directory"
+
+def main(argv):
+
+    try:
+        opts,args = getopt.getopt(argv,"hp:j:",[])
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+
+    prod_name = ""
+    job_name = ""
+    for opt,arg in opts:
+        if opt == '-p':
+            prod_name = arg
+        elif opt == '-j':
+            job_name = arg
+        elif opt == '-h':
+            print_help()
+            sys.exit(0)
+
+    if not prod_name:
+        print "*** ERROR *** No production specified"
+        print_help()
+        sys.exit(2)
+
+    try:
+        conn = MySQLdb.connect(host   = DB_HOST,
+                               port   = DB_PORT,
+                               user   = DB_USER,
+                               passwd = DB_PASSWD,
+                               db     = DB_NAME)
+    except:
+        print "*** ERROR *** Unable to connect to DB. Exception: %s"%sys.exc_info()[0]
+        sys.exit(2)
+
+    c = conn.cursor()
+    c.execute("""SELECT id,prod_dir FROM production WHERE name=%s""",(prod_name,))
+    if c.rowcount == 0:
+        print "*** ERROR *** Production '%s' does not exist in the DB"%prod_name
+        sys.exit(1)
+    (prod_id,prod_dir) = c.fetchone()
+    conn.commit()
+
+    layout = ProdLayout(prod_dir)
+
+    # No job specified: list all job directories found in the production directory
+    if not job_name:
+        for (name,local_dir) in layout.list_job_dirs(): print "%-10s %s/%s"%(name,prod_dir,local_dir)
+        sys.exit(0)
+
+    # Use job directory registered in DB or look for it in the production directory
+    job_dir = ""
+    c.execute("""SELECT job_dir FROM job WHERE production_id=%s AND name=%s""",(prod_id,job_name))
+    if c.rowcount != 0:
+        (job_dir,) = c.fetchone()
+    conn.commit()
+    if not (job_dir and os.path.isdir("%s/%s"%(prod_dir,job_dir))):
+        job_dir = layout.find_job_dir(job_name)
+    if not job_dir:
+        print "*** ERROR *** Job %s of production %s not found"%(job_name,prod_name)
+        sys.exit(1)
+
+    print "%s/%s"%(prod_dir,job_dir)
+    for entry in sorted(os.listdir("%s/%s"%(prod_dir,job_dir))):
+        if entry.startswith("submit_"): print "  %s"%entry
+
+# Execution starts here
+if __name__ == "__main__": main(sys.argv[1:])
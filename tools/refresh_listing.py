@@ -0,0 +1,79 @@
+#!/usr/bin/python
+
+import os
+import sys
+import getopt
+
+# Get location of padme-prod software from PADME_PROD env variable
+# Default to ./padme-prod if not set
+PADME_PROD = os.getenv('PADME_PROD',"./padme-prod")
+
+# Listing cache is shared with the production scripts
+sys.path.append("%s/PadmeProd/code"%PADME_PROD)
+from ListingCache import ListingCache
+
+# Default storage URI (same used by PadmeRecoProd to get list of rawdata files)
+SOURCE_URI = "srm://atlasse.lnf.infn.it:8446/srm/managerv2?SFN=/dpm/lnf.infn.it/home/vo.padme.org"
+
+def print_help():
+    print "refresh_listing -p <path> [-u <uri>] [-s <subdir>] [-t <ttl>] [-l] [-V] [-h]"
+    print "-p <path>\tStorage path to list, e.g. /daq/2020/rawdata"
+    print "-u <uri>\tStorage URI. Default: %s"%SOURCE_URI
+    print "-s <subdir>\tRefresh only this subdirectory of <path>. Can be repeated. Default: all subdirectories"
+    print "-t <ttl>\tTime (s) after which cached listings must be validated. Default: PADME_LISTING_TTL or 3600"
+    print "-l\t\tOnly refresh listing of <path>, not of its subdirectories"
+    print "-V\t\tEnable debug mode. Can be repeated to increase verbosity"
+    print "N.B. this script must be run from the main production directory"
+
+def main(argv):
+
+    try:
+        opts,args = getopt.getopt(argv,"hlVp:u:s:t:",[])
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+
+    uri = SOURCE_URI
+    path = ""
+    subdirs = None
+    ttl = None
+    top_only = False
+    debug = 0
+    for opt,arg in opts:
+        if opt == '-p':
+            path = arg
+        elif opt == '-u':
+            uri = arg
+        elif opt == '-s':
+            if subdirs == None: subdirs = []
+            subdirs.append(arg)
+        elif opt == '-t':
+            try:
+                ttl = int(arg)
+            except ValueError:
+                print "*** ERROR *** Invalid TTL '%s'"%arg
+                sys.exit(2)
+        elif opt == '-l':
+            top_only = True
+        elif opt == '-V':
+            debug += 1
+        elif opt == '-h':
+            print_help()
+            sys.exit(0)
+
+    if not path:
+        print "*** ERROR *** No path specified"
+        print_help()
+        sys.exit(2)
+
+    cache = ListingCache("",ttl,debug)
+    if top_only:
+        if cache.fetch(uri,path) == None: sys.exit(1)
+        n_listed = 1
+    else:
+        n_listed = cache.refresh_tree(uri,path,subdirs)
+        if n_listed < 0: sys.exit(1)
+    print "Listing cache %s refreshed: %d directories listed on storage"%(cache.cache_dir,n_listed)
+
+# Execution starts here
+if __name__ == "__main__": main(sys.argv[1:])
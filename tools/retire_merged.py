@@ -0,0 +1,85 @@
+#!/usr/bin/python
+
+import os
+import sys
+import getopt
+import subprocess
+import shlex
+
+# Get location of padme-prod software from PADME_PROD env variable
+# Default to ./padme-prod if not set
+PADME_PROD = os.getenv('PADME_PROD',"./padme-prod")
+
+# DB interface is shared with the production scripts
+sys.path.append("%s/PadmeProd/code"%PADME_PROD)
+from PadmeMCDB import PadmeMCDB
+
+def print_help():
+    print "retire_merged -n <merge_prod_name> [-f] [-V] [-h]"
+    print "-n <merge_prod_name>\tName of the merge production whose source files will be retired"
+    print "-f\t\t\tEnable FAKE mode: show files to retire without removing them"
+    print "-V\t\t\tEnable debug mode. Can be repeated to increase verbosity"
+    print "N.B. only files merged by successful jobs into a registered merged file are removed from storage."
+    print "     Retired files stay in the DB (with their retirement time) and their lineage is kept."
+
+def main(argv):
+
+    try:
+        opts,args = getopt.getopt(argv,"hfVn:",[])
+    except getopt.GetoptError:
+        print_help()
+        sys.exit(2)
+
+    prod_name = ""
+    fake = False
+    debug = 0
+    for opt,arg in opts:
+        if opt == '-n':
+            prod_name = arg
+        elif opt == '-f':
+            fake = True
+        elif opt == '-V':
+            debug += 1
+        elif opt == '-h':
+            print_help()
+            sys.exit(0)
+
+    if not prod_name:
+        print "*** ERROR *** No merge production specified"
+        print_help()
+        sys.exit(2)
+
+    db = PadmeMCDB()
+    if not db.is_prod_in_db(prod_name) or db.get_prod_type(db.get_prod_id(prod_name)) != "MERGE":
+        print "*** ERROR *** '%s' is not a merge production"%prod_name
+        sys.exit(2)
+
+    files = db.get_retirable_files(prod_name)
+    print "Merge production %s: %d files to retire"%(prod_name,len(files))
+
+    n_retired = 0
+    n_failed = 0
+    for (file_id,file_name,storage_uri,storage_dir) in files:
+        cmd = "gfal-rm %s%s/%s"%(storage_uri,storage_dir,file_name)
+        if fake:
+            print "(FAKE) > %s"%cmd
+            continue
+        if debug: print "> %s"%cmd
+        p = subprocess.Popen(shlex.split(cmd),stdout=subprocess.PIPE,stderr=subprocess.PIPE)
+        (out,err) = p.communicate()
+        if p.returncode == 0:
+            db.set_file_retired(file_id)
+            n_retired += 1
+        else:
+            print "WARNING gfal-rm returned error status %d while removing %s"%(p.returncode,file_name)
+            if debug:
+                print "- STDOUT -\n%s"%out
+                print "- STDERR -\n%s"%err
+            n_failed += 1
+
+    db.close_db()
+    if not fake: print "Retired %d files. %d files could not be removed"%(n_retired,n_failed)
+    if n_failed: sys.exit(1)
+
+# Execution starts here
+if __name__ == "__main__": main(sys.argv[1:])
@@ -37,6 +37,7 @@ SELECT
                 WHEN 108 THEN '108 Done-Failed - No Out'
                 WHEN 109 THEN '109 Cancelled - No Out'
                 WHEN 207 THEN '207 Done-OK - RC!=0'
+                WHEN 307 THEN '307 Done-OK - Hung'
                          ELSE CONCAT(LPAD(s.status,3," "),' ???')
   END                                AS 'sub status',
   s.exit_code                        AS 'exit code',